@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Headless asyncio client for the Onkyo controller program.
+
+This speaks the same line protocol as the OnkyoClient in frontend.py but does
+not depend on GTK; every connection is a pair of asyncio streams, so a single
+event loop can hold as many daemon connections as it has file descriptors.
+"""
+
+import asyncio
+import logging
+
+from onkyoproto import HELLO_MESSAGE, STATUSES, verify_frequency, \
+        decode_line, OnkyoClientException, ConnectionError, CommandException
+
+HOST = 'localhost'
+PORT = 8701
+
+# seconds between reconnection attempts, same as the GTK frontend
+RECONNECT_DELAY = 2.0
+
+log = logging.getLogger(__name__)
+
+class AsyncOnkyoClient:
+    """
+    This class holds information and methods for connecting to the Onkyo
+    receiver daemon program from an asyncio event loop. Pass either a host
+    and port for a TCP connection or a path for a UNIX socket connection.
+    """
+
+    def __init__(self, host=HOST, port=PORT, path=None, reconnect=True):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.reconnect = reconnect
+
+        self._reader = None
+        self._writer = None
+        self._readtask = None
+        self._closing = False
+
+        # one queue per active events() iterator
+        self._listeners = set()
+
+        # our status container object
+        self.status = dict()
+        for item in STATUSES:
+            self.status[item] = None
+        self.status['epoch'] = 0
+
+    async def _connect(self):
+        if self.path:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            await self._hello(reader)
+        except ConnectionError:
+            writer.close()
+            raise
+        self._reader = reader
+        self._writer = writer
+
+    async def _hello(self, reader):
+        line = await reader.readline()
+        line = line.decode('utf-8', 'replace').rstrip("\n")
+        if not line.startswith(HELLO_MESSAGE):
+            raise ConnectionError("Invalid hello message: '%s'" % line)
+
+    def _disconnect(self):
+        if self._writer:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    async def connect(self):
+        """
+        Connect to the daemon, verify the hello line, and start processing
+        input. Raises ConnectionError if the connection could not be made.
+        """
+        self._closing = False
+        try:
+            await self._connect()
+        except OSError as e:
+            raise ConnectionError("Could not connect: %s" % e)
+        self._established()
+        self._readtask = asyncio.ensure_future(self._run())
+
+    def _established(self):
+        # allow callers to see that we may have stale data
+        self.status['epoch'] = self.status['epoch'] + 1
+        self._notify('epoch', self.status['epoch'])
+
+    async def close(self):
+        self._closing = True
+        if self._readtask:
+            self._readtask.cancel()
+            try:
+                await self._readtask
+            except asyncio.CancelledError:
+                pass
+            self._readtask = None
+        if self._writer:
+            writer = self._writer
+            self._disconnect()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        self._notify(None, None)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _run(self):
+        try:
+            await self._serve()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Lost the controller connection")
+            self._disconnect()
+        finally:
+            # whatever ended input processing, end the events() iterators;
+            # close() does this itself
+            if not self._closing:
+                self._notify(None, None)
+
+    async def _querypower(self):
+        try:
+            await self.querypower()
+        except OSError:
+            # the next read notices the connection is gone
+            pass
+
+    async def _serve(self):
+        # we've verified the connection, get powered on status
+        await self._querypower()
+        while not self._closing:
+            try:
+                line = await self._reader.readline()
+            except ValueError:
+                # the stream has already skipped past the overlong line
+                log.warning("Discarded an overlong line from the controller")
+                continue
+            except OSError:
+                line = b""
+            if line.endswith(b"\n"):
+                self._processline(line.decode('utf-8', 'replace')[:-1])
+                continue
+            # EOF; anything without a newline is a partial, discarded line
+            self._disconnect()
+            if not self.reconnect:
+                return
+            log.info("Attempting to reconnect to controller socket")
+            while not self._closing:
+                await asyncio.sleep(RECONNECT_DELAY)
+                try:
+                    await self._connect()
+                except (OSError, ConnectionError):
+                    continue
+                self._established()
+                await self._querypower()
+                break
+
+    def _processline(self, line):
+        log.debug("received line: %s", line)
+        if line.startswith("ERROR"):
+            log.warning("Error received: %s", line)
+            return
+        try:
+            decoded = decode_line(line)
+        except ValueError:
+            decoded = None
+        if not decoded:
+            log.debug("Unrecognized response: %s", line)
+            return
+        key, value = decoded
+        self.status[key] = value
+        self._notify(key, value)
+
+    def _notify(self, key, value):
+        for queue in self._listeners:
+            queue.put_nowait((key, value))
+
+    async def events(self):
+        """
+        Asynchronously iterate over status events as (key, value) tuples.
+        A reconnection produces an ('epoch', n) event; the iterator finishes
+        when the client is closed.
+        """
+        queue = asyncio.Queue()
+        self._listeners.add(queue)
+        try:
+            while True:
+                key, value = await queue.get()
+                if key is None:
+                    return
+                yield key, value
+        finally:
+            self._listeners.discard(queue)
+
+    async def _writeline(self, line):
+        log.debug("sending line: %s", line)
+        if self._writer is None:
+            return False
+        self._writer.write(("%s\n" % line).encode('utf-8'))
+        await self._writer.drain()
+        return True
+
+    async def querystatus(self):
+        await self._writeline("status")
+
+    async def queryzone2status(self):
+        await self._writeline("status zone2")
+
+    async def querysleep(self):
+        await self._writeline("sleep")
+
+    async def queryzone2sleep(self):
+        await self._writeline("zone2sleep")
+
+    async def querypower(self):
+        await self._writeline("power")
+        await self._writeline("zone2power")
+
+    async def setpower(self, state):
+        self.status['power'] = bool(state)
+        if state == True:
+            await self._writeline("power on")
+        else:
+            await self._writeline("power off")
+
+    async def setmute(self, state):
+        self.status['mute'] = bool(state)
+        if state == True:
+            await self._writeline("mute on")
+        else:
+            await self._writeline("mute off")
+
+    async def setvolume(self, volume):
+        try:
+            intval = int(volume)
+        except ValueError:
+            raise CommandException("Volume not an integer: %s" % volume)
+        if intval < 0 or intval > 100:
+            raise CommandException("Volume out of range: %d" % intval)
+        self.status['volume'] = intval
+        await self._writeline("volume %d" % intval)
+
+    async def setinput(self, inp):
+        valid_inputs = [ 'dvr', 'vcr', 'cable', 'sat', 'tv', 'aux', 'dvd',
+                'tape', 'phono', 'cd', 'fm', 'fm tuner', 'am', 'am tuner',
+                'tuner', 'multich', 'xm', 'sirius' ]
+        if inp.lower() not in valid_inputs:
+            raise CommandException("Input not valid: %s" % inp)
+        self.status['input'] = inp
+        await self._writeline("input %s" % inp)
+
+    async def setmode(self, mode):
+        valid_modes = [ 'stereo', 'direct', 'acstereo', 'fullmono',
+                'mono', 'pure', 'straight',
+                'thx', 'pliimovie', 'pliimusic', 'pliigame',
+                'neo6cinema', 'neo6music', 'pliithx', 'neo6thx',
+                'neuralthx' ]
+        if mode.lower() not in valid_modes:
+            raise CommandException("Listening mode not valid: %s" % mode)
+        self.status['mode'] = mode
+        await self._writeline("mode %s" % mode)
+
+    async def settune(self, freq):
+        # this will throw an exception if freq was invalid
+        value = verify_frequency(freq)
+        if value[0] == "AM":
+            await self._writeline("tune %d" % value[1])
+        else:
+            await self._writeline("tune %.1f" % value[1])
+
+    async def setsleep(self, mins):
+        try:
+            intval = int(mins)
+        except ValueError:
+            raise CommandException("Sleep time not an integer: %s" % mins)
+        if intval < 0 or intval > 90:
+            raise CommandException("Sleep time out of range: %d" % intval)
+        self.status['sleep'] = intval
+        if intval > 0:
+            await self._writeline("sleep %d" % intval)
+        else:
+            await self._writeline("sleep off")
+
+    async def setzone2power(self, state):
+        self.status['zone2power'] = bool(state)
+        if state == True:
+            await self._writeline("zone2power on")
+        else:
+            await self._writeline("zone2power off")
+
+    async def setzone2mute(self, state):
+        self.status['zone2mute'] = bool(state)
+        if state == True:
+            await self._writeline("zone2mute on")
+        else:
+            await self._writeline("zone2mute off")
+
+    async def setzone2volume(self, volume):
+        try:
+            intval = int(volume)
+        except ValueError:
+            raise CommandException("Volume not an integer: %s" % volume)
+        if intval < 0 or intval > 100:
+            raise CommandException("Volume out of range: %d" % intval)
+        self.status['zone2volume'] = intval
+        await self._writeline("zone2volume %d" % intval)
+
+    async def setzone2input(self, inp):
+        valid_inputs = [ 'dvr', 'vcr', 'cable', 'sat', 'tv', 'aux', 'dvd',
+                'tape', 'phono', 'cd', 'fm', 'fm tuner', 'am', 'am tuner',
+                'tuner', 'multich', 'xm', 'sirius',
+                'source', 'off' ]
+        if inp.lower() not in valid_inputs:
+            raise CommandException("Input not valid: %s" % inp)
+        self.status['zone2input'] = inp
+        await self._writeline("zone2input %s" % inp)
+
+    async def setzone2tune(self, freq):
+        # this will throw an exception if freq was invalid
+        value = verify_frequency(freq)
+        if value[0] == "AM":
+            await self._writeline("zone2tune %d" % value[1])
+        else:
+            await self._writeline("zone2tune %.1f" % value[1])
+
+    async def setzone2sleep(self, mins):
+        try:
+            intval = int(mins)
+        except ValueError:
+            raise CommandException("Sleep time not an integer: %s" % mins)
+        if intval < 0 or intval > 1440:
+            raise CommandException("Sleep time out of range: %d" % intval)
+        self.status['zone2sleep'] = intval
+        if intval > 0:
+            await self._writeline("zone2sleep %d" % intval)
+        else:
+            await self._writeline("zone2sleep off")
+
+
+async def _main(argv):
+    host = HOST
+    port = PORT
+    if len(argv) > 1:
+        host = argv[1]
+    if len(argv) > 2:
+        port = int(argv[2])
+    if host.startswith("/"):
+        client = AsyncOnkyoClient(path=host)
+    else:
+        client = AsyncOnkyoClient(host, port)
+    async with client:
+        async for key, value in client.events():
+            print("%s: %s" % (key, value))
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig()
+    try:
+        asyncio.run(_main(sys.argv))
+    except KeyboardInterrupt:
+        pass
+
+# vim: set ts=4 sw=4 et:
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the iscp.py codec.
+
+Decodes a buffer of receiver messages, a power-on burst repeated many
+times, into daemon status lines in several ways:
+
+ - per message: split the buffer into messages, find the start of each,
+   decode it to a string and translate it, the way the tools did before
+   the codec
+ - decode_frames: the batch decoder over the same serial data
+ - decode_packets: the batch decoder over the same messages as eISCP
+ - decode_file: the batch decoder over a raw log file
+
+and encodes a list of commands as serial frames and eISCP packets.
+
+Usage: bench/codec.py [messages]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+
+import iscp
+
+# a power on burst plus some messages that need translating rather than a
+# lookup, and a few that are not known at all
+MESSAGES = [
+    "PWR01", "MVL28", "AMT00", "SLI24", "LMD00", "TUN09790", "PRS01",
+    "SLP00", "DIM00", "ZPW01", "ZVL14", "SLZ80", "TUZ00780", "SL323",
+    "LMD88", "SWL+3", "AVS1000", "TGCN/A", "IFAHDMI 1,PCM,48 kHz",
+]
+
+ENDS = [ b"\x1a", b"\x1a\r\n", b"\r\n" ]
+
+def per_message(buf):
+    """Decode one message at a time, with no shared state."""
+    lines = []
+    for frame in buf.replace(b"\r\n", b"\x1a").split(b"\x1a"):
+        start = frame.find(iscp.START)
+        if start < 0:
+            continue
+        code = frame[start + len(iscp.START):].decode('latin-1')
+        lines.extend(iscp.status_lines(code))
+    return lines
+
+def timed(func, *args, repeat=5):
+    """Return the best elapsed time of several runs and the last result."""
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def report(name, count, unit, elapsed, extra=""):
+    print("%-16s %10.0f %s/sec  (%d %s%s)" % (name, count / elapsed, unit,
+            count, unit, extra))
+
+def main():
+    count = 200000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    codes = [ MESSAGES[i % len(MESSAGES)] for i in range(count) ]
+    serial = b"".join(iscp.START + code.encode('ascii') + ENDS[i % len(ENDS)]
+            for i, code in enumerate(codes))
+    packets = b"".join(iscp.HEADER.pack(iscp.MAGIC, iscp.HEADER.size,
+            len(code) + 3, iscp.VERSION) + iscp.START +
+            code.encode('ascii') + iscp.EOF for code in codes)
+
+    elapsed, lines = timed(per_message, serial)
+    report("per message", count, "msgs", elapsed,
+            ", %d lines" % len(lines))
+    elapsed, (batch, used) = timed(iscp.decode_frames, serial)
+    report("decode_frames", count, "msgs", elapsed,
+            ", %d lines, %s" % (len(batch),
+            "same" if batch == lines else "DIFFERENT"))
+    elapsed, (batch, used) = timed(iscp.decode_packets, packets)
+    report("decode_packets", count, "msgs", elapsed,
+            ", %d lines, %s" % (len(batch),
+            "same" if batch == lines else "DIFFERENT"))
+
+    with tempfile.NamedTemporaryFile(prefix="onkyo-codec-") as f:
+        f.write(serial)
+        f.flush()
+        elapsed, batch = timed(iscp.decode_file, f.name)
+        report("decode_file", count, "msgs", elapsed,
+                ", %d bytes" % len(serial))
+
+    elapsed, frames = timed(lambda: [ iscp.encode_frame(c) for c in codes ])
+    report("encode_frame", count, "cmds", elapsed)
+    elapsed, frames = timed(lambda: [ iscp.encode_packet(c) for c in codes ])
+    report("encode_packet", count, "cmds", elapsed)
+
+if __name__ == "__main__":
+    main()
+
+# vim: set ts=4 sw=4 et:
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for client-side response decoding.
+
+Compares the old if/elif chain from OnkyoClient._processinput with the
+RESPONSES dispatch table in onkyoproto.py, which frontend.py and
+asyncclient.py both decode with. Both print what they do not recognize,
+as the frontend does, only to a null sink rather than the terminal.
+
+Usage: bench/decode.py [iterations]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+
+from onkyoproto import decode_line
+
+NULL = open(os.devnull, "w")
+
+# a power-on burst as produced by "status" and "status zone2", plus the odd
+# message the old chain did not know about
+LINES = [
+    "OK:power:on",
+    "OK:dbvolume:-40",
+    "OK:volume:42",
+    "OK:mute:off",
+    "OK:input:FM Tuner",
+    "OK:mode:Neo:6 Cinema",
+    "OK:tune:97.9 FM",
+    "OK:preset:3",
+    "OK:zone2power:on",
+    "OK:zone2dbvolume:-62",
+    "OK:zone2volume:20",
+    "OK:zone2mute:off",
+    "OK:zone2input:CD",
+    "OK:zone2tune:780 AM",
+    "OK:swlevel:+3",
+    "OK:avsync:100",
+    "OK:dimmer:Dim",
+    "OK:latenight:off",
+    "OK:audyssey:on",
+    "OK:todo:IFAHDMI 1,PCM,48 kHz",
+]
+
+def legacy_decode(status, line):
+    """The decoding done by _processinput before the dispatch table."""
+    line = line.split(":")
+    if line[0] == "ERROR":
+        NULL.write("Error received: %s\n" % (line,))
+        return False
+    elif line[1] == "power":
+        if line[2] == "on":
+            status['power'] = True
+        else:
+            status['power'] = False
+    elif line[1] == "mute":
+        if line[2] == "on":
+            status['mute'] = True
+        else:
+            status['mute'] = False
+    elif line[1] == "mode":
+        status['mode'] = ":".join(line[2:])
+    elif line[1] == "volume":
+        status['volume'] = int(line[2])
+    elif line[1] == "input":
+        status['input'] = ":".join(line[2:])
+    elif line[1] == "tune":
+        status['tune'] = ":".join(line[2:])
+    elif line[1] == "sleep":
+        status['sleep'] = int(line[2])
+    elif line[1] == "zone2power":
+        if line[2] == "on":
+            status['zone2power'] = True
+        else:
+            status['zone2power'] = False
+    elif line[1] == "zone2mute":
+        if line[2] == "on":
+            status['zone2mute'] = True
+        else:
+            status['zone2mute'] = False
+    elif line[1] == "zone2mode":
+        status['zone2mode'] = line[2]
+    elif line[1] == "zone2volume":
+        status['zone2volume'] = int(line[2])
+    elif line[1] == "zone2input":
+        status['zone2input'] = line[2]
+    elif line[1] == "zone2tune":
+        status['zone2tune'] = line[2]
+    elif line[1] == "zone2sleep":
+        status['zone2sleep'] = int(line[2])
+    else:
+        NULL.write("Unrecognized response: %s\n" % (line,))
+        return False
+    return True
+
+def table_decode(status, line):
+    """The decoding done by _processlines in frontend.py."""
+    if line.startswith("ERROR"):
+        NULL.write("Error received: %s\n" % line)
+        return False
+    decoded = decode_line(line)
+    if decoded:
+        status[decoded[0]] = decoded[1]
+        return True
+    NULL.write("Unrecognized response: %s\n" % line)
+    return False
+
+def run(decoder, lines, iterations, repeat=5):
+    """Return the best elapsed time of several runs and the hit count."""
+    best = None
+    for r in range(repeat):
+        status = {}
+        recognized = 0
+        start = time.time()
+        for i in range(iterations):
+            for line in lines:
+                if decoder(status, line):
+                    recognized += 1
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, recognized
+
+def main():
+    iterations = 20000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    total = iterations * len(LINES)
+    for name, decoder in (("before", legacy_decode), ("after", table_decode)):
+        elapsed, recognized = run(decoder, LINES, iterations)
+        print("%-7s %10.0f lines/sec  (%d of %d lines recognized)" % (
+                name, total / elapsed, recognized, total))
+
+if __name__ == "__main__":
+    main()
+
+# vim: set ts=4 sw=4 et:
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test for the onkyocontrol daemon.
+
+Starts the daemon against an emulated receiver (see emulator.py), connects
+a number of clients over a UNIX socket and has each of them send a mix of
+commands at a fixed rate. When the run is over, a JSON report is written
+with:
+
+ - command-to-broadcast latency percentiles, from the moment a client sends
+   a command until the status line answering it reaches that client; with
+   --request-ids, until the daemon acknowledges the last receiver command
+   of the request as answered (or dropped), along with counts of each kind
+   of acknowledgement
+ - serial commands per second seen by the emulated receiver
+ - broadcast fan-out time, the spread between the first and the last client
+   receiving the same broadcast line, and the lines and bytes received;
+   only lines every client received count, and measuring starts once the
+   daemon has been quiet for a moment
+ - daemon CPU time and resident set size, read from /proc
+
+Usage: bench/loadtest.py [options], see --help.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.normpath(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, ROOT)
+
+from emulator import Emulator, ReceiverState
+
+HELLO_MESSAGE = "OK:onkyocontrol"
+
+# seconds without a line after which the daemon is taken to be done
+# with whatever it was sending
+QUIET = 0.5
+
+MODES = { 'stereo': 'Stereo', 'direct': 'Direct', 'mono': 'Mono',
+        'pure': 'Pure Audio', 'straight': 'Straight Decode' }
+
+def _volume():
+    value = random.randint(0, 100)
+    return "volume %d" % value, "OK:volume:%d" % value, True
+
+def _zone2volume():
+    value = random.randint(0, 100)
+    return "zone2volume %d" % value, "OK:zone2volume:%d" % value, True
+
+def _tune():
+    freq = random.randrange(8750, 10790, 20)
+    return ("tune %d.%d" % (freq // 100, (freq // 10) % 10),
+            "OK:tune:%d.%d FM" % (freq // 100, (freq // 10) % 10), True)
+
+def _mute():
+    value = random.choice(('on', 'off'))
+    return "mute %s" % value, "OK:mute:%s" % value, True
+
+def _mode():
+    key = random.choice(sorted(MODES))
+    return "mode %s" % key, "OK:mode:%s" % MODES[key], True
+
+def _query():
+    return "volume", "OK:volume:", False
+
+def _status():
+    # the tuner is the last thing a main zone status query asks for
+    return "status", "OK:tune:", False
+
+# name -> generator of (command, expected line, exact match)
+WORKLOADS = {
+    'volume': _volume,
+    'zone2volume': _zone2volume,
+    'tune': _tune,
+    'mute': _mute,
+    'mode': _mode,
+    'query': _query,
+    'status': _status,
+}
+DEFAULT_MIX = "volume=4,zone2volume=1,tune=1,mute=1,mode=1,query=2,status=1"
+
+def parse_mix(mix):
+    names, weights = [], []
+    for item in mix.split(","):
+        name, sep, weight = item.partition("=")
+        if name not in WORKLOADS:
+            raise SystemExit("unknown workload '%s', choose from %s" %
+                    (name, ", ".join(sorted(WORKLOADS))))
+        names.append(name)
+        weights.append(float(weight) if weight else 1.0)
+    return names, weights
+
+def percentiles(values, scale=1000.0):
+    if not values:
+        return None
+    values = sorted(values)
+    def pct(p):
+        return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+    return {
+        'count': len(values),
+        'mean': scale * sum(values) / len(values),
+        'p50': scale * pct(50),
+        'p90': scale * pct(90),
+        'p99': scale * pct(99),
+        'max': scale * values[-1],
+    }
+
+# acknowledgements after which a receiver command is no longer outstanding
+ACK_FINAL = ('answered', 'unanswered', 'superseded', 'skipped', 'rejected')
+
+class Client:
+    """One connection to the daemon, recording when every line arrived."""
+
+    def __init__(self, index, request_ids=False):
+        self.index = index
+        self.request_ids = request_ids
+        # request ID -> [send time, receiver commands outstanding]
+        self.requests = {}
+        self.acks = {}
+        self.next_id = 0
+        self.reader = None
+        self.writer = None
+        # (expected line, exact match, send time) oldest first
+        self.pending = []
+        self.latencies = []
+        # (line, arrival time) of every broadcast line
+        self.arrivals = []
+        self.bytes = 0
+        self.sent = 0
+        # when the last line of any kind arrived
+        self.last = time.monotonic()
+
+    async def connect(self, path, subscribe=None):
+        self.reader, self.writer = await asyncio.open_unix_connection(path)
+        hello = await self.reader.readline()
+        if not hello.decode().startswith(HELLO_MESSAGE):
+            raise RuntimeError("bad hello from daemon: %r" % hello)
+        if subscribe:
+            self.writer.write(("subscribe %s\n" % subscribe).encode())
+            # a status snapshot (-S) may come first
+            reply = await self.reader.readline()
+            while reply.startswith(b"OK:") and \
+                    not reply.startswith(b"OK:subscribe:"):
+                reply = await self.reader.readline()
+            if not reply.decode().startswith("OK:subscribe:"):
+                raise RuntimeError("subscribe failed: %r" % reply)
+
+    def send(self, command, expected, exact):
+        if self.request_ids:
+            self.next_id += 1
+            self.requests[str(self.next_id)] = [time.monotonic(), 0]
+            command = "@%d %s" % (self.next_id, command)
+        else:
+            self.pending.append((expected, exact, time.monotonic()))
+        self.writer.write(("%s\n" % command).encode())
+        self.sent += 1
+
+    def ack(self, line, now):
+        """Account for an "ACK:id:event[:command]" line."""
+        fields = line.split(":", 3)
+        req = self.requests.get(fields[1])
+        event = fields[2]
+        self.acks[event] = self.acks.get(event, 0) + 1
+        if req is None:
+            return
+        if event == 'queued':
+            req[1] += 1
+            return
+        if event in ACK_FINAL:
+            req[1] -= 1
+        if req[1] <= 0:
+            self.latencies.append(now - req[0])
+            del self.requests[fields[1]]
+
+    @property
+    def waiting(self):
+        return self.requests if self.request_ids else self.pending
+
+    async def read(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            now = time.monotonic()
+            self.last = now
+            if line.startswith(b"ACK:"):
+                # only this client gets these, they are no broadcast
+                self.ack(line.decode().rstrip("\n"), now)
+                continue
+            self.bytes += len(line)
+            line = line.decode().rstrip("\n")
+            self.arrivals.append((line, now))
+            for i, (expected, exact, sent) in enumerate(self.pending):
+                if line == expected or (not exact and
+                        line.startswith(expected)):
+                    self.latencies.append(now - sent)
+                    del self.pending[i]
+                    break
+
+    async def drive(self, rate, duration, names, weights):
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            name = random.choices(names, weights)[0]
+            self.send(*WORKLOADS[name]())
+            await self.writer.drain()
+            # low rates with many clients: don't sleep past the end of the run
+            await asyncio.sleep(min(random.expovariate(rate),
+                max(0, end - time.monotonic())))
+
+def proc_stats(pid):
+    """Return (cpu seconds, rss kB, peak rss kB) for a process."""
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    # utime and stime are fields 14 and 15, 1-based, of the full line
+    cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+    rss = hwm = 0
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+            elif line.startswith("VmHWM:"):
+                hwm = int(line.split()[1])
+    return cpu, rss, hwm
+
+async def wait_for_quiet(clients, quiet=QUIET):
+    """Wait until none of the clients has received a line for a while."""
+    while True:
+        idle = time.monotonic() - max(c.last for c in clients)
+        if idle >= quiet:
+            return
+        await asyncio.sleep(quiet - idle)
+
+def fanout_times(clients):
+    """
+    Return the spread between the first and the last client receiving each
+    broadcast. A broadcast is known by its text and by how many times the
+    same text arrived before it; lines not every client received, such as
+    answers outside a subscription, are left out.
+    """
+    if not clients:
+        return []
+    seen = []
+    for c in clients:
+        counts, times = {}, {}
+        for line, when in c.arrivals:
+            n = counts.get(line, 0)
+            counts[line] = n + 1
+            times[(line, n)] = when
+        seen.append(times)
+    common = set(seen[0]).intersection(*seen[1:])
+    return [ max(t[key] for t in seen) - min(t[key] for t in seen)
+            for key in common ]
+
+async def wait_for_socket(path, proc, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if proc.poll() is not None or time.monotonic() > end:
+            raise RuntimeError("daemon did not start")
+        await asyncio.sleep(0.05)
+
+async def run(args):
+    names, weights = parse_mix(args.mix)
+    tmpdir = tempfile.mkdtemp(prefix="onkyo-bench-")
+    sockpath = os.path.join(tmpdir, "onkyo.sock")
+
+    emulator = Emulator(ReceiverState(), latency=args.latency / 1000.0,
+            baud=args.baud)
+    serial = emulator.open()
+    await emulator.start()
+
+    daemon = subprocess.Popen([args.daemon, "-s", serial, "-u", sockpath] +
+            args.daemon_args, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+    clients = []
+    try:
+        await wait_for_socket(sockpath, daemon)
+
+        # power everything up before measuring anything
+        control = Client(-1)
+        await control.connect(sockpath)
+        reader = asyncio.ensure_future(control.read())
+        control.send("power on", "OK:power:on", True)
+        control.send("zone2power on", "OK:zone2power:on", True)
+        while control.pending:
+            await asyncio.sleep(0.05)
+        # the status burst powering up causes goes on for a while at 9600
+        # baud; clients connecting during it would get different lines
+        await wait_for_quiet([control])
+        control.writer.close()
+        reader.cancel()
+
+        for i in range(args.clients):
+            client = Client(i, args.request_ids)
+            await client.connect(sockpath, args.subscribe)
+            clients.append(client)
+        readers = [ asyncio.ensure_future(c.read()) for c in clients ]
+        # e.g. a status snapshot; only measure what all clients are sent
+        await wait_for_quiet(clients)
+        for c in clients:
+            c.arrivals = []
+            c.bytes = 0
+
+        cpu_start = proc_stats(daemon.pid)[0]
+        commands_start = emulator.commands
+        start = time.monotonic()
+        await asyncio.gather(*[ c.drive(args.rate, args.duration,
+            names, weights) for c in clients ])
+        # let the serial queue drain before we stop counting
+        settle = time.monotonic() + args.settle
+        while time.monotonic() < settle and any(c.waiting for c in clients):
+            await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - start
+        cpu_end, rss, hwm = proc_stats(daemon.pid)
+        commands = emulator.commands - commands_start
+
+        for r in readers:
+            r.cancel()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        emulator.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    latencies = [ l for c in clients for l in c.latencies ]
+    fanout = fanout_times(clients)
+    sent = sum(c.sent for c in clients)
+    acks = {}
+    for c in clients:
+        for event, count in c.acks.items():
+            acks[event] = acks.get(event, 0) + count
+
+    return {
+        'config': {
+            'clients': args.clients,
+            'rate': args.rate,
+            'duration': args.duration,
+            'mix': args.mix,
+            'latency_ms': args.latency,
+            'baud': args.baud,
+            'subscribe': args.subscribe,
+            'request_ids': args.request_ids,
+            'daemon': args.daemon,
+            'daemon_args': args.daemon_args,
+        },
+        'elapsed': elapsed,
+        'commands_sent': sent,
+        'commands_answered': len(latencies),
+        'commands_unanswered': sent - len(latencies),
+        'latency_ms': percentiles(latencies),
+        'acks': acks,
+        'serial': {
+            'commands': commands,
+            'commands_per_sec': commands / elapsed,
+            'replies': emulator.replies,
+        },
+        'broadcast': {
+            'lines': len(fanout),
+            'bytes': sum(c.bytes for c in clients),
+            'fanout_ms': percentiles(fanout),
+        },
+        'daemon': {
+            'cpu_seconds': cpu_end - cpu_start,
+            'cpu_percent': 100.0 * (cpu_end - cpu_start) / elapsed,
+            'rss_kb': rss,
+            'peak_rss_kb': hwm,
+        },
+    }
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+            description="Load test onkyocontrol against an emulated receiver.")
+    parser.add_argument('-n', '--clients', type=int, default=10,
+            help="number of client connections (default 10)")
+    parser.add_argument('-r', '--rate', type=float, default=1.0,
+            help="commands per second sent by each client (default 1)")
+    parser.add_argument('-t', '--duration', type=float, default=10.0,
+            help="seconds to send commands for (default 10)")
+    parser.add_argument('-m', '--mix', default=DEFAULT_MIX,
+            help="weighted workload mix (default %s)" % DEFAULT_MIX)
+    parser.add_argument('--settle', type=float, default=5.0,
+            help="max seconds to wait for outstanding answers (default 5)")
+    parser.add_argument('--latency', type=float, default=20.0, metavar='MS',
+            help="emulated receiver reply latency (default 20)")
+    parser.add_argument('--baud', type=int, default=9600,
+            help="emulated receiver baud rate (default 9600)")
+    parser.add_argument('--subscribe', metavar='PATTERNS',
+            help="key patterns every client subscribes to, e.g. 'zone2*'; "
+            "answers outside them count as unanswered")
+    parser.add_argument('--request-ids', action='store_true',
+            help="tag commands with request IDs and time them by the "
+            "daemon's acknowledgements")
+    parser.add_argument('--daemon', default=os.path.join(ROOT, "onkyocontrol"),
+            help="daemon binary to test (default ./onkyocontrol)")
+    parser.add_argument('-o', '--output', metavar='FILE',
+            help="write the JSON report here instead of stdout")
+    parser.add_argument('--seed', type=int, help="random seed")
+    parser.add_argument('daemon_args', nargs='*',
+            help="extra daemon arguments, after --")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.seed is not None:
+        random.seed(args.seed)
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
+
+# vim: set ts=4 sw=4 et:
@@ -0,0 +1,259 @@
+/*
+ *  lookup.c - command and status lookup microbenchmark
+ *
+ *  Copyright (c) 2026 the onkyocontrol authors
+ *
+ *  This program is free software; you can redistribute it and/or modify
+ *  it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation; either version 2 of the License, or
+ *  (at your option) any later version.
+ *
+ *  This program is distributed in the hope that it will be useful,
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ *  GNU General Public License for more details.
+ *
+ *  You should have received a copy of the GNU General Public License
+ *  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/*
+ * Measures how many receiver messages per second go through parse_status(),
+ * both on their own and framed from a stream like the serial device sends
+ * them, and how many user commands per second go through process_command(),
+ * both for a mix of commands, for a burst of distinct commands that all end
+ * up waiting in the receiver command queue at once, and for a volume sweep
+ * where each new value replaces the one still waiting. No sockets or serial
+ * devices are involved, the stream comes from a pipe; the onkyo.c functions
+ * the status and command code calls into are replaced by counting stubs
+ * below.
+ *
+ * Build with "make bench", run as "bench/lookup [rounds]".
+ */
+
+/* parse_status() is static, so pull in the whole file; this comes first
+ * so its feature test macros apply */
+#include "../receiver.c"
+
+#include <time.h>
+#include <unistd.h>
+
+const char * const rcvr_err = "ERROR:Receiver Error\n";
+
+static unsigned long writes = 0;
+
+int write_to_connection(UNUSED struct conn *c, UNUSED const char *msg)
+{
+	writes++;
+	return 0;
+}
+
+int write_to_connections(UNUSED const char *msg)
+{
+	writes++;
+	return 0;
+}
+
+/* the rest of the daemon side is not needed here */
+int conn_subscribe(UNUSED struct conn *c, UNUSED char *patterns)
+{
+	return 0;
+}
+
+int conn_unsubscribe(UNUSED struct conn *c, UNUSED char *patterns)
+{
+	return 0;
+}
+
+size_t conn_subscriptions(UNUSED const struct conn *c, char *buf,
+		UNUSED size_t size)
+{
+	buf[0] = '\0';
+	return 0;
+}
+
+struct request_tag *conn_request(UNUSED struct conn *c,
+		UNUSED struct request_tag *req)
+{
+	return NULL;
+}
+
+void request_ack(UNUSED const struct request_tag *req,
+		UNUSED const char *event, UNUSED const char *cmd)
+{
+}
+
+void write_stats(UNUSED struct conn *c)
+{
+}
+
+/* A power on burst plus some messages near the end of the status tables
+ * and a few that are not in them at all. */
+static const char * const messages[] = {
+	START_RECV "PWR01",
+	START_RECV "MVL28",
+	START_RECV "AMT00",
+	START_RECV "SLI24",
+	START_RECV "LMD00",
+	START_RECV "TUN09790",
+	START_RECV "PRS01",
+	START_RECV "SLP00",
+	START_RECV "DIM00",
+	START_RECV "ZPW01",
+	START_RECV "SL323",
+	START_RECV "LMD88",
+	START_RECV "TGCN/A",
+	START_RECV "IFAHDMI 1,PCM,48 kHz",
+	NULL,
+};
+
+static const char * const commands[] = {
+	"power",
+	"volume 40",
+	"mute off",
+	"input dvd",
+	"input sirius",
+	"mode stereo",
+	"mode neuralthx",
+	"tune 97.9",
+	"zone2power on",
+	"zone2input cd",
+	"zone3volume 20",
+	"sleep 30",
+	"nosuchcommand",
+	NULL,
+};
+
+/* distinct commands queued before the queue is emptied again */
+#define BURST_SIZE 200
+
+static double elapsed(struct timespec *start)
+{
+	struct timespec now;
+	clock_gettime(CLOCK_MONOTONIC, &now);
+	return (double)(now.tv_sec - start->tv_sec) +
+		(double)(now.tv_nsec - start->tv_nsec) / 1e9;
+}
+
+static void empty_queue(struct receiver *rcvr)
+{
+	/* only the queue wait statistics care about the time */
+	static struct timeval now;
+
+	while(queue_pop(&rcvr->queue, &now))
+		;
+}
+
+int main(int argc, char *argv[])
+{
+	unsigned long rounds = 200000, i, j, count;
+	const char * const *ptr;
+	struct receiver *rcvr;
+	struct timespec start;
+	double secs;
+	char stream[RCVR_BUF_SIZE];
+	size_t stream_len;
+	int fds[2];
+
+	if(argc > 1)
+		rounds = strtoul(argv[1], NULL, 10);
+
+	init_commands();
+	init_statuses();
+	rcvr = calloc(1, sizeof(struct receiver));
+	if(!rcvr)
+		return EXIT_FAILURE;
+	rcvr->fd = -1;
+
+	count = 0;
+	clock_gettime(CLOCK_MONOTONIC, &start);
+	for(i = 0; i < rounds; i++) {
+		for(ptr = messages; *ptr; ptr++) {
+			/* parse_status() modifies the message in place */
+			char buf[BUF_SIZE];
+			size_t len = strlen(*ptr);
+			memcpy(buf, *ptr, len + 1);
+			parse_status(rcvr, len, buf);
+			count++;
+		}
+	}
+	secs = elapsed(&start);
+	printf("parse_status:    %10.0f msgs/sec (%lu msgs, %lu writes)\n",
+			count / secs, count, writes);
+
+	/* all messages back to back, as in a power on burst; this fits in one
+	 * read of the receiver input buffer */
+	stream_len = 0;
+	for(ptr = messages; *ptr; ptr++) {
+		stream_len += (size_t)sprintf(stream + stream_len, "%s%s", *ptr,
+				(ptr - messages) % 2 ? END_RECV : END_RECV "\r\n");
+	}
+	if(pipe(fds) == -1)
+		return EXIT_FAILURE;
+	rcvr->fd = fds[0];
+	count = rcvr->msgs_received;
+	clock_gettime(CLOCK_MONOTONIC, &start);
+	for(i = 0; i < rounds; i++) {
+		if(write(fds[1], stream, stream_len) != (ssize_t)stream_len)
+			return EXIT_FAILURE;
+		process_incoming_message(rcvr);
+	}
+	secs = elapsed(&start);
+	count = rcvr->msgs_received - count;
+	printf("serial stream:   %10.0f msgs/sec (%lu msgs, %zu bytes per read)\n",
+			count / secs, count, stream_len);
+	close(fds[0]);
+	close(fds[1]);
+	rcvr->fd = -1;
+
+	count = 0;
+	clock_gettime(CLOCK_MONOTONIC, &start);
+	for(i = 0; i < rounds; i++) {
+		for(ptr = commands; *ptr; ptr++) {
+			process_command(rcvr, NULL, *ptr);
+			empty_queue(rcvr);
+			count++;
+		}
+	}
+	secs = elapsed(&start);
+	printf("process_command: %10.0f cmds/sec (%lu cmds)\n", count / secs, count);
+
+	count = 0;
+	clock_gettime(CLOCK_MONOTONIC, &start);
+	for(i = 0; i < rounds / 100; i++) {
+		for(j = 0; j < BURST_SIZE; j++) {
+			char cmd[BUF_SIZE];
+			snprintf(cmd, BUF_SIZE, "raw MVL%02lX", j);
+			process_command(rcvr, NULL, cmd);
+			count++;
+		}
+		empty_queue(rcvr);
+	}
+	secs = elapsed(&start);
+	printf("queue burst:     %10.0f cmds/sec (%lu cmds, %d per burst)\n",
+			count / secs, count, BURST_SIZE);
+
+	count = 0;
+	rcvr->queue.superseded = 0;
+	clock_gettime(CLOCK_MONOTONIC, &start);
+	for(i = 0; i < rounds / 100; i++) {
+		for(j = 0; j < BURST_SIZE; j++) {
+			char cmd[BUF_SIZE];
+			snprintf(cmd, BUF_SIZE, "volume %lu", j % 101);
+			process_command(rcvr, NULL, cmd);
+			count++;
+		}
+		if(i == 0)
+			printf("volume sweep:    %d commands queued as %zu\n",
+					BURST_SIZE, rcvr->queue.len);
+		empty_queue(rcvr);
+	}
+	secs = elapsed(&start);
+	printf("volume sweep:    %10.0f cmds/sec (%lu cmds, %lu superseded)\n",
+			count / secs, count, rcvr->queue.superseded);
+
+	free(rcvr);
+	return EXIT_SUCCESS;
+}
+
+/* vim: set ts=4 sw=4 noet: */
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+A/B benchmark of the daemon's receiver command pacing modes.
+
+For every emulated receiver reply latency given, the daemon is started once
+with fixed pacing (a command every 80 ms) and once with adaptive pacing (the
+next command as soon as the previous one is answered). Each run measures:
+
+ - burst: a client queues a number of distinct volume changes at once; how
+   long until the answer to every one of them has come back
+ - closed loop: a client sends one volume change at a time and waits for
+   its answer before sending the next, like a slider being dragged
+
+With --net, the emulated receiver is a network receiver the daemon talks
+eISCP to, instead of one on a serial line.
+
+The JSON report has one entry per mode and latency, plus the adaptive over
+fixed speedup for each latency.
+
+Usage: bench/pacing.py [options], see --help.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from loadtest import ROOT, Client, percentiles, wait_for_socket
+from emulator import Emulator, NetEmulator, ReceiverState
+
+MODES = ('fixed', 'adaptive')
+
+async def wait_answered(client, timeout):
+    end = time.monotonic() + timeout
+    while client.pending and time.monotonic() < end:
+        await asyncio.sleep(0.001)
+
+async def run_one(args, mode, latency):
+    tmpdir = tempfile.mkdtemp(prefix="onkyo-bench-")
+    sockpath = os.path.join(tmpdir, "onkyo.sock")
+
+    if args.net:
+        emulator = NetEmulator(ReceiverState(), latency=latency / 1000.0)
+        option = "-n"
+    else:
+        emulator = Emulator(ReceiverState(), latency=latency / 1000.0,
+                baud=args.baud)
+        option = "-s"
+    device = emulator.open()
+    await emulator.start()
+
+    daemon = subprocess.Popen([args.daemon, option, device, "-u", sockpath,
+            "-p", mode] + args.daemon_args, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+    try:
+        await wait_for_socket(sockpath, daemon)
+        client = Client(0)
+        await client.connect(sockpath)
+        reader = asyncio.ensure_future(client.read())
+        client.send("power on", "OK:power:on", True)
+        await wait_answered(client, args.settle)
+        await asyncio.sleep(0.5)
+
+        # raw commands are queued as they are, so none of them replaces
+        # another one still waiting to be sent
+        commands_start = emulator.commands
+        start = time.monotonic()
+        for value in range(args.burst):
+            client.send("raw MVL%02X" % value, "OK:volume:%d" % value, True)
+        await wait_answered(client, args.settle)
+        burst_time = time.monotonic() - start
+        burst_answered = args.burst - len(client.pending)
+        burst_commands = emulator.commands - commands_start
+        client.pending = []
+        client.latencies = []
+        await asyncio.sleep(0.5)
+
+        start = time.monotonic()
+        for i in range(args.steps):
+            value = 20 + i % 40
+            client.send("volume %d" % value, "OK:volume:%d" % value, True)
+            await wait_answered(client, args.settle)
+        loop_time = time.monotonic() - start
+        loop_latencies = client.latencies
+
+        reader.cancel()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        emulator.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {
+        'mode': mode,
+        'latency_ms': latency,
+        'burst': {
+            'commands': args.burst,
+            'answered': burst_answered,
+            'serial_commands': burst_commands,
+            'seconds': burst_time,
+            'commands_per_sec': burst_answered / burst_time,
+        },
+        'closed_loop': {
+            'commands': args.steps,
+            'seconds': loop_time,
+            'commands_per_sec': len(loop_latencies) / loop_time,
+            'latency_ms': percentiles(loop_latencies),
+        },
+    }
+
+async def run(args):
+    runs = []
+    for latency in args.latency:
+        for mode in MODES:
+            runs.append(await run_one(args, mode, latency))
+
+    speedup = []
+    for latency in args.latency:
+        fixed, adaptive = [ [ r for r in runs if r['mode'] == mode and
+                r['latency_ms'] == latency ][0] for mode in MODES ]
+        speedup.append({
+            'latency_ms': latency,
+            'burst': adaptive['burst']['commands_per_sec'] /
+                fixed['burst']['commands_per_sec'],
+            'closed_loop': adaptive['closed_loop']['commands_per_sec'] /
+                fixed['closed_loop']['commands_per_sec'],
+        })
+
+    return {
+        'config': {
+            'burst': args.burst,
+            'steps': args.steps,
+            'baud': None if args.net else args.baud,
+            'net': args.net,
+            'daemon': args.daemon,
+            'daemon_args': args.daemon_args,
+        },
+        'runs': runs,
+        'speedup': speedup,
+    }
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+            description="Compare fixed and adaptive command pacing against "
+            "an emulated receiver.")
+    parser.add_argument('--latency', default="5,20,50", metavar='MS[,MS...]',
+            help="emulated receiver reply latencies (default 5,20,50)")
+    parser.add_argument('--burst', type=int, default=100,
+            help="volume changes queued at once, at most 101 (default 100)")
+    parser.add_argument('--steps', type=int, default=40,
+            help="volume changes sent one at a time (default 40)")
+    parser.add_argument('--settle', type=float, default=30.0,
+            help="max seconds to wait for outstanding answers (default 30)")
+    parser.add_argument('--baud', type=int, default=9600,
+            help="emulated receiver baud rate (default 9600)")
+    parser.add_argument('--net', action='store_true',
+            help="emulate a network (eISCP) receiver instead of a serial "
+            "one")
+    parser.add_argument('--daemon', default=os.path.join(ROOT, "onkyocontrol"),
+            help="daemon binary to test (default ./onkyocontrol)")
+    parser.add_argument('-o', '--output', metavar='FILE',
+            help="write the JSON report here instead of stdout")
+    parser.add_argument('daemon_args', nargs='*',
+            help="extra daemon arguments, after --")
+    args = parser.parse_args(argv)
+    args.latency = [ float(l) for l in args.latency.split(",") ]
+    if not 0 < args.burst <= 101:
+        parser.error("--burst must be between 1 and 101")
+    return args
+
+def main():
+    args = parse_args(sys.argv[1:])
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
+
+# vim: set ts=4 sw=4 et:
@@ -0,0 +1,561 @@
+/*
+ *  capture.c - timestamped capture of raw receiver traffic
+ *
+ *  Copyright (c) 2026 the onkyocontrol authors
+ *
+ *  This program is free software; you can redistribute it and/or modify
+ *  it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation; either version 2 of the License, or
+ *  (at your option) any later version.
+ *
+ *  This program is distributed in the hope that it will be useful,
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ *  GNU General Public License for more details.
+ *
+ *  You should have received a copy of the GNU General Public License
+ *  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/*
+ * A capture file starts with a header:
+ *
+ *   8 bytes  "ONKYOCAP"
+ *   be32     format version, 1
+ *   be32     header size, 32
+ *   be32 x2  wall clock time the file was opened, seconds and nanoseconds
+ *   be32 x2  monotonic clock time at the same moment
+ *
+ * followed by one record for every read from and write to a receiver:
+ *
+ *   be32     payload length
+ *   be32 x2  monotonic clock time, seconds and nanoseconds
+ *   byte     direction, 'r' for received or 't' for transmitted
+ *   byte     receiver number, in the order they were given
+ *   byte     receiver type, 's' for serial or 'n' for network
+ *   byte     reserved, 0
+ *   payload  the bytes exactly as read or written, eISCP headers included
+ *
+ * All numbers are big endian. The wall clock time of a record is the one in
+ * the file header plus how far its monotonic time is past the header's.
+ */
+
+#define _GNU_SOURCE 1 /* O_CLOEXEC */
+
+#include <limits.h>
+#include <pthread.h>
+#include <signal.h>
+#include <stdarg.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <errno.h>
+#include <time.h>
+
+#include "onkyo.h"
+
+#define CAPTURE_MAGIC "ONKYOCAP"
+#define CAPTURE_VERSION 1
+#define CAPTURE_HEADER_SIZE 32
+#define CAPTURE_RECORD_SIZE 16
+
+/** Longest problem report the writer thread leaves for the event loop */
+#define CAPTURE_ERROR_SIZE 256
+
+static const char * const sync_names[] = {
+	"none", "rotate", "flush",
+};
+
+/*
+ * The event loop collects records in one buffer while a writer thread
+ * writes the other one out, so neither a slow disk nor a sync ever holds up
+ * the loop. If the writer is still busy once the loop's buffer is full,
+ * further records are lost rather than waited for. cap_lock guards what is
+ * marked shared; the file itself belongs to the writer.
+ */
+static pthread_mutex_t cap_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t cap_wake = PTHREAD_COND_INITIALIZER;
+static pthread_t cap_thread;
+static int cap_thread_running = 0;
+/** (shared) tells the writer to exit once it has nothing left to write */
+static int cap_stop = 0;
+
+/** absolute path of the capture file, so rotating still works after the
+ * daemon changed to another directory */
+static char *cap_path = NULL;
+/** whether records are collected; off once the file is gone for good */
+static int cap_on = 0;
+/** (shared) the capture file, -1 once a new one could not be created */
+static int cap_fd = -1;
+/** size at which the file is rotated, 0 to never rotate it */
+static size_t cap_rotate = 0;
+static enum capture_sync cap_sync = SYNC_ROTATE;
+/** (shared) bytes written to the current file */
+static size_t cap_size = 0;
+
+/** Records waiting to be handed to the writer; capture_flush() does so once
+ * the oldest has waited long enough or the buffer is half full. */
+static unsigned char cap_bufs[2][CAPTURE_BUF_SIZE];
+static unsigned char *cap_buf = cap_bufs[0];
+static size_t cap_len = 0;
+/** when the oldest record waiting was made */
+static struct timespec cap_oldest;
+/** (shared) records the writer is busy with, none while it is idle */
+static unsigned char *cap_out = NULL;
+static size_t cap_out_len = 0;
+
+static unsigned long cap_records = 0;
+/** (shared) */
+static unsigned long cap_rotations = 0;
+/** (shared) bytes of records that never made it into the file */
+static unsigned long long cap_lost = 0;
+/** (shared) the first problem met since the event loop last looked */
+static char cap_error[CAPTURE_ERROR_SIZE];
+static enum log_level cap_error_level;
+
+static void put_be32(unsigned char *p, unsigned long val)
+{
+	p[0] = (unsigned char)(val >> 24);
+	p[1] = (unsigned char)(val >> 16);
+	p[2] = (unsigned char)(val >> 8);
+	p[3] = (unsigned char)val;
+}
+
+/**
+ * Note a problem for the event loop to log; log_msg() is not safe to call
+ * from the writer thread. Only the first problem is kept until then.
+ * @param level the log level to log it at
+ * @param fmt printf style format of the message
+ */
+static void capture_error(enum log_level level, const char *fmt, ...)
+	PRINTF_LIKE(2, 3);
+static void capture_error(enum log_level level, const char *fmt, ...)
+{
+	va_list args;
+
+	pthread_mutex_lock(&cap_lock);
+	if(!cap_error[0]) {
+		va_start(args, fmt);
+		vsnprintf(cap_error, sizeof(cap_error), fmt, args);
+		va_end(args);
+		cap_error_level = level;
+	}
+	pthread_mutex_unlock(&cap_lock);
+}
+
+/**
+ * Log what the writer ran into, and stop collecting records once there is
+ * no capture file to write them to any more.
+ */
+static void capture_check(void)
+{
+	char msg[CAPTURE_ERROR_SIZE];
+	enum log_level level;
+	int gone;
+
+	pthread_mutex_lock(&cap_lock);
+	strcpy(msg, cap_error);
+	level = cap_error_level;
+	cap_error[0] = '\0';
+	gone = cap_fd < 0;
+	if(gone && cap_on) {
+		cap_lost += cap_len;
+		cap_len = 0;
+	}
+	pthread_mutex_unlock(&cap_lock);
+
+	if(msg[0])
+		log_msg(level, "%s", msg);
+	if(gone)
+		cap_on = 0;
+}
+
+/**
+ * Look up a sync policy by name.
+ * @param name the policy name, e.g. "flush"
+ * @return the policy, -1 if there is no policy of that name
+ */
+int capture_parse_sync(const char *name)
+{
+	int i;
+	for(i = SYNC_NONE; i <= SYNC_FLUSH; i++) {
+		if(strcmp(name, sync_names[i]) == 0)
+			return i;
+	}
+	return -1;
+}
+
+/**
+ * Create the capture file, replacing anything of the same name, and write
+ * its header.
+ * @return 0 on success, -1 on failure (errno is set)
+ */
+static int capture_create(void)
+{
+	unsigned char hdr[CAPTURE_HEADER_SIZE];
+	struct timespec real, mono;
+	ssize_t n;
+	int fd;
+
+	fd = open(cap_path, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC,
+			S_IRUSR | S_IWUSR | S_IRGRP | S_IROTH);
+	if(fd == -1)
+		return -1;
+
+	clock_gettime(CLOCK_REALTIME, &real);
+	clock_gettime(CLOCK_MONOTONIC, &mono);
+	memcpy(hdr, CAPTURE_MAGIC, 8);
+	put_be32(hdr + 8, CAPTURE_VERSION);
+	put_be32(hdr + 12, CAPTURE_HEADER_SIZE);
+	put_be32(hdr + 16, (unsigned long)real.tv_sec);
+	put_be32(hdr + 20, (unsigned long)real.tv_nsec);
+	put_be32(hdr + 24, (unsigned long)mono.tv_sec);
+	put_be32(hdr + 28, (unsigned long)mono.tv_nsec);
+	n = xwrite(fd, hdr, CAPTURE_HEADER_SIZE);
+	if(n != CAPTURE_HEADER_SIZE) {
+		int err = n < 0 ? errno : ENOSPC;
+		close(fd);
+		errno = err;
+		return -1;
+	}
+	pthread_mutex_lock(&cap_lock);
+	cap_fd = fd;
+	cap_size = CAPTURE_HEADER_SIZE;
+	pthread_mutex_unlock(&cap_lock);
+	return 0;
+}
+
+/**
+ * Move the capture file out of the way as path.1, shifting older ones up
+ * to path.CAPTURE_KEEP and dropping the oldest.
+ */
+static void capture_shift(void)
+{
+	char from[PATH_MAX + 16], to[PATH_MAX + 16];
+	size_t len = sizeof(from);
+	int i;
+
+	for(i = CAPTURE_KEEP; i > 1; i--) {
+		snprintf(from, len, "%s.%d", cap_path, i - 1);
+		snprintf(to, len, "%s.%d", cap_path, i);
+		if(rename(from, to) == -1 && errno != ENOENT)
+			capture_error(LEVEL_WARN, "capture rotate %s: %s",
+					from, strerror(errno));
+	}
+	snprintf(to, len, "%s.1", cap_path);
+	if(rename(cap_path, to) == -1 && errno != ENOENT)
+		capture_error(LEVEL_WARN, "capture rotate %s: %s",
+				cap_path, strerror(errno));
+}
+
+/**
+ * Close the full capture file and start a new one. If the new one cannot
+ * be created, capturing stops.
+ */
+static void capture_rotate(void)
+{
+	int fd = cap_fd;
+
+	if(cap_sync != SYNC_NONE)
+		fdatasync(fd);
+	pthread_mutex_lock(&cap_lock);
+	cap_fd = -1;
+	pthread_mutex_unlock(&cap_lock);
+	close(fd);
+	capture_shift();
+	if(capture_create() == -1) {
+		capture_error(LEVEL_ERROR, "capture %s: %s, capture stopped",
+				cap_path, strerror(errno));
+		return;
+	}
+	pthread_mutex_lock(&cap_lock);
+	cap_rotations++;
+	pthread_mutex_unlock(&cap_lock);
+}
+
+/**
+ * Start capturing receiver traffic to a file. An existing file of the same
+ * name is replaced, or rotated away first if rotation is on.
+ * @param path the file to capture to
+ * @param rotate size (in bytes) after which to rotate the file, 0 never
+ * @param sync when to sync the file to disk
+ * @return 0 on success, -1 if the file could not be created
+ */
+int capture_open(const char *path, size_t rotate, enum capture_sync sync)
+{
+	struct stat st;
+
+	capture_close();
+	if(path[0] == '/') {
+		cap_path = strdup(path);
+	} else {
+		char cwd[PATH_MAX];
+		if(!getcwd(cwd, sizeof(cwd))) {
+			perror("getcwd()");
+			return -1;
+		}
+		cap_path = malloc(strlen(cwd) + strlen(path) + 2);
+		if(cap_path)
+			sprintf(cap_path, "%s/%s", cwd, path);
+	}
+	if(!cap_path) {
+		perror("malloc()");
+		return -1;
+	}
+	cap_rotate = rotate;
+	cap_sync = sync;
+
+	/* keep what an earlier run captured if we keep old captures anyway */
+	if(rotate && stat(cap_path, &st) == 0 && st.st_size > 0)
+		capture_shift();
+	if(capture_create() == -1) {
+		perror(path);
+		free(cap_path);
+		cap_path = NULL;
+		return -1;
+	}
+	cap_on = 1;
+	return 0;
+}
+
+/**
+ * Write records to the capture file, then sync or rotate it as needed.
+ * This runs in the writer thread, or once it is gone, when closing.
+ * @param buf the records
+ * @param len the length of the records
+ */
+static void capture_write(const unsigned char *buf, size_t len)
+{
+	size_t done = 0;
+
+	while(cap_fd > -1 && done < len) {
+		ssize_t n = xwrite(cap_fd, buf + done, len - done);
+		if(n <= 0) {
+			capture_error(LEVEL_ERROR, "capture write: %s",
+					n < 0 ? strerror(errno) : "no space");
+			break;
+		}
+		done += (size_t)n;
+	}
+	pthread_mutex_lock(&cap_lock);
+	cap_size += done;
+	cap_lost += len - done;
+	pthread_mutex_unlock(&cap_lock);
+
+	if(cap_fd < 0)
+		return;
+	if(cap_sync == SYNC_FLUSH)
+		fdatasync(cap_fd);
+	if(cap_rotate && cap_size >= cap_rotate)
+		capture_rotate();
+}
+
+/**
+ * The writer thread: write out every batch of records handed to it until
+ * told to stop.
+ */
+static void *capture_writer(UNUSED void *arg)
+{
+	pthread_mutex_lock(&cap_lock);
+	for(;;) {
+		const unsigned char *buf = cap_out;
+		size_t len = cap_out_len;
+
+		if(!len) {
+			if(cap_stop)
+				break;
+			pthread_cond_wait(&cap_wake, &cap_lock);
+			continue;
+		}
+		pthread_mutex_unlock(&cap_lock);
+		capture_write(buf, len);
+		pthread_mutex_lock(&cap_lock);
+		cap_out_len = 0;
+	}
+	pthread_mutex_unlock(&cap_lock);
+	return NULL;
+}
+
+/**
+ * Hand the waiting records to the writer thread, unless it is still busy
+ * with the last batch. The thread is only started with the first batch, as
+ * daemonize() forks after capture_open() and threads do not survive that.
+ * @return 1 if the records were handed over, 0 if the writer was busy
+ */
+static int capture_handoff(void)
+{
+	int handed = 0;
+
+	if(!cap_thread_running) {
+		sigset_t all, old;
+		int err;
+
+		/* signals are for the event loop */
+		sigfillset(&all);
+		pthread_sigmask(SIG_SETMASK, &all, &old);
+		err = pthread_create(&cap_thread, NULL, capture_writer, NULL);
+		pthread_sigmask(SIG_SETMASK, &old, NULL);
+		if(err) {
+			log_msg(LEVEL_ERROR, "capture thread: %s, capture stopped",
+					strerror(err));
+			pthread_mutex_lock(&cap_lock);
+			cap_lost += cap_len;
+			pthread_mutex_unlock(&cap_lock);
+			cap_len = 0;
+			cap_on = 0;
+			return 0;
+		}
+		cap_thread_running = 1;
+	}
+
+	pthread_mutex_lock(&cap_lock);
+	if(!cap_out_len) {
+		cap_out = cap_buf;
+		cap_out_len = cap_len;
+		cap_buf = cap_buf == cap_bufs[0] ? cap_bufs[1] : cap_bufs[0];
+		cap_len = 0;
+		pthread_cond_signal(&cap_wake);
+		handed = 1;
+	}
+	pthread_mutex_unlock(&cap_lock);
+	return handed;
+}
+
+/**
+ * Write out the waiting records and stop capturing. Unlike everything else
+ * here this waits for the disk, which is fine when shutting down.
+ */
+void capture_close(void)
+{
+	if(cap_thread_running) {
+		pthread_mutex_lock(&cap_lock);
+		cap_stop = 1;
+		pthread_cond_signal(&cap_wake);
+		pthread_mutex_unlock(&cap_lock);
+		pthread_join(cap_thread, NULL);
+		cap_thread_running = 0;
+		cap_stop = 0;
+	}
+	/* with the writer gone, the rest can be written out right here */
+	if(cap_on && cap_len)
+		capture_write(cap_buf, cap_len);
+	cap_len = 0;
+	if(cap_path)
+		capture_check();
+	if(cap_fd > -1) {
+		if(cap_sync != SYNC_NONE)
+			fdatasync(cap_fd);
+		close(cap_fd);
+		cap_fd = -1;
+	}
+	free(cap_path);
+	cap_path = NULL;
+	cap_on = 0;
+}
+
+/**
+ * Capture data read from or written to a receiver. The record is only
+ * buffered here; capture_flush() hands it to the writer thread. If the
+ * buffer is full and the writer still busy, the record is lost.
+ * @param dir whether the data was read or written
+ * @param rcvr the receiver the data came from or went to
+ * @param data the data, exactly as it was read or written
+ * @param len the length of the data
+ */
+void capture_record(enum capture_dir dir, const struct receiver *rcvr,
+		const char *data, size_t len)
+{
+	struct timespec now;
+	unsigned char *p;
+
+	if(!cap_on)
+		return;
+	if(CAPTURE_BUF_SIZE - cap_len < CAPTURE_RECORD_SIZE + len &&
+			(!capture_handoff() ||
+			 CAPTURE_BUF_SIZE - cap_len < CAPTURE_RECORD_SIZE + len)) {
+		/* never wait for the disk in the event loop */
+		pthread_mutex_lock(&cap_lock);
+		cap_lost += CAPTURE_RECORD_SIZE + len;
+		pthread_mutex_unlock(&cap_lock);
+		return;
+	}
+
+	clock_gettime(CLOCK_MONOTONIC, &now);
+	if(!cap_len)
+		cap_oldest = now;
+	p = cap_buf + cap_len;
+	put_be32(p, (unsigned long)len);
+	put_be32(p + 4, (unsigned long)now.tv_sec);
+	put_be32(p + 8, (unsigned long)now.tv_nsec);
+	p[12] = (unsigned char)dir;
+	p[13] = (unsigned char)rcvr->id;
+	p[14] = rcvr->type == RCVR_NET ? 'n' : 's';
+	p[15] = 0;
+	memcpy(p + CAPTURE_RECORD_SIZE, data, len);
+	cap_len += CAPTURE_RECORD_SIZE + len;
+	cap_records++;
+}
+
+/**
+ * Hand the waiting records to the writer thread if the oldest of them has
+ * waited for CAPTURE_FLUSH ms or the buffer is filling up, and log anything
+ * the writer ran into. This is called from the event loop, so records are
+ * written in batches rather than one at a time.
+ * @return the time (in milliseconds) until records are due to be handed
+ * over, -1 if none are waiting
+ */
+int capture_flush(void)
+{
+	struct timespec now;
+	long waited;
+
+	if(!cap_path)
+		return -1;
+	capture_check();
+	if(!cap_len)
+		return -1;
+	if(cap_len < CAPTURE_BUF_SIZE / 2) {
+		clock_gettime(CLOCK_MONOTONIC, &now);
+		waited = (long)(now.tv_sec - cap_oldest.tv_sec) * 1000 +
+			(now.tv_nsec - cap_oldest.tv_nsec) / 1000000;
+		if(waited < CAPTURE_FLUSH)
+			return (int)(CAPTURE_FLUSH - waited);
+	}
+	if(!capture_handoff())
+		return cap_on ? CAPTURE_RETRY : -1;
+	return -1;
+}
+
+/**
+ * Print where receiver traffic is captured to, for the SIGUSR1 status.
+ */
+void capture_show_status(void)
+{
+	int fd;
+	size_t size, waiting;
+	unsigned long rotations;
+	unsigned long long lost;
+
+	if(!cap_path) {
+		printf("capture file  : none\n");
+		return;
+	}
+	pthread_mutex_lock(&cap_lock);
+	fd = cap_fd;
+	size = cap_size;
+	waiting = cap_len + cap_out_len;
+	rotations = cap_rotations;
+	lost = cap_lost;
+	pthread_mutex_unlock(&cap_lock);
+
+	printf("capture file  : %s (%d, sync %s)\n", cap_path, fd,
+			sync_names[cap_sync]);
+	printf("capture       : %lu records, %zu bytes in file, %zu waiting, "
+			"%lu rotations, %llu bytes lost\n", cap_records, size,
+			waiting, rotations, lost);
+}
+
+/* vim: set ts=4 sw=4 noet: */
@@ -30,11 +30,11 @@
 /* forward-declared because of the circular reference */
 struct command;
 
-typedef int (cmd_handler) (struct receiver *, const struct command *, char *);
+typedef int (cmd_handler) (struct receiver *, struct conn *,
+		const struct command *, char *);
 
 /** A specific command and associated handler function */
 struct command {
-	unsigned long hash;
 	const char *name;
 	const char *prefix;
 	cmd_handler *handler;
@@ -42,11 +42,17 @@ struct command {
 
 /** A text to value mapping of code values, such as for inputs or modes */
 struct code_map {
-	unsigned long hash;
 	const char *key;
 	const char *value;
 };
 
+/** Indexes of command_list, conn_command_list, inputs and modes, built by
+ * init_commands() */
+static struct hash_index command_index;
+static struct hash_index conn_command_index;
+static struct hash_index input_index;
+static struct hash_index mode_index;
+
 /**
  * Convert a string, in place, to uppercase.
  * @param str string to convert (in place)
@@ -65,56 +71,33 @@ static void strtoupper(char *str)
  * is available for writing. Queueing and sending asynchronously allows
  * the program to backlog many commands at once without blocking on the
  * potentially slow receiver device. When queueing, we check if this command
- * is already in the queue- if so, we do not queue it again.
+ * is already in the queue- if so, we do not queue it again. A new value for
+ * a setting replaces an older value that was not sent yet.
  * @param rcvr the receiver the command should be queued for
+ * @param c the connection the command came from, NULL if none; it is told
+ * what becomes of the command if it gave the command line a request ID
  * @param cmd the command struct for the first part of the receiver command
  * string, usually containing a prefix aka "PWR"
  * @param arg the second part of the receiver command string, aka "QSTN"
- * @return 0 on success, -1 on missing args
+ * @return 0 on success, -1 on missing args, -3 on a full queue
  */
-static int cmd_attempt(struct receiver *rcvr,
+static int cmd_attempt(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, const char *arg)
 {
-	struct cmdqueue *q;
+	struct request_tag req;
 
 	if(!cmd || !arg)
 		return -1;
-	if(strlen(cmd->prefix) + strlen(arg) >= BUF_SIZE)
-		return -1;
-
-	q = malloc(sizeof(struct cmdqueue));
-	if(!q)
-		return -1;
-
-	sprintf(q->cmd, "%s%s", cmd->prefix, arg);
-	q->hash = hash_sdbm(q->cmd);
-	q->next = NULL;
-
-	if(rcvr->queue == NULL) {
-		rcvr->queue = q;
-	} else {
-		struct cmdqueue *ptr = rcvr->queue;
-		for(;;) {
-			if(ptr->hash == q->hash) {
-				/* command already in our queue, skip second copy */
-				free(q);
-				return 0;
-			}
-			if(!ptr->next)
-				break;
-			ptr = ptr->next;
-		}
-		ptr->next = q;
-	}
-	return 0;
+	return rcvr_queue_command(rcvr, cmd->prefix, arg,
+			conn_request(c, &req));
 }
 
-static int cmd_attempt_raw(struct receiver *rcvr,
+static int cmd_attempt_raw(struct receiver *rcvr, struct conn *c,
 		const char *prefix, const char *arg)
 {
-	struct command c;
-	c.prefix = prefix;
-	return cmd_attempt(rcvr, &c, arg);
+	struct command cmd;
+	cmd.prefix = prefix;
+	return cmd_attempt(rcvr, c, &cmd, arg);
 }
 
 /**
@@ -125,40 +108,40 @@ static int cmd_attempt_raw(struct receiver *rcvr,
  * @return the return value of cmd_attempt() if we found a standard operation,
  * else -2
  */
-static int handle_standard(struct receiver *rcvr,
+static int handle_standard(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	if(!arg || strcmp(arg, "status") == 0)
-		return cmd_attempt(rcvr, cmd, "QSTN");
+		return cmd_attempt(rcvr, c, cmd, "QSTN");
 	else if(strcmp(arg, "up") == 0)
-		return cmd_attempt(rcvr, cmd, "UP");
+		return cmd_attempt(rcvr, c, cmd, "UP");
 	else if(strcmp(arg, "down") == 0)
-		return cmd_attempt(rcvr, cmd, "DOWN");
+		return cmd_attempt(rcvr, c, cmd, "DOWN");
 	return -2;
 }
 
-static int handle_boolean(struct receiver *rcvr,
+static int handle_boolean(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	if(!arg || strcmp(arg, "status") == 0)
-		return cmd_attempt(rcvr, cmd, "QSTN");
+		return cmd_attempt(rcvr, c, cmd, "QSTN");
 	else if(strcmp(arg, "on") == 0)
-		return cmd_attempt(rcvr, cmd, "01");
+		return cmd_attempt(rcvr, c, cmd, "01");
 	else if(strcmp(arg, "off") == 0)
-		return cmd_attempt(rcvr, cmd, "00");
+		return cmd_attempt(rcvr, c, cmd, "00");
 	else if(strcmp(arg, "toggle") == 0) {
 		const char *prefix = cmd->prefix;
 		/* toggle is applicable for mute, not for power */
 		if(strcmp(prefix, "AMT") == 0 || strcmp(prefix, "ZMT") == 0
 				|| strcmp(prefix, "MT3") == 0)
-			return cmd_attempt(rcvr, cmd, "TG");
+			return cmd_attempt(rcvr, c, cmd, "TG");
 	}
 
 	/* unrecognized command */
 	return -1;
 }
 
-static int handle_ranged(struct receiver *rcvr,
+static int handle_ranged(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg,
 		int lower, int upper, int offset, const char *fmt)
 {
@@ -167,7 +150,7 @@ static int handle_ranged(struct receiver *rcvr,
 	char *test;
 	char cmdstr[3]; /* "XX\0" */
 
-	ret = handle_standard(rcvr, cmd, arg);
+	ret = handle_standard(rcvr, c, cmd, arg);
 	if(ret != -2)
 		return ret;
 
@@ -185,35 +168,35 @@ static int handle_ranged(struct receiver *rcvr,
 	/* create our command */
 	sprintf(cmdstr, fmt, (unsigned long)level);
 	/* send the command */
-	return cmd_attempt(rcvr, cmd, cmdstr);
+	return cmd_attempt(rcvr, c, cmd, cmdstr);
 }
 
-static int handle_volume(struct receiver *rcvr,
+static int handle_volume(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
-	return handle_ranged(rcvr, cmd, arg, 0, 100, 0, "%02lX");
+	return handle_ranged(rcvr, c, cmd, arg, 0, 100, 0, "%02lX");
 }
 
-static int handle_dbvolume(struct receiver *rcvr,
+static int handle_dbvolume(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
-	return handle_ranged(rcvr, cmd, arg, -82, 18, 82, "%02lX");
+	return handle_ranged(rcvr, c, cmd, arg, -82, 18, 82, "%02lX");
 }
 
-static int handle_preset(struct receiver *rcvr,
+static int handle_preset(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
-	return handle_ranged(rcvr, cmd, arg, 0, 40, 0, "%02lX");
+	return handle_ranged(rcvr, c, cmd, arg, 0, 40, 0, "%02lX");
 }
 
-static int handle_avsync(struct receiver *rcvr,
+static int handle_avsync(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	/* the extra '0' is an easy way to not have to multiply by 10 */
-	return handle_ranged(rcvr, cmd, arg, 0, 250, 0, "%03ld0");
+	return handle_ranged(rcvr, c, cmd, arg, 0, 250, 0, "%03ld0");
 }
 
-static int handle_swlevel(struct receiver *rcvr,
+static int handle_swlevel(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	int ret;
@@ -221,7 +204,7 @@ static int handle_swlevel(struct receiver *rcvr,
 	char *test;
 	char cmdstr[3]; /* "XX\0" */
 
-	ret = handle_standard(rcvr, cmd, arg);
+	ret = handle_standard(rcvr, c, cmd, arg);
 	if(ret != -2)
 		return ret;
 
@@ -244,47 +227,46 @@ static int handle_swlevel(struct receiver *rcvr,
 		sprintf(cmdstr, "-%1lX", (unsigned long)-level);
 	}
 	/* send the command */
-	return cmd_attempt(rcvr, cmd, cmdstr);
+	return cmd_attempt(rcvr, c, cmd, cmdstr);
 }
 
 static struct code_map inputs[] = {
-	{ 0, "DVR",       "00" },
-	{ 0, "VCR",       "00" },
-	{ 0, "CABLE",     "01" },
-	{ 0, "SAT",       "01" },
-	{ 0, "TV",        "02" },
-	{ 0, "AUX",       "03" },
-	{ 0, "AUX2",      "04" },
-	{ 0, "PC",        "05" },
-	{ 0, "DVD",       "10" },
-	{ 0, "TAPE",      "20" },
-	{ 0, "PHONO",     "22" },
-	{ 0, "CD",        "23" },
-	{ 0, "FM",        "24" },
-	{ 0, "FM TUNER",  "24" },
-	{ 0, "AM",        "25" },
-	{ 0, "AM TUNER",  "25" },
-	{ 0, "TUNER",     "26" },
-	{ 0, "MUSIC SERVER", "27" },
-	{ 0, "SERVER",    "27" },
-	{ 0, "IRADIO",    "28" },
-	{ 0, "USB",       "29" },
-	{ 0, "USB REAR",  "2A" },
-	{ 0, "PORT",      "40" },
-	{ 0, "MULTICH",   "30" },
-	{ 0, "XM",        "31" },
-	{ 0, "SIRIUS",    "32" },
-	{ 0, NULL,        NULL },
+	{ "DVR",       "00" },
+	{ "VCR",       "00" },
+	{ "CABLE",     "01" },
+	{ "SAT",       "01" },
+	{ "TV",        "02" },
+	{ "AUX",       "03" },
+	{ "AUX2",      "04" },
+	{ "PC",        "05" },
+	{ "DVD",       "10" },
+	{ "TAPE",      "20" },
+	{ "PHONO",     "22" },
+	{ "CD",        "23" },
+	{ "FM",        "24" },
+	{ "FM TUNER",  "24" },
+	{ "AM",        "25" },
+	{ "AM TUNER",  "25" },
+	{ "TUNER",     "26" },
+	{ "MUSIC SERVER", "27" },
+	{ "SERVER",    "27" },
+	{ "IRADIO",    "28" },
+	{ "USB",       "29" },
+	{ "USB REAR",  "2A" },
+	{ "PORT",      "40" },
+	{ "MULTICH",   "30" },
+	{ "XM",        "31" },
+	{ "SIRIUS",    "32" },
+	{ NULL,        NULL },
 };
 
-static int handle_input(struct receiver *rcvr,
+static int handle_input(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	int ret;
-	unsigned long hashval;
 	struct code_map *input;
 
-	ret = handle_standard(rcvr, cmd, arg);
+	ret = handle_standard(rcvr, c, cmd, arg);
 	if(ret != -2)
 		return ret;
 
@@ -292,93 +274,82 @@ static int handle_input(struct receiver *rcvr,
 	strtoupper(arg);
 	ret = -1;
 
-	hashval = hash_sdbm(arg);
-	for(input = inputs; input->key; input++) {
-		if(input->hash == hashval) {
-			ret = cmd_attempt(rcvr, cmd, input->value);
-			break;
-		}
-	}
+	input = hash_index_find(&input_index, arg, hash_sdbm(arg));
+	if(input)
+		ret = cmd_attempt(rcvr, c, cmd, input->value);
 	/* the following are only valid for zones */
 	if(ret == -1 &&
 			(strcmp(cmd->prefix, "SLZ") == 0 ||
 			 strcmp(cmd->prefix, "SL3") == 0)) {
 		if(strcmp(arg, "OFF") == 0)
-			ret = cmd_attempt(rcvr, cmd, "7F");
+			ret = cmd_attempt(rcvr, c, cmd, "7F");
 		else if(strcmp(arg, "SOURCE") == 0)
-			ret = cmd_attempt(rcvr, cmd, "80");
+			ret = cmd_attempt(rcvr, c, cmd, "80");
 	}
 
 	return ret;
 }
 
 static struct code_map modes[] = {
-	{ 0, "STEREO",     "00" },
-	{ 0, "DIRECT",     "01" },
-	{ 0, "MONOMOVIE",  "07" },
-	{ 0, "ORCHESTRA",  "08" },
-	{ 0, "UNPLUGGED",  "09" },
-	{ 0, "STUDIOMIX",  "0A" },
-	{ 0, "TVLOGIC",    "0B" },
-	{ 0, "ACSTEREO",   "0C" },
-	{ 0, "THEATERD",   "0D" },
-	{ 0, "MONO",       "0F" },
-	{ 0, "PURE",       "11" },
-	{ 0, "FULLMONO",   "13" },
-	{ 0, "DTSSS",      "15" },
-	{ 0, "DSX",        "16" },
-	{ 0, "STRAIGHT",   "40" },
-	{ 0, "DOLBYEX",    "41" },
-	{ 0, "DTSES",      "41" },
-	{ 0, "THX",        "42" },
-	{ 0, "THXEX",      "43" },
-	{ 0, "THXMUSIC",   "44" },
-	{ 0, "THXGAMES",   "45" },
-	{ 0, "PLIIMOVIE",  "80" },
-	{ 0, "PLIIMUSIC",  "81" },
-	{ 0, "NEO6CINEMA", "82" },
-	{ 0, "NEO6MUSIC",  "83" },
-	{ 0, "PLIITHX",    "84" },
-	{ 0, "NEO6THX",    "85" },
-	{ 0, "PLIIGAME",   "86" },
-	{ 0, "NEURALTHX",  "88" },
-	{ 0, NULL,         NULL },
+	{ "STEREO",     "00" },
+	{ "DIRECT",     "01" },
+	{ "MONOMOVIE",  "07" },
+	{ "ORCHESTRA",  "08" },
+	{ "UNPLUGGED",  "09" },
+	{ "STUDIOMIX",  "0A" },
+	{ "TVLOGIC",    "0B" },
+	{ "ACSTEREO",   "0C" },
+	{ "THEATERD",   "0D" },
+	{ "MONO",       "0F" },
+	{ "PURE",       "11" },
+	{ "FULLMONO",   "13" },
+	{ "DTSSS",      "15" },
+	{ "DSX",        "16" },
+	{ "STRAIGHT",   "40" },
+	{ "DOLBYEX",    "41" },
+	{ "DTSES",      "41" },
+	{ "THX",        "42" },
+	{ "THXEX",      "43" },
+	{ "THXMUSIC",   "44" },
+	{ "THXGAMES",   "45" },
+	{ "PLIIMOVIE",  "80" },
+	{ "PLIIMUSIC",  "81" },
+	{ "NEO6CINEMA", "82" },
+	{ "NEO6MUSIC",  "83" },
+	{ "PLIITHX",    "84" },
+	{ "NEO6THX",    "85" },
+	{ "PLIIGAME",   "86" },
+	{ "NEURALTHX",  "88" },
+	{ NULL,         NULL },
 };
 
-static int handle_mode(struct receiver *rcvr,
+static int handle_mode(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	int ret;
-	unsigned long hashval;
 	struct code_map *mode;
 
-	ret = handle_standard(rcvr, cmd, arg);
+	ret = handle_standard(rcvr, c, cmd, arg);
 	if(ret != -2)
 		return ret;
 
 	/* allow lower or upper names */
 	strtoupper(arg);
-	ret = -1;
 
-	hashval = hash_sdbm(arg);
-	for(mode = modes; mode->key; mode++) {
-		if(mode->hash == hashval) {
-			ret = cmd_attempt(rcvr, cmd, mode->value);
-			break;
-		}
-	}
-
-	return ret;
+	mode = hash_index_find(&mode_index, arg, hash_sdbm(arg));
+	if(!mode)
+		return -1;
+	return cmd_attempt(rcvr, c, cmd, mode->value);
 }
 
-static int handle_tune(struct receiver *rcvr,
+static int handle_tune(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	int ret;
 	char cmdstr[6]; /* "00000\0" */
 	char *test;
 
-	ret = handle_standard(rcvr, cmd, arg);
+	ret = handle_standard(rcvr, c, cmd, arg);
 	if(ret != -2)
 		return ret;
 
@@ -423,10 +394,10 @@ static int handle_tune(struct receiver *rcvr,
 		/* we want to print something like "TUN00780" */
 		sprintf(cmdstr, "%05ld", freq);
 	}
-	return cmd_attempt(rcvr, cmd, cmdstr);
+	return cmd_attempt(rcvr, c, cmd, cmdstr);
 }
 
-static int handle_sleep(struct receiver *rcvr,
+static int handle_sleep(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	long mins;
@@ -434,9 +405,9 @@ static int handle_sleep(struct receiver *rcvr,
 	char cmdstr[3]; /* "XX\0" */
 
 	if(!arg || strcmp(arg, "status") == 0)
-		return cmd_attempt(rcvr, cmd, "QSTN");
+		return cmd_attempt(rcvr, c, cmd, "QSTN");
 	else if(strcmp(arg, "off") == 0)
-		return cmd_attempt(rcvr, cmd, "OFF");
+		return cmd_attempt(rcvr, c, cmd, "OFF");
 
 	/* otherwise we probably have a number */
 	mins = strtol(arg, &test, 10);
@@ -451,7 +422,7 @@ static int handle_sleep(struct receiver *rcvr,
 	/* create our command */
 	sprintf(cmdstr, "%02lX", (unsigned long)mins);
 	/* send the command */
-	return cmd_attempt(rcvr, cmd, cmdstr);
+	return cmd_attempt(rcvr, c, cmd, cmdstr);
 }
 
 int write_fakesleep_status(struct receiver *rcvr,
@@ -474,7 +445,7 @@ int write_fakesleep_status(struct receiver *rcvr,
 	return 0;
 }
 
-static int handle_fakesleep(struct receiver *rcvr,
+static int handle_fakesleep(struct receiver *rcvr, UNUSED struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	struct timeval now;
@@ -520,59 +491,194 @@ static int handle_fakesleep(struct receiver *rcvr,
 	return 0;
 }
 
-static int handle_memory(struct receiver *rcvr,
+static int handle_memory(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	if(!arg)
 		return -1;
 	if(strcmp(arg, "lock") == 0)
-		return cmd_attempt(rcvr, cmd, "LOCK");
+		return cmd_attempt(rcvr, c, cmd, "LOCK");
 	else if(strcmp(arg, "unlock") == 0)
-		return cmd_attempt(rcvr, cmd, "UNLK");
+		return cmd_attempt(rcvr, c, cmd, "UNLK");
 	return -1;
 }
 
 
-static int handle_status(struct receiver *rcvr,
+/** A receiver query issued for a status request, and the status key the
+ * receiver answer shows up as. Some answers produce a second key. */
+struct status_query {
+	const char *prefix;
+	const char *key;
+	const char *extra_key;
+};
+
+static const struct status_query main_queries[] = {
+	{ "PWR", "power",  NULL },
+	{ "MVL", "volume", "dbvolume" },
+	{ "AMT", "mute",   NULL },
+	{ "SLI", "input",  NULL },
+	{ "LMD", "mode",   NULL },
+	{ "TUN", "tune",   NULL },
+	{ NULL,  NULL,     NULL },
+};
+
+static const struct status_query zone2_queries[] = {
+	{ "ZPW", "zone2power",  NULL },
+	{ "ZVL", "zone2volume", "zone2dbvolume" },
+	{ "ZMT", "zone2mute",   NULL },
+	{ "SLZ", "zone2input",  NULL },
+	{ "TUZ", "zone2tune",   NULL },
+	{ NULL,  NULL,          NULL },
+};
+
+static const struct status_query zone3_queries[] = {
+	{ "PW3", "zone3power",  NULL },
+	{ "VL3", "zone3volume", "zone3dbvolume" },
+	{ "MT3", "zone3mute",   NULL },
+	{ "SL3", "zone3input",  NULL },
+	{ "TU3", "zone3tune",   NULL },
+	{ NULL,  NULL,          NULL },
+};
+
+/**
+ * Pick the list of status queries for a status-type command. The zone is
+ * taken from the command name (e.g. "zone2status") or the argument (e.g.
+ * "status zone2"), defaulting to the main zone.
+ * @param cmd the struct containing information on the command being called
+ * @param arg the provided argument, e.g. "zone2"
+ * @return the list of queries, NULL if the argument is not a zone
+ */
+static const struct status_query *zone_queries(const struct command *cmd,
+		const char *arg)
+{
+	if(strncmp(cmd->name, "zone2", 5) == 0 ||
+			(arg && strcmp(arg, "zone2") == 0))
+		return zone2_queries;
+	if(strncmp(cmd->name, "zone3", 5) == 0 ||
+			(arg && strcmp(arg, "zone3") == 0))
+		return zone3_queries;
+	if(!arg || strcmp(arg, "main") == 0)
+		return main_queries;
+	return NULL;
+}
+
+static int handle_status(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
 	int ret = 0;
+	const struct status_query *q = zone_queries(cmd, arg);
+
+	if(!q)
+		return -1;
 
 	/* this handler is a bit different in that we call
 	 * multiple receiver commands */
-	if(strcmp(cmd->name, "status") == 0 && (!arg || strcmp(arg, "main") == 0)) {
-		ret += cmd_attempt_raw(rcvr, "PWR", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "MVL", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "AMT", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "SLI", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "LMD", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "TUN", "QSTN");
-	} else if(strcmp(cmd->name, "zone2status") == 0 || (arg && strcmp(arg, "zone2") == 0)) {
-		ret += cmd_attempt_raw(rcvr, "ZPW", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "ZVL", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "ZMT", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "SLZ", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "TUZ", "QSTN");
-	} else if(strcmp(cmd->name, "zone3status") == 0 || (arg && strcmp(arg, "zone3") == 0)) {
-		ret += cmd_attempt_raw(rcvr, "PW3", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "VL3", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "MT3", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "SL3", "QSTN");
-		ret += cmd_attempt_raw(rcvr, "TU3", "QSTN");
-	} else {
+	for(; q->prefix; q++) {
+		if(cmd_attempt_raw(rcvr, c, q->prefix, "QSTN") == -3)
+			ret = -3;
+	}
+
+	return ret;
+}
+
+/**
+ * Reply to a cached status request on the requesting connection only, or
+ * to everyone if the request did not come from a connection.
+ */
+static void reply_status(struct conn *c, const char *msg)
+{
+	if(c)
+		write_to_connection(c, msg);
+	else
+		write_to_connections(msg);
+}
+
+static int handle_cachedstatus(struct receiver *rcvr, struct conn *c,
+		const struct command *cmd, char *arg)
+{
+	int ret = 0;
+	struct timeval now;
+	const struct status_query *q = zone_queries(cmd, arg);
+
+	if(!q)
 		return -1;
+
+	/* Answer from the status cache wherever we can; only values we have
+	 * never seen or that are too old cost a trip to the receiver. */
+	gettimeofday(&now, NULL);
+	for(; q->prefix; q++) {
+		const char *msg = rcvr_cached_status(rcvr, q->key, &now);
+		if(!msg) {
+			if(cmd_attempt_raw(rcvr, c, q->prefix, "QSTN") == -3)
+				ret = -3;
+			continue;
+		}
+		if(q->extra_key) {
+			const char *extra = rcvr_cached_status(rcvr, q->extra_key, &now);
+			if(extra)
+				reply_status(c, extra);
+		}
+		reply_status(c, msg);
 	}
 
-	return ret < 0 ? -2 : 0;
+	return ret;
 }
 
-static int handle_raw(struct receiver *rcvr,
+static int handle_raw(struct receiver *rcvr, struct conn *c,
 		const struct command *cmd, char *arg)
 {
-	return cmd_attempt(rcvr, cmd, arg);
+	return cmd_attempt(rcvr, c, cmd, arg);
+}
+
+static int handle_loglevel(UNUSED struct receiver *rcvr, struct conn *c,
+		UNUSED const struct command *cmd, char *arg)
+{
+	char buf[BUF_SIZE];
+
+	if(arg && strcmp(arg, "status") != 0) {
+		int level = log_parse_level(arg);
+		if(level == -1)
+			return -1;
+		log_set_level((enum log_level)level);
+	}
+	snprintf(buf, BUF_SIZE, "OK:loglevel:%s\n",
+			log_level_name(log_get_level()));
+	reply_status(c, buf);
+	return 0;
 }
 
-static int handle_quit(UNUSED struct receiver *rcvr,
+/**
+ * Handle "subscribe [pattern...]" and "unsubscribe [pattern...]". Both
+ * reply with the subscriptions the connection has afterwards; a bare
+ * "unsubscribe" drops them all.
+ */
+static int handle_subscribe(UNUSED struct receiver *rcvr, struct conn *c,
+		const struct command *cmd, char *arg)
+{
+	char buf[MAX_SUBSCRIPTIONS * SUB_KEY_SIZE + BUF_SIZE];
+	int len;
+
+	if(strcmp(cmd->name, "subscribe") == 0) {
+		if(arg && conn_subscribe(c, arg) == -1)
+			return -1;
+	} else if(conn_unsubscribe(c, arg) == -1) {
+		return -1;
+	}
+	len = snprintf(buf, sizeof(buf), "OK:%s:", cmd->name);
+	conn_subscriptions(c, buf + len, sizeof(buf) - (size_t)len - 1);
+	strcat(buf, "\n");
+	reply_status(c, buf);
+	return 0;
+}
+
+static int handle_stats(UNUSED struct receiver *rcvr, struct conn *c,
+		UNUSED const struct command *cmd, UNUSED char *arg)
+{
+	write_stats(c);
+	return 0;
+}
+
+static int handle_quit(UNUSED struct receiver *rcvr, UNUSED struct conn *c,
 		UNUSED const struct command *cmd, UNUSED char *arg)
 {
 	return -2;
@@ -580,76 +686,164 @@ static int handle_quit(UNUSED struct receiver *rcvr,
 
 static struct command command_list[] = {
 	/*
-	{ 0, name,      prefix, handle_func }, */
-	{ 0, "power",    "PWR", handle_boolean },
-	{ 0, "volume",   "MVL", handle_volume },
-	{ 0, "dbvolume", "MVL", handle_dbvolume },
-	{ 0, "mute",     "AMT", handle_boolean },
-	{ 0, "input",    "SLI", handle_input },
-	{ 0, "mode",     "LMD", handle_mode },
-	{ 0, "tune",     "TUN", handle_tune },
-	{ 0, "preset",   "PRS", handle_preset },
-	{ 0, "swlevel",  "SWL", handle_swlevel },
-	{ 0, "avsync",   "AVS", handle_avsync },
-	{ 0, "memory",   "MEM", handle_memory },
-	{ 0, "audyssey", "ADY", handle_boolean },
-	{ 0, "dyneq",    "ADQ", handle_boolean },
-
-	{ 0, "status",   NULL,  handle_status },
-
-	{ 0, "zone2power",  "ZPW", handle_boolean },
-	{ 0, "zone2volume", "ZVL", handle_volume },
-	{ 0, "zone2dbvolume","ZVL",handle_dbvolume },
-	{ 0, "zone2mute",   "ZMT", handle_boolean },
-	{ 0, "zone2input",  "SLZ", handle_input },
-	{ 0, "zone2tune",   "TUZ", handle_tune },
-	{ 0, "zone2preset", "PRZ", handle_preset },
-
-	{ 0, "zone2status", NULL,  handle_status },
-
-	{ 0, "zone3power",  "PW3", handle_boolean },
-	{ 0, "zone3volume", "VL3", handle_volume },
-	{ 0, "zone3dbvolume","VL3",handle_dbvolume },
-	{ 0, "zone3mute",   "MT3", handle_boolean },
-	{ 0, "zone3input",  "SL3", handle_input },
-	{ 0, "zone3tune",   "TU3", handle_tune },
-	{ 0, "zone3preset", "PR3", handle_preset },
-
-	{ 0, "zone3status", NULL,  handle_status },
-
-	{ 0, "sleep",       "SLP", handle_sleep },
-	{ 0, "zone2sleep",  "2",   handle_fakesleep },
-	{ 0, "zone3sleep",  "3",   handle_fakesleep },
-
-	{ 0, "raw",  "", handle_raw },
-	{ 0, "quit", "", handle_quit },
-
-	{ 0, NULL, NULL, NULL },
+	{ name,      prefix, handle_func }, */
+	{ "power",    "PWR", handle_boolean },
+	{ "volume",   "MVL", handle_volume },
+	{ "dbvolume", "MVL", handle_dbvolume },
+	{ "mute",     "AMT", handle_boolean },
+	{ "input",    "SLI", handle_input },
+	{ "mode",     "LMD", handle_mode },
+	{ "tune",     "TUN", handle_tune },
+	{ "preset",   "PRS", handle_preset },
+	{ "swlevel",  "SWL", handle_swlevel },
+	{ "avsync",   "AVS", handle_avsync },
+	{ "memory",   "MEM", handle_memory },
+	{ "audyssey", "ADY", handle_boolean },
+	{ "dyneq",    "ADQ", handle_boolean },
+
+	{ "status",   NULL,  handle_status },
+	{ "cachedstatus", NULL, handle_cachedstatus },
+
+	{ "zone2power",  "ZPW", handle_boolean },
+	{ "zone2volume", "ZVL", handle_volume },
+	{ "zone2dbvolume","ZVL",handle_dbvolume },
+	{ "zone2mute",   "ZMT", handle_boolean },
+	{ "zone2input",  "SLZ", handle_input },
+	{ "zone2tune",   "TUZ", handle_tune },
+	{ "zone2preset", "PRZ", handle_preset },
+
+	{ "zone2status", NULL,  handle_status },
+	{ "zone2cachedstatus", NULL, handle_cachedstatus },
+
+	{ "zone3power",  "PW3", handle_boolean },
+	{ "zone3volume", "VL3", handle_volume },
+	{ "zone3dbvolume","VL3",handle_dbvolume },
+	{ "zone3mute",   "MT3", handle_boolean },
+	{ "zone3input",  "SL3", handle_input },
+	{ "zone3tune",   "TU3", handle_tune },
+	{ "zone3preset", "PR3", handle_preset },
+
+	{ "zone3status", NULL,  handle_status },
+	{ "zone3cachedstatus", NULL, handle_cachedstatus },
+
+	{ "sleep",       "SLP", handle_sleep },
+	{ "zone2sleep",  "2",   handle_fakesleep },
+	{ "zone3sleep",  "3",   handle_fakesleep },
+
+	{ "raw",  "", handle_raw },
+
+	{ NULL, NULL, NULL },
+};
+
+/** Commands about the connection itself rather than a receiver; these are
+ * run once per command line, with no receiver. */
+static struct command conn_command_list[] = {
+	{ "loglevel",    "", handle_loglevel },
+	{ "subscribe",   "", handle_subscribe },
+	{ "unsubscribe", "", handle_subscribe },
+	{ "stats",       "", handle_stats },
+	{ "quit",        "", handle_quit },
+
+	{ NULL, NULL, NULL },
 };
 
 /**
- * Initialize our list of commands. This must be called before the first
- * call to process_command().
+ * Build a hash index of a code map, keyed by the code names.
+ * @param idx the index to build
+ * @param codes the code map, terminated by a NULL key
+ * @return 0 on success, -1 on allocation failure
  */
-void init_commands(void)
+static int index_code_map(struct hash_index *idx, struct code_map *codes)
 {
-	unsigned int cmd_count = 0;
-	struct command *ptr;
 	struct code_map *code;
+	size_t count = 0;
 
-	for(ptr = command_list; ptr->name; ptr++) {
-		ptr->hash = hash_sdbm(ptr->name);
-		cmd_count++;
-	}
+	for(code = codes; code->key; code++)
+		count++;
+	if(hash_index_init(idx, count) == -1)
+		return -1;
+	for(code = codes; code->key; code++)
+		hash_index_add(idx, code->key, code);
+	return 0;
+}
 
-	for(code = inputs; code->key; code++) {
-		code->hash = hash_sdbm(code->key);
-	}
-	for(code = modes; code->key; code++) {
-		code->hash = hash_sdbm(code->key);
-	}
+/**
+ * Build a hash index of a command list, keyed by the command names.
+ * @param idx the index to build
+ * @param cmds the command list, terminated by a NULL name
+ * @return the number of commands indexed, -1 on allocation failure
+ */
+static int index_commands(struct hash_index *idx, struct command *cmds)
+{
+	struct command *ptr;
+	int count = 0;
 
-	printf("%u commands added to command list.\n", cmd_count);
+	for(ptr = cmds; ptr->name; ptr++)
+		count++;
+	if(hash_index_init(idx, (size_t)count) == -1)
+		return -1;
+	for(ptr = cmds; ptr->name; ptr++)
+		hash_index_add(idx, ptr->name, ptr);
+	return count;
+}
+
+/**
+ * Initialize our list of commands. This must be called before the first
+ * call to process_command() or process_conn_command().
+ * @return 0 on success, -1 on allocation failure
+ */
+int init_commands(void)
+{
+	int cmd_count, conn_count;
+
+	cmd_count = index_commands(&command_index, command_list);
+	conn_count = index_commands(&conn_command_index, conn_command_list);
+	if(cmd_count == -1 || conn_count == -1)
+		return -1;
+
+	if(index_code_map(&input_index, inputs) == -1 ||
+			index_code_map(&mode_index, modes) == -1)
+		return -1;
+
+	log_msg(LEVEL_INFO, "%d commands added to command list.",
+			cmd_count + conn_count);
+	return 0;
+}
+
+/**
+ * Free the memory used by our command indexes.
+ */
+void free_commands(void)
+{
+	hash_index_free(&command_index);
+	hash_index_free(&conn_command_index);
+	hash_index_free(&input_index);
+	hash_index_free(&mode_index);
+}
+
+/**
+ * Split a command string into the standard "<cmd> <arg>" format.
+ * @param str the full command string, e.g. "power on"
+ * @param argstr where to store the argument, NULL if there is none
+ * @return the command, which the argument is part of; must be freed
+ */
+static char *split_command(const char *str, char **argstr)
+{
+	char *cmdstr, *p;
+
+	cmdstr = strdup(str);
+	/* start by killing trailing whitespace of any sort */
+	p = cmdstr + strlen(cmdstr) - 1;
+	while(isspace(*p) && p >= cmdstr)
+		*p-- = '\0';
+	/* start by splitting the string after the cmd */
+	*argstr = strchr(cmdstr, ' ');
+	/* if we had an arg, set our pointers correctly */
+	if(*argstr) {
+		**argstr = '\0';
+		(*argstr)++;
+	}
+	return cmdstr;
 }
 
 /** 
@@ -658,42 +852,27 @@ void init_commands(void)
  * the work to it. If no handler is found, return an error; otherwise
  * return the relevant human-readable status message.
  * @param rcvr the receiver to process the command for
+ * @param c the connection the command came from, NULL for internal commands
  * @param str the full command string, e.g. "power on"
  * @return 0 if the command string was correct and sent, -1 on invalid command,
- * -2 if we should quit/close the connection
- * string
+ * -2 if we should quit/close the connection, -3 if the receiver command
+ * queue is full
  */
-int process_command(struct receiver *rcvr, const char *str)
+int process_command(struct receiver *rcvr, struct conn *c, const char *str)
 {
-	unsigned long hashval;
 	char *cmdstr, *argstr;
-	char *c;
 	struct command *cmd;
 
 	if(!str)
 		return -1;
 
-	cmdstr = strdup(str);
-	/* start by killing trailing whitespace of any sort */
-	c = cmdstr + strlen(cmdstr) - 1;
-	while(isspace(*c) && c >= cmdstr)
-		*c-- = '\0';
-	/* start by splitting the string after the cmd */
-	argstr = strchr(cmdstr, ' ');
-	/* if we had an arg, set our pointers correctly */
-	if(argstr) {
-		*argstr = '\0';
-		argstr++;
-	}
-
-	hashval = hash_sdbm(cmdstr);
-	for(cmd = command_list; cmd->name; cmd++) {
-		if(cmd->hash == hashval) {
-			/* we found the handler, call it and return the result */
-			int ret = cmd->handler(rcvr, cmd, argstr);
-			free(cmdstr);
-			return ret;
-		}
+	cmdstr = split_command(str, &argstr);
+	cmd = hash_index_find(&command_index, cmdstr, hash_sdbm(cmdstr));
+	if(cmd) {
+		/* we found the handler, call it and return the result */
+		int ret = cmd->handler(rcvr, c, cmd, argstr);
+		free(cmdstr);
+		return ret;
 	}
 
 	/* we didn't find a handler, must be an invalid command */
@@ -701,6 +880,29 @@ int process_command(struct receiver *rcvr, const char *str)
 	return -1;
 }
 
+/**
+ * Process a command about the connection itself, such as "subscribe" or
+ * "quit". Unlike receiver commands these are run only once, however many
+ * receivers there are.
+ * @param c the connection the command came from
+ * @param str the full command string, e.g. "loglevel debug"
+ * @return 0 if the command was run, -1 on invalid arguments, -2 if we
+ * should quit/close the connection, 1 if it is not a connection command
+ */
+int process_conn_command(struct conn *c, const char *str)
+{
+	char *cmdstr, *argstr;
+	struct command *cmd;
+	int ret = 1;
+
+	cmdstr = split_command(str, &argstr);
+	cmd = hash_index_find(&conn_command_index, cmdstr, hash_sdbm(cmdstr));
+	if(cmd)
+		ret = cmd->handler(NULL, c, cmd, argstr);
+	free(cmdstr);
+	return ret;
+}
+
 
 /**
  * Determine if a command is related to the receiver power status. This can
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+Onkyo receiver emulator for hardware-free testing of onkyocontrol.
+
+This opens a pseudo-terminal and behaves like a receiver attached to the
+serial port on the other end of it. Point the daemon at the printed device
+path with --serial. Commands are read in the "!1XXXyy\\r\\n" format written
+by rcvr_send_command and answered with "!1XXXyy" status messages terminated
+the way a real receiver terminates them (EOF, 0x1A).
+
+The emulator keeps track of power for the main zone and zones 2 and 3 and
+only answers commands for a zone that is powered on; everything else gets
+an "N/A" reply. Powering a zone on produces a burst of status messages, and
+with --chatter the emulator also reports front-panel style changes on its
+own. --latency and --baud control how quickly replies come back.
+
+With --net, the emulator is a network receiver instead: it listens on a
+TCP port and speaks eISCP, where every message travels in a packet behind
+a 16 byte header. Point the daemon at the printed address with --net.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import sys
+import tty
+
+from iscp import EOF, HEADER, MAGIC, START, VERSION, decode_frame, \
+        split_frames
+
+TERMINATORS = {
+    'eof': EOF,
+    'eofcrlf': EOF + b"\r\n",
+    'crlf': b"\r\n",
+}
+
+INPUTS = [ '00', '01', '02', '03', '04', '05', '10', '20', '22', '23', '24',
+        '25', '26', '27', '28', '29', '2A', '30', '31', '32', '40' ]
+ZONE_INPUTS = [ '00', '01', '02', '03', '04', '10', '20', '22', '23', '24',
+        '25', '26', '30', '31', '32', '7F', '80' ]
+MODES = [ '00', '01', '07', '08', '09', '0A', '0B', '0C', '0D', '0F', '11',
+        '13', '15', '16', '40', '41', '42', '43', '44', '45', '80', '81',
+        '82', '83', '84', '85', '86', '88' ]
+
+# prefix -> (zone, kind, choices); zone 0 is the power command itself
+COMMANDS = {
+    'PWR': (0, 'power', 1),
+    'ZPW': (0, 'power', 2),
+    'PW3': (0, 'power', 3),
+
+    'MVL': (1, 'volume', None),
+    'AMT': (1, 'mute', None),
+    'SLI': (1, 'code', INPUTS),
+    'LMD': (1, 'code', MODES),
+    'TUN': (1, 'tune', None),
+    'PRS': (1, 'preset', None),
+    'SLP': (1, 'sleep', None),
+    'SWL': (1, 'swlevel', None),
+    'AVS': (1, 'avsync', None),
+    'MEM': (1, 'code', [ 'LOCK', 'UNLK' ]),
+    'DIF': (1, 'code', [ '00', '01', '02' ]),
+    'DIM': (1, 'code', [ '00', '01', '02', '03', '08' ]),
+    'LTN': (1, 'code', [ '00', '01', '02' ]),
+    'RAS': (1, 'code', [ '00', '01' ]),
+    'ADY': (1, 'code', [ '00', '01' ]),
+    'ADQ': (1, 'code', [ '00', '01' ]),
+    'HDO': (1, 'code', [ '00', '01' ]),
+    'RES': (1, 'code', [ '00', '01', '02', '03', '04', '05' ]),
+    'SLA': (1, 'code', [ '00', '01', '02', '03', '04' ]),
+    'TGA': (1, 'code', [ '00', '01' ]),
+    'TGB': (1, 'code', [ '00', '01' ]),
+    'TGC': (1, 'code', [ '00', '01' ]),
+
+    'ZVL': (2, 'volume', None),
+    'ZMT': (2, 'mute', None),
+    'SLZ': (2, 'code', ZONE_INPUTS),
+    'TUZ': (2, 'tune', None),
+    'PRZ': (2, 'preset', None),
+
+    'VL3': (3, 'volume', None),
+    'MT3': (3, 'mute', None),
+    'SL3': (3, 'code', ZONE_INPUTS),
+    'TU3': (3, 'tune', None),
+    'PR3': (3, 'preset', None),
+}
+
+# the messages a zone reports when it is switched on
+POWER_ON_BURST = {
+    1: [ 'MVL', 'AMT', 'SLI', 'LMD', 'TUN', 'PRS', 'SLP', 'DIM' ],
+    2: [ 'ZVL', 'ZMT', 'SLZ', 'TUZ', 'PRZ' ],
+    3: [ 'VL3', 'MT3', 'SL3', 'TU3', 'PR3' ],
+}
+POWER_PREFIX = { 1: 'PWR', 2: 'ZPW', 3: 'PW3' }
+
+def _clamp(value, lower, upper):
+    return max(lower, min(upper, value))
+
+class ReceiverState:
+    """
+    The complete state of the emulated receiver. handle() takes a command
+    without framing, such as "MVLQSTN", and returns the list of status
+    messages (again without framing) the receiver would answer with.
+    """
+
+    def __init__(self):
+        self.power = { 1: False, 2: False, 3: False }
+        self.values = {
+            'MVL': '28', 'AMT': '00', 'SLI': '24', 'LMD': '00',
+            'TUN': '09790', 'PRS': '01', 'SLP': '00', 'SWL': '00',
+            'AVS': '0000', 'MEM': 'UNLK', 'DIF': '00', 'DIM': '00',
+            'LTN': '00', 'RAS': '00', 'ADY': '01', 'ADQ': '01', 'HDO': '01',
+            'RES': '01', 'SLA': '00', 'TGA': '00', 'TGB': '00', 'TGC': '00',
+            'ZVL': '20', 'ZMT': '00', 'SLZ': '80', 'TUZ': '09790',
+            'PRZ': '01',
+            'VL3': '20', 'MT3': '00', 'SL3': '80', 'TU3': '00780',
+            'PR3': '01',
+        }
+
+    def status(self, prefix):
+        zone = COMMANDS[prefix][0]
+        if zone == 0:
+            power = self.power[COMMANDS[prefix][2]]
+            return prefix + ('01' if power else '00')
+        return prefix + self.values[prefix]
+
+    def handle(self, cmd):
+        prefix, arg = cmd[:3], cmd[3:]
+        if prefix not in COMMANDS:
+            # real receivers simply ignore commands they do not know
+            return []
+        zone, kind, choices = COMMANDS[prefix]
+
+        if kind == 'power':
+            return self._power(prefix, choices, arg)
+        if not self.power[zone]:
+            return [ prefix + 'N/A' ]
+        if arg == 'QSTN':
+            return [ self.status(prefix) ]
+
+        handler = getattr(self, '_' + kind)
+        value = handler(self.values[prefix], arg, choices)
+        if value is None:
+            return [ prefix + 'N/A' ]
+        self.values[prefix] = value
+        return [ prefix + value ]
+
+    def _power(self, prefix, zone, arg):
+        if arg == 'QSTN':
+            return [ self.status(prefix) ]
+        if arg not in ('00', '01'):
+            return [ prefix + 'N/A' ]
+        on = arg == '01'
+        replies = [ prefix + arg ]
+        if on and not self.power[zone]:
+            self.power[zone] = True
+            replies.extend(self.status(p) for p in POWER_ON_BURST[zone])
+        self.power[zone] = on
+        return replies
+
+    def _volume(self, value, arg, choices):
+        level = int(value, 16)
+        if arg.startswith('UP'):
+            level += 1
+        elif arg.startswith('DOWN'):
+            level -= 1
+        else:
+            try:
+                level = int(arg, 16)
+            except ValueError:
+                return None
+            if level < 0 or level > 100:
+                return None
+        return '%02X' % _clamp(level, 0, 100)
+
+    def _mute(self, value, arg, choices):
+        if arg == 'TG':
+            return '01' if value == '00' else '00'
+        if arg in ('00', '01'):
+            return arg
+        return None
+
+    def _code(self, value, arg, choices):
+        if arg in ('UP', 'DOWN'):
+            step = 1 if arg == 'UP' else -1
+            return choices[(choices.index(value) + step) % len(choices)]
+        if arg in choices:
+            return arg
+        return None
+
+    def _tune(self, value, arg, choices):
+        freq = int(value)
+        if arg in ('UP', 'DOWN'):
+            # FM moves in 0.2 MHz steps, AM in 10 kHz steps
+            step = 20 if freq > 8000 else 10
+            freq += step if arg == 'UP' else -step
+        else:
+            if len(arg) != 5 or not arg.isdigit():
+                return None
+            freq = int(arg)
+        if freq > 8000:
+            freq = _clamp(freq, 8750, 10790)
+        else:
+            freq = _clamp(freq, 530, 1710)
+        return '%05d' % freq
+
+    def _preset(self, value, arg, choices):
+        preset = int(value, 16)
+        if arg in ('UP', 'DOWN'):
+            preset += 1 if arg == 'UP' else -1
+            return '%02X' % (((preset - 1) % 40) + 1)
+        try:
+            preset = int(arg, 16)
+        except ValueError:
+            return None
+        if preset < 1 or preset > 40:
+            return None
+        return '%02X' % preset
+
+    def _sleep(self, value, arg, choices):
+        if arg == 'OFF':
+            return '00'
+        try:
+            mins = int(arg, 16)
+        except ValueError:
+            return None
+        if mins < 0 or mins > 90:
+            return None
+        return '%02X' % mins
+
+    def _swlevel(self, value, arg, choices):
+        level = 0 if value == '00' else int(value, 16)
+        if arg in ('UP', 'DOWN'):
+            level += 1 if arg == 'UP' else -1
+        else:
+            try:
+                level = int(arg, 16)
+            except ValueError:
+                return None
+        level = _clamp(level, -15, 12)
+        if level == 0:
+            return '00'
+        return '%+X' % level
+
+    def _avsync(self, value, arg, choices):
+        if arg in ('UP', 'DOWN'):
+            delay = int(value) + (50 if arg == 'UP' else -50)
+        elif len(arg) == 4 and arg.isdigit():
+            delay = int(arg)
+        else:
+            return None
+        return '%04d' % _clamp(delay, 0, 2500)
+
+    def chatter(self):
+        """
+        Make a random change someone could have made on the front panel or
+        remote control and return the resulting status messages.
+        """
+        zones = [ z for z in (1, 2, 3) if self.power[z] ]
+        if not zones:
+            return []
+        zone = random.choice(zones)
+        prefix = random.choice(POWER_ON_BURST[zone][:5])
+        kind = COMMANDS[prefix][1]
+        if kind == 'mute':
+            return self.handle(prefix + 'TG')
+        return self.handle(prefix + random.choice(('UP', 'DOWN')))
+
+
+class Emulator:
+    """
+    Serve a ReceiverState over a pseudo-terminal from an asyncio event
+    loop. Replies are delayed by the configured latency and written no
+    faster than the configured baud rate allows.
+    """
+
+    def __init__(self, state=None, latency=0.0, baud=9600, chatter=0.0,
+            terminator=EOF, verbose=False):
+        self.state = state or ReceiverState()
+        self.latency = latency
+        self.baud = baud
+        self.chatter = chatter
+        self.terminator = terminator
+        self.verbose = verbose
+
+        self.master = -1
+        self.slave = -1
+        self.path = None
+        self.commands = 0
+        self.replies = 0
+
+        self._inbuf = bytearray()
+        self._outqueue = None
+        self._tasks = []
+
+    def open(self):
+        self.master, self.slave = os.openpty()
+        # No echo or line processing until the daemon sets its own terminal
+        # attributes. We keep the slave open so the master does not see a
+        # hangup whenever the daemon closes and reopens the device.
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        return self.path
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self.master >= 0:
+            try:
+                asyncio.get_event_loop().remove_reader(self.master)
+            except RuntimeError:
+                pass
+            os.close(self.master)
+            os.close(self.slave)
+            self.master = self.slave = -1
+
+    async def start(self):
+        if self.master < 0:
+            self.open()
+        loop = asyncio.get_running_loop()
+        self._outqueue = asyncio.Queue()
+        loop.add_reader(self.master, self._readable)
+        self._tasks.append(asyncio.ensure_future(self._writer()))
+        if self.chatter > 0:
+            self._tasks.append(asyncio.ensure_future(self._chatterer()))
+
+    def _log(self, direction, data):
+        if self.verbose:
+            sys.stderr.write("%s %r\n" % (direction, bytes(data)))
+
+    def _readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            # EIO: nothing has the slave side open right now
+            return
+        self._inbuf.extend(data)
+        # commands end in CR LF, but accept any of the ISCP terminators
+        codes, used = split_frames(self._inbuf)
+        del self._inbuf[:used]
+        for code in codes:
+            self._command(code.decode('ascii', 'replace'))
+
+    def _command(self, cmd):
+        self._log("<", START + cmd.encode('ascii', 'replace'))
+        self.commands += 1
+        replies = self.state.handle(cmd)
+        asyncio.get_running_loop().call_later(self.latency,
+                self._queue, replies)
+
+    def _queue(self, replies):
+        for reply in replies:
+            self._outqueue.put_nowait(reply)
+
+    async def _writer(self):
+        while True:
+            reply = await self._outqueue.get()
+            frame = START + reply.encode('ascii') + self.terminator
+            self._log(">", frame)
+            self._write(frame)
+            self.replies += 1
+            if self.baud:
+                # 8n1 framing: ten bits on the wire per byte
+                await asyncio.sleep(len(frame) * 10.0 / self.baud)
+
+    def _write(self, frame):
+        try:
+            os.write(self.master, frame)
+        except OSError:
+            pass
+
+    async def _chatterer(self):
+        while True:
+            await asyncio.sleep(random.expovariate(1.0 / self.chatter))
+            self._queue(self.state.chatter())
+
+
+class NetEmulator(Emulator):
+    """
+    Serve a ReceiverState over eISCP from an asyncio event loop, like a
+    network receiver. Status messages go to every connected client. There
+    is no baud rate to pace replies by, only the latency.
+    """
+
+    def __init__(self, state=None, latency=0.0, chatter=0.0,
+            terminator=EOF + b"\r\n", verbose=False, host='127.0.0.1',
+            port=0):
+        super().__init__(state, latency=latency, baud=0, chatter=chatter,
+                terminator=terminator, verbose=verbose)
+        self.host = host
+        self.port = port
+        self.connections = 0
+
+        self._sock = None
+        self._server = None
+        self._clients = []
+
+    def open(self):
+        self._sock = socket.create_server((self.host, self.port))
+        self.port = self._sock.getsockname()[1]
+        self.path = "%s:%d" % (self.host, self.port)
+        return self.path
+
+    def drop(self):
+        """Close all client connections, as a receiver being rebooted."""
+        for writer in self._clients:
+            writer.close()
+        self._clients = []
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self.drop()
+        if self._server:
+            self._server.close()
+            self._server = None
+        elif self._sock:
+            self._sock.close()
+        self._sock = None
+
+    async def start(self):
+        if not self._sock:
+            self.open()
+        self._outqueue = asyncio.Queue()
+        self._server = await asyncio.start_server(self._client,
+                sock=self._sock)
+        self._tasks.append(asyncio.ensure_future(self._writer()))
+        if self.chatter > 0:
+            self._tasks.append(asyncio.ensure_future(self._chatterer()))
+
+    async def _client(self, reader, writer):
+        self.connections += 1
+        self._clients.append(writer)
+        try:
+            while True:
+                magic, header_size, size, version = HEADER.unpack(
+                        await reader.readexactly(HEADER.size))
+                if magic != MAGIC or header_size < HEADER.size:
+                    self._log("!", magic)
+                    break
+                await reader.readexactly(header_size - HEADER.size)
+                cmd = decode_frame(await reader.readexactly(size))
+                if cmd is not None:
+                    self._command(cmd)
+        except (asyncio.IncompleteReadError, ConnectionError,
+                asyncio.CancelledError):
+            # the client went away, or we are shutting down
+            pass
+        finally:
+            if writer in self._clients:
+                self._clients.remove(writer)
+            writer.close()
+
+    def _write(self, frame):
+        packet = HEADER.pack(MAGIC, HEADER.size, len(frame), VERSION) + frame
+        for writer in self._clients:
+            writer.write(packet)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+            description="Emulate an Onkyo receiver on a pseudo-terminal.")
+    parser.add_argument('-l', '--link', metavar='PATH',
+            help="also create a symlink to the pty device at PATH")
+    parser.add_argument('-n', '--net', metavar='[HOST:]PORT',
+            help="be a network receiver speaking eISCP on this TCP "
+            "address instead of using a pty, e.g. 60128")
+    parser.add_argument('--latency', type=float, default=20.0, metavar='MS',
+            help="delay before answering each command (default 20)")
+    parser.add_argument('--baud', type=int, default=9600,
+            help="pace replies as if sent at this baud rate, 0 for no "
+            "pacing (default 9600)")
+    parser.add_argument('--chatter', type=float, default=0.0, metavar='SECS',
+            help="mean time between unsolicited status changes (default "
+            "off)")
+    parser.add_argument('--terminator', choices=sorted(TERMINATORS),
+            default='eof', help="status message terminator (default eof)")
+    parser.add_argument('--power', action='store_true',
+            help="start with the main zone powered on")
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help="print all traffic to stderr")
+    return parser.parse_args(argv)
+
+async def _main(args):
+    state = ReceiverState()
+    state.power[1] = args.power
+    if args.net:
+        host, _, port = args.net.rpartition(':')
+        emulator = NetEmulator(state, latency=args.latency / 1000.0,
+                chatter=args.chatter,
+                terminator=TERMINATORS[args.terminator],
+                verbose=args.verbose, host=host or '127.0.0.1',
+                port=int(port))
+    else:
+        emulator = Emulator(state, latency=args.latency / 1000.0,
+                baud=args.baud, chatter=args.chatter,
+                terminator=TERMINATORS[args.terminator],
+                verbose=args.verbose)
+    path = emulator.open()
+    if args.link and not args.net:
+        if os.path.lexists(args.link):
+            os.unlink(args.link)
+        os.symlink(path, args.link)
+    # the first line of output is the device to hand to --serial, or the
+    # address to hand to --net
+    print(path)
+    sys.stdout.flush()
+    await emulator.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        emulator.close()
+        if args.link and not args.net:
+            os.unlink(args.link)
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_main(parse_args(sys.argv[1:])))
+    except KeyboardInterrupt:
+        pass
+
+# vim: set ts=4 sw=4 et:
@@ -8,46 +8,16 @@ DEBUG = False
 HOST = 'dublin'
 PORT = 8701
 
-import pygtk, gtk, gobject
-import os, socket
-
-HELLO_MESSAGE = "OK:onkyocontrol"
-STATUSES = [ 'power', 'mute', 'mode', 'volume', 'input', 'tune', 'sleep',
-        'zone2power', 'zone2mute', 'zone2volume', 'zone2input', 'zone2tune',
-        'zone2sleep' ]
-
-def verify_frequency(freq):
-    """
-    Verify that a frequency value given by the user can be mapped to an FM
-    or AM frequency. If it is a valid FM frequency, return the value as a
-    float; if it is a valid AM frequency return it as an int. If the frequency
-    is not valid, raise a CommandException.
-    """
-    try:
-        floatval = float(freq)
-    except ValueError:
-        raise CommandException("Frequency not valid: %s" % freq)
-    # attempt to validate the frequency
-    if floatval < 87.4 or floatval > 108.0:
-        # try AM instead
-        if floatval < 530 or floatval > 1710:
-            # we failed both validity tests
-            raise CommandException("Frequency not valid: %s" % freq)
-        else:
-            # valid AM frequency
-            return "AM", int(floatval)
-    else:
-        # valid FM frequency
-        return "FM", floatval
-
-class OnkyoClientException(Exception):
-    pass
+# Minimum time in milliseconds between two sends for controls such as the
+# volume sliders that can generate many values; matches the daemon's
+# COMMAND_WAIT pacing to the receiver.
+COALESCE_INTERVAL = 80
 
-class ConnectionError(OnkyoClientException):
-    pass
+import pygtk, gtk, gobject
+import socket
 
-class CommandException(OnkyoClientException):
-    pass
+from onkyoproto import HELLO_MESSAGE, STATUSES, verify_frequency, \
+        decode_line, OnkyoClientException, ConnectionError, CommandException
 
 class OnkyoClient:
     """
@@ -66,11 +36,20 @@ class OnkyoClient:
 
         # set up our socket descriptors
         self._sock = None
+        # bytes received but not yet terminated by a newline
+        self._recvbuf = bytearray()
+
+        # Fields touched since the last update notification, along with the
+        # raw lines that touched them. One idle callback per main loop
+        # iteration hands these to the update callback as a batch.
+        self._changed = set()
+        self._received = []
+        self._idleevent = -1
+        self._updatecallback = None
 
-        # set up our notification file descriptor
-        (fd_r, fd_w) = os.pipe()
-        self._piperead = fd_r
-        self._pipewrite = fd_w
+        # latest-value-wins sends; key -> held line, key -> timer event
+        self._heldlines = dict()
+        self._holdevents = dict()
 
         # our status container object
         self.status = dict()
@@ -84,9 +63,10 @@ class OnkyoClient:
     def __del__(self):
         if self._sock:
             self._disconnect()
-        if self._piperead:
-            os.close(self._piperead)
-            os.close(self._pipewrite)
+        if self._idleevent >= 0:
+            gobject.source_remove(self._idleevent)
+        for eventid in self._holdevents.values():
+            gobject.source_remove(eventid)
 
     def _connect(self):
         if self._sock:
@@ -125,6 +105,12 @@ class OnkyoClient:
         if self._sock:
             self._sock.close()
             self._sock = None
+        del self._recvbuf[:]
+        # held lines were meant for this connection, not the next one
+        for eventid in self._holdevents.values():
+            gobject.source_remove(eventid)
+        self._holdevents.clear()
+        self._heldlines.clear()
 
     def establish_connection(self, force=False):
         if self._sock:
@@ -137,6 +123,7 @@ class OnkyoClient:
         if self._connect():
             # allow the frontend to see that we may have stale data
             self.status['epoch'] = self.status['epoch'] + 1
+            self._mark_changed('epoch')
             # stop our timer connect event if it exists
             if self._connectevent >= 0:
                 gobject.source_remove(self._connectevent)
@@ -159,9 +146,14 @@ class OnkyoClient:
             return True
 
     def _hello(self):
-        lines = self._read()
-        if len(lines) < 1 or not lines[0].startswith(HELLO_MESSAGE):
+        lines = []
+        while not lines:
+            lines = self._read()
+        if not lines[0].startswith(HELLO_MESSAGE):
             raise ConnectionError("Invalid hello message: '%s'" % lines[0])
+        # anything that arrived with the hello is the daemon's status
+        # snapshot; use it now rather than on the next read
+        self._processlines(lines[1:])
 
     def _writeline(self, line):
         if DEBUG:
@@ -172,11 +164,54 @@ class OnkyoClient:
         self._sock.sendall("%s\n" % line)
         return True
 
+    def _writelatest(self, key, line):
+        """
+        Send a line for the given control key, sending at most one line per
+        key every COALESCE_INTERVAL milliseconds. If a line was sent recently,
+        hold this one instead, replacing any older line still held for the
+        same key. Held lines are sent when the interval expires, so the final
+        value is never lost.
+        """
+        if key in self._holdevents:
+            self._heldlines[key] = line
+            return True
+        self._holdevents[key] = gobject.timeout_add(COALESCE_INTERVAL,
+                self._sendheld, key)
+        return self._writeline(line)
+
+    def _sendheld(self, key):
+        line = self._heldlines.pop(key, None)
+        if line is None:
+            # nothing new arrived during the interval, stop the timer
+            del self._holdevents[key]
+            return False
+        try:
+            self._writeline(line)
+        except:
+            # the timer dies with the exception; forget it, or this key
+            # would only ever be held from now on
+            del self._holdevents[key]
+            raise
+        # keep the timer running for another interval
+        return True
+
     def _read(self):
+        """
+        Read what is available on the socket and return the complete lines
+        received so far. A partial line at the end is kept in the receive
+        buffer until the rest of it arrives, so this may return an empty
+        list. Only a real EOF is treated as a lost connection.
+        """
         data = self._sock.recv(4096)
-        if not data.endswith("\n"):
+        if not data:
             raise ConnectionError("Connection lost on read")
-        lines = data.rstrip("\n").split("\n")
+        buf = self._recvbuf
+        buf.extend(data)
+        end = buf.rfind("\n")
+        if end < 0:
+            return []
+        lines = str(buf[:end]).split("\n")
+        del buf[:end + 1]
         if DEBUG:
             print "received lines: %s" % lines
         return lines
@@ -198,69 +233,62 @@ class OnkyoClient:
                 print "Attempting to reconnect to controller socket"
                 self.establish_connection(True)
                 return False
-            for line in lines:
-                line = line.split(":")
-                # first check for errors
-                if line[0] == "ERROR":
-                    print "Error received: %s" % line
-                    #raise OnkyoClientException("Error received: %s" % line)
-                # primary zone processing
-                elif line[1] == "power":
-                    if line[2] == "on":
-                        self.status['power'] = True
-                    else:
-                        self.status['power'] = False
-                elif line[1] == "mute":
-                    if line[2] == "on":
-                        self.status['mute'] = True
-                    else:
-                        self.status['mute'] = False
-                # For everything else, we use the literal string returned after
-                # the second colon. Ensure we don't lose any actual colons by
-                # rejoining after the second colon.
-                elif line[1] == "mode":
-                    self.status['mode'] = ":".join(line[2:])
-                elif line[1] == "volume":
-                    self.status['volume'] = int(line[2])
-                elif line[1] == "input":
-                    self.status['input'] = ":".join(line[2:])
-                elif line[1] == "tune":
-                    self.status['tune'] = ":".join(line[2:])
-                elif line[1] == "sleep":
-                    self.status['sleep'] = int(line[2])
-                # zone 2 processing
-                elif line[1] == "zone2power":
-                    if line[2] == "on":
-                        self.status['zone2power'] = True
-                    else:
-                        self.status['zone2power'] = False
-                elif line[1] == "zone2mute":
-                    if line[2] == "on":
-                        self.status['zone2mute'] = True
-                    else:
-                        self.status['zone2mute'] = False
-                elif line[1] == "zone2mode":
-                    self.status['zone2mode'] = line[2]
-                elif line[1] == "zone2volume":
-                    self.status['zone2volume'] = int(line[2])
-                elif line[1] == "zone2input":
-                    self.status['zone2input'] = line[2]
-                elif line[1] == "zone2tune":
-                    self.status['zone2tune'] = line[2]
-                elif line[1] == "zone2sleep":
-                    self.status['zone2sleep'] = int(line[2])
-                # not sure what we have if we get here
-                else:
-                    print "Unrecognized response: %s" % line
-
-                # notify the pipe that we processed input
-                os.write(self._pipewrite, '%r' % line)
+            self._processlines(lines)
 
         # return true in any case if we made it here
         return True
 
-    def get_notify_fd(self):
-        return self._piperead
+    def _processlines(self, lines):
+        for line in lines:
+            # first check for errors
+            if line.startswith("ERROR"):
+                print "Error received: %s" % line
+                #raise OnkyoClientException("Error received: %s" % line)
+            else:
+                try:
+                    decoded = decode_line(line)
+                except ValueError:
+                    decoded = None
+                if decoded:
+                    self.status[decoded[0]] = decoded[1]
+                    self._mark_changed(decoded[0])
+                else:
+                    # not sure what we have if we get here
+                    print "Unrecognized response: %s" % line
+
+        # let the update callback see these lines on the next idle
+        self._received.extend(lines)
+        if lines:
+            self._schedule_update()
+
+    def _mark_changed(self, key):
+        self._changed.add(key)
+        self._schedule_update()
+
+    def _schedule_update(self):
+        # coalesce everything processed this main loop iteration into a
+        # single callback invocation
+        if self._idleevent < 0:
+            self._idleevent = gobject.idle_add(self._dispatch_update)
+
+    def _dispatch_update(self):
+        self._idleevent = -1
+        changed = self._changed
+        received = self._received
+        self._changed = set()
+        self._received = []
+        if self._updatecallback:
+            self._updatecallback(changed, received)
+        # this is a one-shot idle source
+        return False
+
+    def set_update_callback(self, callback):
+        """
+        Register a function to be called from the main loop with the set of
+        status fields touched and the list of lines received since the last
+        call. Bursts of status lines result in a single call.
+        """
+        self._updatecallback = callback
 
     def querystatus(self):
         self._writeline("status")
@@ -300,7 +328,7 @@ class OnkyoClient:
         if intval < 0 or intval > 100:
             raise CommandException("Volume out of range: %d" % intval)
         self.status['volume'] = intval
-        self._writeline("volume %d" % intval)
+        self._writelatest('volume', "volume %d" % intval)
 
     def setinput(self, inp):
         valid_inputs = [ 'dvr', 'vcr', 'cable', 'sat', 'tv', 'aux', 'dvd',
@@ -365,7 +393,7 @@ class OnkyoClient:
         if intval < 0 or intval > 100:
             raise CommandException("Volume out of range: %d" % intval)
         self.status['zone2volume'] = intval
-        self._writeline("zone2volume %d" % intval)
+        self._writelatest('zone2volume', "zone2volume %d" % intval)
 
     def setzone2input(self, inp):
         valid_inputs = [ 'dvr', 'vcr', 'cable', 'sat', 'tv', 'aux', 'dvd',
@@ -414,9 +442,8 @@ class OnkyoFrontend:
         # make our GTK window
         self.setup_gui()
 
-        # kick off our update function, listening on the client notify FD
-        gobject.io_add_watch(self.client.get_notify_fd(), gobject.IO_IN,
-                self.update_controls)
+        # kick off our update function, called once per batch of changes
+        self.client.set_update_callback(self.update_controls)
 
     def set_combobox_text(self, combobox, text):
         model = combobox.get_model()
@@ -561,31 +588,30 @@ class OnkyoFrontend:
         except CommandException, e:
             self.errorbox(e.args[0])
 
-    def update_controls(self, fd, condition):
-        # suck our input, put it in the console
-        data = os.read(fd, 256)
-        buf = self.console.get_buffer()
-        buf.insert(buf.get_end_iter(), "%s\n" % data)
-        self.console.scroll_to_iter(buf.get_end_iter(), 0)
+    def update_controls(self, changed, lines):
+        # put our input in the console
+        if lines:
+            buf = self.console.get_buffer()
+            buf.insert(buf.get_end_iter(), "%s\n" % "\n".join(lines))
+            self.console.scroll_to_iter(buf.get_end_iter(), 0)
         # convenience variable
         client_status = self.client.status
-        status_updated = dict()
+        status_updated = set()
         # record our client statues in known_status so we don't do unnecessary
-        # updates when we call each of the set_* methods
-        for item in STATUSES:
+        # updates when we call each of the set_* methods; only the fields the
+        # client touched since our last call need to be looked at
+        for item in changed:
+            if item not in self.known_status:
+                continue
             if self.known_status[item] != client_status[item]:
                 self.known_status[item] = client_status[item]
-                status_updated[item] = True
-            else:
-                status_updated[item] = False
-        new_epoch = self.known_status['epoch'] != client_status['epoch']
-        if new_epoch:
-            self.known_status['epoch'] = client_status['epoch']
+                status_updated.add(item)
+        new_epoch = 'epoch' in status_updated
 
 
         # make sure to call correct method for each type of control
         # check for None value as it means we don't know the status
-        if client_status['power'] != None and status_updated['power'] == True:
+        if client_status['power'] != None and 'power' in status_updated:
             self.power.set_active(client_status['power'])
             self.set_main_sensitive(client_status['power'])
             # query for a status update if the receiver power switched on
@@ -598,24 +624,24 @@ class OnkyoFrontend:
         elif client_status['power'] == True and new_epoch:
             self.client.querystatus()
             self.client.querysleep()
-        if client_status['mute'] != None and status_updated['mute'] == True:
+        if client_status['mute'] != None and 'mute' in status_updated:
             self.mute.set_active(client_status['mute'])
-        if client_status['mode'] != None and status_updated['mode'] == True:
+        if client_status['mode'] != None and 'mode' in status_updated:
             self.set_combobox_text(self.mode, client_status['mode'])
-        if client_status['volume'] != None and status_updated['volume'] == True:
+        if client_status['volume'] != None and 'volume' in status_updated:
             self.volume.set_value(client_status['volume'])
-        if client_status['input'] != None and status_updated['input'] == True:
+        if client_status['input'] != None and 'input' in status_updated:
             self.set_combobox_text(self.input, client_status['input'])
-        if client_status['tune'] != None and status_updated['tune'] == True:
+        if client_status['tune'] != None and 'tune' in status_updated:
             self.tune.set_text(client_status['tune'])
-        if client_status['sleep'] != None and status_updated['sleep'] == True:
+        if client_status['sleep'] != None and 'sleep' in status_updated:
             if client_status['sleep'] == 0:
                 self.sleep.set_text("Off")
             else:
                 self.sleep.set_text("%d min" % client_status['sleep'])
 
         if client_status['zone2power'] != None and \
-                status_updated['zone2power'] == True:
+                'zone2power' in status_updated:
             self.zone2power.set_active(client_status['zone2power'])
             self.set_zone2_sensitive(client_status['zone2power'])
             if client_status['zone2power'] == True:
@@ -626,20 +652,20 @@ class OnkyoFrontend:
         elif client_status['zone2power'] == True and new_epoch:
             self.client.queryzone2status()
         if client_status['zone2mute'] != None and \
-                status_updated['zone2mute'] == True:
+                'zone2mute' in status_updated:
             self.zone2mute.set_active(client_status['zone2mute'])
         # no zone2 mode
         if client_status['zone2volume'] != None and \
-                status_updated['zone2volume'] == True:
+                'zone2volume' in status_updated:
             self.zone2volume.set_value(client_status['zone2volume'])
         if client_status['zone2input'] != None and \
-                status_updated['zone2input'] == True:
+                'zone2input' in status_updated:
             self.set_combobox_text(self.zone2input, client_status['zone2input'])
         if client_status['zone2tune'] != None and \
-                status_updated['zone2tune'] == True:
+                'zone2tune' in status_updated:
             self.zone2tune.set_text(client_status['zone2tune'])
         if client_status['zone2sleep'] != None and \
-                status_updated['zone2sleep'] == True:
+                'zone2sleep' in status_updated:
             if client_status['zone2sleep'] == 0:
                 self.zone2sleep.set_text("Off")
             else:
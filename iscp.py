@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Codec for the ISCP and eISCP receiver control protocols.
+
+ISCP is what Onkyo receivers speak on their serial port: "!1", a three
+letter command and its argument, e.g. "!1MVL28". Receivers end their
+messages with EOF (0x1A), CR LF or both; we end ours with CR LF. eISCP is
+the same over TCP (port 60128), with every message in a packet behind a
+16 byte header giving the header and message lengths.
+
+Besides framing, this turns receiver messages into the "OK:key:value"
+lines the daemon sends its clients, exactly like parse_status() in
+receiver.c does, and builds the raw volume, tuner, preset and other codes
+like the command handlers in command.c do. Lines are returned without
+their newline.
+
+For whole buffers, such as a raw dump of a serial line,
+decode_frames(), decode_packets() and decode_file() work in one pass:
+messages are found by a single regular expression scan (or by reading the
+packet headers in place), and the lines for a message are shared from a
+cache, so the only object made per message is the bytes of its code.
+FrameDecoder and PacketDecoder do the same for data arriving in pieces.
+
+iter_capture() reads the capture files written by the daemon's --log
+option, and decode_capture() turns what the receivers sent in one into
+status lines.
+"""
+
+import collections
+import mmap
+import re
+import struct
+
+START = b"!1"
+EOF = b"\x1a"
+# the end of the messages we send
+END_SEND = b"\r\n"
+# any of these ends a message from a receiver
+END_CHARS = b"\x1a\r\n"
+
+EISCP_PORT = 60128
+MAGIC = b"ISCP"
+VERSION = 1
+# magic, header size, message size, version, three reserved bytes
+HEADER = struct.Struct(">4sIIB3x")
+
+CAPTURE_MAGIC = b"ONKYOCAP"
+CAPTURE_VERSION = 1
+# magic, version, header size, wall clock and monotonic time at opening
+CAPTURE_HEADER = struct.Struct(">8sIIIIII")
+# payload size, monotonic time, direction, receiver number and type, one
+# reserved byte
+CAPTURE_RECORD = struct.Struct(">IIIcBcx")
+
+# one read from ('r') or write to ('t') a receiver; time is the wall clock
+# time in seconds, kind is 's' for a serial and 'n' for a network receiver
+CaptureRecord = collections.namedtuple('CaptureRecord',
+        'time direction receiver kind data')
+
+# everything after the start characters up to an end character; this is
+# how receiver.c frames a serial stream and then finds the start of each
+# message in it
+_FRAME_RE = re.compile(rb"!1([^\x1a\r\n]*)[\x1a\r\n]")
+# the same within an eISCP packet, where the end characters are optional
+_PAYLOAD_RE = re.compile(rb"!1([^\x1a\r\n]*)")
+
+INPUTS = [
+    ('00', 'DVR'), ('01', 'Cable'), ('02', 'TV'), ('03', 'AUX'),
+    ('04', 'AUX2'), ('05', 'PC'), ('10', 'DVD'), ('20', 'Tape'),
+    ('22', 'Phono'), ('23', 'CD'), ('24', 'FM Tuner'), ('25', 'AM Tuner'),
+    ('26', 'Tuner'), ('27', 'Music Server'), ('28', 'Internet Radio'),
+    ('29', 'USB'), ('2A', 'USB Rear'), ('40', 'Port'), ('30', 'Multichannel'),
+    ('31', 'XM Radio'), ('32', 'Sirius Radio'),
+    ('FF', 'Audyssey Speaker Setup'),
+]
+
+ZONE_INPUTS = [
+    ('00', 'DVR'), ('01', 'Cable'), ('02', 'TV'), ('03', 'AUX'),
+    ('04', 'AUX2'), ('10', 'DVD'), ('20', 'Tape'), ('22', 'Phono'),
+    ('23', 'CD'), ('24', 'FM Tuner'), ('25', 'AM Tuner'), ('26', 'Tuner'),
+    ('30', 'Multichannel'), ('31', 'XM Radio'), ('32', 'Sirius Radio'),
+    ('7F', 'Off'), ('80', 'Source'),
+]
+
+MODES = [
+    ('00', 'Stereo'), ('01', 'Direct'), ('07', 'Mono Movie'),
+    ('08', 'Orchestra'), ('09', 'Unplugged'), ('0A', 'Studio-Mix'),
+    ('0B', 'TV Logic'), ('0C', 'All Channel Stereo'),
+    ('0D', 'Theater-Dimensional'), ('0F', 'Mono'), ('10', 'Test Tone'),
+    ('11', 'Pure Audio'), ('13', 'Full Mono'),
+    ('15', 'DTS Surround Sensation'), ('16', 'Audyssey DSX'),
+    ('40', 'Straight Decode'), ('41', 'Dolby EX/DTS ES'),
+    ('42', 'THX Cinema'), ('43', 'THX Surround EX'), ('44', 'THX Music'),
+    ('45', 'THX Games'), ('80', 'Pro Logic IIx Movie'),
+    ('81', 'Pro Logic IIx Music'), ('82', 'Neo:6 Cinema'),
+    ('83', 'Neo:6 Music'), ('84', 'PLIIx THX Cinema'),
+    ('85', 'Neo:6 THX Cinema'), ('86', 'Pro Logic IIx Game'),
+    ('88', 'Neural THX'),
+]
+
+_OFFON = [ ('00', 'off'), ('01', 'on') ]
+
+# prefix, status key, (argument, value) pairs, whether "N/A" is an error
+# for this key; the statuses table of receiver.c
+_TABLES = [
+    ('AMT', 'mute', _OFFON, False),
+    ('SLI', 'input', INPUTS, False),
+    ('LMD', 'mode', MODES, True),
+    ('MEM', 'memory', [ ('LOCK', 'locked'), ('UNLK', 'unlocked') ], True),
+    ('ZMT', 'zone2mute', _OFFON, False),
+    ('ZVL', 'zone2volume', [], True),
+    ('SLZ', 'zone2input', ZONE_INPUTS, False),
+    ('MT3', 'zone3mute', _OFFON, False),
+    ('VL3', 'zone3volume', [], True),
+    ('SL3', 'zone3input', ZONE_INPUTS, False),
+    ('DIF', 'display', [ ('00', 'Volume'), ('01', 'Mode'),
+            ('02', 'Digital Format') ], True),
+    ('DIM', 'dimmer', [ ('00', 'Bright'), ('01', 'Dim'), ('02', 'Dark'),
+            ('03', 'Shut-off'), ('08', 'Bright (LED off)') ], True),
+    ('LTN', 'latenight', [ ('00', 'off'), ('01', 'low'), ('02', 'high') ],
+            False),
+    ('RAS', 're-eq', _OFFON, False),
+    ('ADY', 'audyssey', _OFFON, False),
+    ('ADQ', 'dynamiceq', _OFFON, False),
+    ('HDO', 'hdmiout', _OFFON, False),
+    ('RES', 'resolution', [ ('00', 'Through'), ('01', 'Auto'),
+            ('02', '480p'), ('03', '720p'), ('04', '1080i'),
+            ('05', '1080p') ], False),
+    ('SLA', 'audioselector', [ ('00', 'Auto'), ('01', 'Multichannel'),
+            ('02', 'Analog'), ('03', 'iLink'), ('04', 'HDMI') ], False),
+    ('TGA', 'triggera', _OFFON, True),
+    ('TGB', 'triggerb', _OFFON, True),
+    ('TGC', 'triggerc', _OFFON, True),
+    ('PWR', 'power', _OFFON, False),
+    ('ZPW', 'zone2power', _OFFON, False),
+    ('PW3', 'zone3power', _OFFON, False),
+]
+
+# raw code -> status line, for every status that is a plain lookup
+STATUSES = {}
+for _prefix, _key, _values, _na in _TABLES:
+    for _arg, _value in _values:
+        STATUSES[_prefix + _arg] = "OK:%s:%s" % (_key, _value)
+    if _na:
+        STATUSES[_prefix + 'N/A'] = "ERROR:%s:N/A" % _key
+del _prefix, _key, _values, _na, _arg, _value
+
+# zone -> prefixes of its volume, tuner and preset commands
+_ZONE_PREFIXES = {
+    1: ('MVL', 'TUN', 'PRS'),
+    2: ('ZVL', 'TUZ', 'PRZ'),
+    3: ('VL3', 'TU3', 'PR3'),
+}
+_VOLUME_KEYS = {
+    'M': ('volume', 'dbvolume'),
+    'Z': ('zone2volume', 'zone2dbvolume'),
+    'V': ('zone3volume', 'zone3dbvolume'),
+}
+_ZONE_KEYS = { 'Z': 'zone2', '3': 'zone3' }
+
+_NUMBER_RE = {
+    10: re.compile(r"\s*[+-]?[0-9]*"),
+    16: re.compile(r"\s*[+-]?[0-9A-Fa-f]*"),
+}
+
+def _strtol(text, base):
+    """The number text starts with, 0 if none, like C's strtol()."""
+    number = _NUMBER_RE[base].match(text).group().strip()
+    if number in ('', '+', '-'):
+        return 0
+    return int(number, base)
+
+def _c_div(a, b):
+    """Integer division truncating toward zero, like C."""
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def status_lines(code):
+    """
+    Translate a receiver message without its framing, e.g. "MVL28", into
+    the lines the daemon sends its clients for it, e.g.
+    ("OK:dbvolume:-42", "OK:volume:40"). Unknown messages come out as
+    "OK:todo:" lines, like from the daemon.
+    """
+    line = STATUSES.get(code)
+    if line is not None:
+        return (line,)
+
+    if code[:3] in ('MVL', 'ZVL', 'VL3'):
+        level = _strtol(code[3:], 16)
+        key, dbkey = _VOLUME_KEYS[code[0]]
+        return ("OK:%s:%d" % (dbkey, level - 82), "OK:%s:%d" % (key, level))
+    if code[:2] == 'TU':
+        freq = _strtol(code[3:], 10)
+        key = _ZONE_KEYS.get(code[2:3], '') + 'tune'
+        if freq > 8000:
+            return ("OK:%s:%d.%d FM" % (key, _c_div(freq, 100),
+                    _c_div(freq, 10) % 10),)
+        return ("OK:%s:%d AM" % (key, freq),)
+    if code[:3] in ('PRS', 'PRZ', 'PR3'):
+        key = _ZONE_KEYS.get(code[2], '') + 'preset'
+        return ("OK:%s:%d" % (key, _strtol(code[3:], 16)),)
+    if code[:3] == 'SLP':
+        return ("OK:sleep:%d" % _strtol(code[3:], 16),)
+    if code[:3] == 'SWL':
+        return ("OK:swlevel:%+d" % _strtol(code[3:], 16),)
+    if code[:3] == 'AVS':
+        return ("OK:avsync:%d" % _c_div(_strtol(code[3:], 10), 10),)
+    return ("OK:todo:%s" % code,)
+
+# raw code bytes -> status lines; receivers repeat the same few hundred
+# messages over and over, so this stays small
+_cache = {}
+_CACHE_LIMIT = 65536
+
+def _lines_for(code):
+    lines = _cache.get(code)
+    if lines is None:
+        if len(_cache) >= _CACHE_LIMIT:
+            _cache.clear()
+        lines = _cache[code] = status_lines(code.decode('latin-1'))
+    return lines
+
+def encode_frame(code):
+    """Frame a command for the serial port, e.g. "MVL28" -> b"!1MVL28\\r\\n"."""
+    if isinstance(code, str):
+        code = code.encode('ascii')
+    return START + code + END_SEND
+
+def encode_packet(code):
+    """Put a command in an eISCP packet, header and all."""
+    frame = encode_frame(code)
+    return HEADER.pack(MAGIC, HEADER.size, len(frame), VERSION) + frame
+
+def decode_frame(frame):
+    """
+    The code in a single serial message, e.g. b"!1MVL28\\x1a" -> "MVL28";
+    None if there is no message in it.
+    """
+    match = _PAYLOAD_RE.search(frame)
+    if match is None:
+        return None
+    return match.group(1).decode('latin-1')
+
+def split_frames(buf):
+    """
+    The codes of every complete message in a buffer of serial data, e.g.
+    [b"PWR01", b"MVL28"]. buf can be bytes, a bytearray or an mmap.
+    Returns the list of codes and the number of bytes used; a message not
+    yet ended is left for the next call.
+    """
+    used = 0
+    for end in END_CHARS:
+        used = max(used, buf.rfind(bytes((end,))) + 1)
+    return _FRAME_RE.findall(buf), used
+
+def decode_frames(buf):
+    """
+    Translate every complete message in a buffer of serial data into status
+    lines. Returns the list of lines and the number of bytes used, like
+    split_frames().
+    """
+    lines = []
+    extend = lines.extend
+    lookup = _cache.get
+    codes, used = split_frames(buf)
+    for code in codes:
+        found = lookup(code)
+        extend(found if found is not None else _lines_for(code))
+    return lines, used
+
+def iter_packets(buf, pos=0):
+    """
+    Yield the start and end offsets of the message in each complete eISCP
+    packet of buf, from pos on, without copying anything. Data that is not
+    a packet is skipped up to the next packet header. Once no complete
+    packet is left, yields (None, offset of the rest).
+    """
+    size = len(buf)
+    while size - pos >= HEADER.size:
+        magic, header_size, length, version = HEADER.unpack_from(buf, pos)
+        if magic != MAGIC or header_size < HEADER.size:
+            # lost track of the packets; find the next header
+            pos = buf.find(MAGIC, pos + 1)
+            if pos < 0:
+                pos = size - len(MAGIC) + 1
+            continue
+        start = pos + header_size
+        if start + length > size:
+            break
+        pos = start + length
+        yield start, pos
+    yield None, pos
+
+def decode_packets(buf):
+    """
+    Translate the messages of every complete eISCP packet in buf into
+    status lines, like decode_frames(). Returns the list of lines and the
+    number of bytes used.
+    """
+    lines = []
+    extend = lines.extend
+    lookup = _cache.get
+    search = _PAYLOAD_RE.search
+    for start, end in iter_packets(buf):
+        if start is None:
+            return lines, end
+        match = search(buf, start, end)
+        if match is None:
+            continue
+        code = match.group(1)
+        found = lookup(code)
+        extend(found if found is not None else _lines_for(code))
+    return lines, len(buf)
+
+def decode_file(path, packets=False):
+    """
+    Translate all messages in a file, e.g. a dump of a serial line, into
+    status lines. The file is mapped into memory rather than read.
+    """
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file can't be mapped
+            return []
+    with buf:
+        if packets:
+            return decode_packets(buf)[0]
+        return decode_frames(buf)[0]
+
+def iter_capture(path):
+    """
+    Yield the records of a capture file written by the daemon's --log
+    option as CaptureRecord tuples, in the order they were captured. A
+    record cut short at the end of the file is left out.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(CAPTURE_HEADER.size)
+        if len(header) < CAPTURE_HEADER.size:
+            raise ValueError("%s: not a capture file" % path)
+        magic, version, size, real_sec, real_nsec, mono_sec, mono_nsec = \
+                CAPTURE_HEADER.unpack(header)
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            raise ValueError("%s: not a capture file" % path)
+        f.seek(size)
+        # record times are monotonic; anchor them to the wall clock
+        offset = real_sec + real_nsec / 1e9 - mono_sec - mono_nsec / 1e9
+        while True:
+            record = f.read(CAPTURE_RECORD.size)
+            if len(record) < CAPTURE_RECORD.size:
+                return
+            length, sec, nsec, direction, receiver, kind = \
+                    CAPTURE_RECORD.unpack(record)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield CaptureRecord(sec + nsec / 1e9 + offset,
+                    direction.decode('ascii'), receiver,
+                    kind.decode('ascii'), data)
+
+def decode_capture(path):
+    """
+    Translate what the receivers sent in a capture file into status lines.
+    Returns a list of (time, receiver, line) tuples, the time being that of
+    the read that completed the message.
+    """
+    decoders = {}
+    result = []
+    for record in iter_capture(path):
+        if record.direction != 'r':
+            continue
+        decoder = decoders.get(record.receiver)
+        if decoder is None:
+            decoder = PacketDecoder() if record.kind == 'n' else FrameDecoder()
+            decoders[record.receiver] = decoder
+        result.extend((record.time, record.receiver, line)
+                for line in decoder.feed(record.data))
+    return result
+
+class FrameDecoder:
+    """
+    Translate serial data arriving in pieces into status lines, keeping a
+    message that is not complete yet until the rest of it is fed.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        self._buf.extend(data)
+        lines, used = decode_frames(self._buf)
+        del self._buf[:used]
+        return lines
+
+class PacketDecoder(FrameDecoder):
+    """The same as FrameDecoder for an eISCP connection."""
+
+    def feed(self, data):
+        self._buf.extend(data)
+        lines, used = decode_packets(self._buf)
+        del self._buf[:used]
+        return lines
+
+def _ranged(prefix, value, lower, upper, fmt):
+    value = int(value)
+    if value < lower or value > upper:
+        raise ValueError("%s value out of range: %d" % (prefix, value))
+    return prefix + fmt % value
+
+def volume(level, zone=1):
+    """The code for a volume level, 0 to 100, e.g. "MVL28"."""
+    return _ranged(_ZONE_PREFIXES[zone][0], level, 0, 100, "%02X")
+
+def dbvolume(db, zone=1):
+    """The code for a volume in dB, -82 to 18."""
+    db = int(db)
+    if db < -82 or db > 18:
+        raise ValueError("%s value out of range: %d dB" %
+                (_ZONE_PREFIXES[zone][0], db))
+    return volume(db + 82, zone)
+
+def preset(number, zone=1):
+    """The code for a tuner preset, 0 to 40."""
+    return _ranged(_ZONE_PREFIXES[zone][2], number, 0, 40, "%02X")
+
+def sleep(minutes):
+    """The code for the sleep timer, 0 to 90 minutes; None for off."""
+    if minutes is None:
+        return "SLPOFF"
+    return _ranged("SLP", minutes, 0, 90, "%02X")
+
+def avsync(ms):
+    """The code for an audio delay, 0 to 250 ms."""
+    return _ranged("AVS", ms, 0, 250, "%03d0")
+
+def swlevel(level):
+    """The code for a subwoofer level, -15 to 12."""
+    level = int(level)
+    if level < -15 or level > 12:
+        raise ValueError("SWL value out of range: %d" % level)
+    if level == 0:
+        return "SWL00"
+    return "SWL%s%X" % ('+' if level > 0 else '-', abs(level))
+
+def tune(freq, zone=1):
+    """
+    The code for a tuner frequency: FM as "97.9" or 97.9 (87.5 to 107.9),
+    AM as "780" or 780 (530 to 1710).
+    """
+    prefix = _ZONE_PREFIXES[zone][1]
+    if isinstance(freq, float):
+        freq = "%.1f" % freq
+    freq = str(freq)
+    if '.' in freq:
+        whole, _, tenths = freq.partition('.')
+        whole, tenths = int(whole), int(tenths)
+        if tenths < 0 or tenths > 9 or (whole <= 87 and tenths < 5) or \
+                whole >= 108:
+            raise ValueError("FM frequency out of range: %s" % freq)
+        return "%s%05d" % (prefix, whole * 100 + tenths * 10)
+    freq = int(freq)
+    if freq < 530 or freq > 1710:
+        raise ValueError("AM frequency out of range: %d" % freq)
+    return "%s%05d" % (prefix, freq)
+
+# vim: set ts=4 sw=4 et:
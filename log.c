@@ -0,0 +1,327 @@
+/*
+ *  log.c - buffered, leveled logging
+ *
+ *  Copyright (c) 2026 the onkyocontrol authors
+ *
+ *  This program is free software; you can redistribute it and/or modify
+ *  it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation; either version 2 of the License, or
+ *  (at your option) any later version.
+ *
+ *  This program is distributed in the hope that it will be useful,
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ *  GNU General Public License for more details.
+ *
+ *  You should have received a copy of the GNU General Public License
+ *  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#define _GNU_SOURCE 1 /* localtime_r, O_CLOEXEC, SOCK_NONBLOCK */
+
+#include <stdarg.h>
+#include <stdio.h>
+#include <string.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <errno.h>
+#include <time.h>
+
+#include "onkyo.h"
+
+/** The socket the local syslog daemon reads messages from */
+#define SYSLOG_PATH "/dev/log"
+
+/** syslog facility LOG_DAEMON, already shifted into place */
+#define SYSLOG_DAEMON (3 << 3)
+
+/** Longest single log message, including any prefix */
+#define LOG_LINE_SIZE 512
+
+/** Where log messages end up */
+enum log_target {
+	TARGET_NONE,   /**< nowhere */
+	TARGET_STREAM, /**< stderr, as they are */
+	TARGET_FILE,   /**< a file, with a time stamp and level */
+	TARGET_SYSLOG, /**< the syslog socket, one datagram each */
+};
+
+static const char * const level_names[] = {
+	"error", "warn", "info", "debug",
+};
+
+/** syslog severities of our levels */
+static const int syslog_levels[] = { 3, 4, 6, 7 };
+
+int log_threshold = LEVEL_INFO;
+static enum log_level log_level = LEVEL_INFO;
+/** level to go back to when debug logging is toggled off again */
+static enum log_level log_saved_level = LEVEL_INFO;
+static enum log_target log_target = TARGET_STREAM;
+static int log_fd = STDERR_FILENO;
+
+/** Messages waiting to be written; the event loop drains this every time
+ * around, so the space after log_end is nearly always all there is. */
+static char log_buf[LOG_BUF_SIZE];
+static size_t log_start = 0;
+static size_t log_end = 0;
+/** messages thrown away because log_buf was full */
+static unsigned long log_dropped = 0;
+
+/** time stamp for file output, only formatted once a second */
+static time_t stamp_time = 0;
+static char stamp[32];
+
+static void update_threshold(void)
+{
+	log_threshold = log_target == TARGET_NONE ? -1 : (int)log_level;
+}
+
+/**
+ * Send log messages somewhere else. Messages already waiting are written
+ * to the old destination first.
+ * @param dest "stderr", "syslog", "none", or the path of a file to append to
+ * @return 0 on success, -1 if the destination could not be opened; the
+ * old destination is kept then
+ */
+int log_open(const char *dest)
+{
+	enum log_target target;
+	int fd;
+
+	if(strcmp(dest, "stderr") == 0) {
+		target = TARGET_STREAM;
+		fd = STDERR_FILENO;
+	} else if(strcmp(dest, "none") == 0) {
+		target = TARGET_NONE;
+		fd = -1;
+	} else if(strcmp(dest, "syslog") == 0) {
+		struct sockaddr_un addr;
+
+		target = TARGET_SYSLOG;
+		fd = socket(AF_UNIX, SOCK_DGRAM | SOCK_NONBLOCK | SOCK_CLOEXEC, 0);
+		if(fd == -1) {
+			perror("socket()");
+			return -1;
+		}
+		memset(&addr, 0, sizeof(struct sockaddr_un));
+		addr.sun_family = AF_UNIX;
+		strcpy(addr.sun_path, SYSLOG_PATH);
+		if(connect(fd, (struct sockaddr *)&addr,
+					sizeof(struct sockaddr_un)) == -1) {
+			perror(SYSLOG_PATH);
+			close(fd);
+			return -1;
+		}
+	} else {
+		target = TARGET_FILE;
+		fd = open(dest, O_WRONLY | O_CREAT | O_APPEND | O_NONBLOCK | O_CLOEXEC,
+				S_IRUSR | S_IWUSR | S_IRGRP | S_IROTH);
+		if(fd == -1) {
+			perror(dest);
+			return -1;
+		}
+	}
+
+	log_close();
+	log_target = target;
+	log_fd = fd;
+	update_threshold();
+	return 0;
+}
+
+/**
+ * Write out what we can of the waiting messages and stop logging.
+ */
+void log_close(void)
+{
+	log_flush();
+	if(log_fd > STDERR_FILENO)
+		close(log_fd);
+	log_fd = -1;
+	log_target = TARGET_NONE;
+	log_start = log_end = 0;
+	update_threshold();
+}
+
+void log_set_level(enum log_level level)
+{
+	log_level = level;
+	update_threshold();
+}
+
+enum log_level log_get_level(void)
+{
+	return log_level;
+}
+
+/**
+ * Switch debug logging on, or back off to the level that was set before.
+ */
+void log_toggle_debug(void)
+{
+	if(log_level == LEVEL_DEBUG) {
+		log_set_level(log_saved_level == LEVEL_DEBUG ?
+				LEVEL_INFO : log_saved_level);
+	} else {
+		log_saved_level = log_level;
+		log_set_level(LEVEL_DEBUG);
+	}
+	log_msg(LEVEL_INFO, "log level now %s", log_level_name(log_level));
+}
+
+const char *log_level_name(enum log_level level)
+{
+	return level_names[level];
+}
+
+/**
+ * Look up a log level by name.
+ * @param name the level name, e.g. "debug"
+ * @return the level, -1 if there is no level of that name
+ */
+int log_parse_level(const char *name)
+{
+	int i;
+	for(i = LEVEL_ERROR; i <= LEVEL_DEBUG; i++) {
+		if(strcmp(name, level_names[i]) == 0)
+			return i;
+	}
+	return -1;
+}
+
+/**
+ * Copy a message into the buffer, making room at the end if needed.
+ * @return 0 on success, -1 if the buffer is too full
+ */
+static int log_append(const char *msg, size_t len)
+{
+	if(LOG_BUF_SIZE - log_end < len) {
+		if(LOG_BUF_SIZE - (log_end - log_start) < len)
+			return -1;
+		memmove(log_buf, log_buf + log_start, log_end - log_start);
+		log_end -= log_start;
+		log_start = 0;
+	}
+	memcpy(log_buf + log_end, msg, len);
+	log_end += len;
+	return 0;
+}
+
+/**
+ * Start a log line with what the destination wants in front of every
+ * message: a syslog header, or a time stamp and level for a file.
+ * @param line where to write the prefix, at least LOG_LINE_SIZE bytes
+ * @param level the level of the message
+ * @return the length of the prefix
+ */
+static size_t log_prefix(char *line, enum log_level level)
+{
+	if(log_target == TARGET_SYSLOG) {
+		return (size_t)sprintf(line, "<%d>onkyocontrol: ",
+				SYSLOG_DAEMON | syslog_levels[level]);
+	} else if(log_target == TARGET_FILE) {
+		time_t now = time(NULL);
+		if(now != stamp_time) {
+			struct tm tm;
+			localtime_r(&now, &tm);
+			strftime(stamp, sizeof(stamp), "%Y-%m-%d %H:%M:%S", &tm);
+			stamp_time = now;
+		}
+		return (size_t)sprintf(line, "%s %s: ", stamp, level_names[level]);
+	}
+	return 0;
+}
+
+/**
+ * Log a message, if its level is enabled. The message is only formatted
+ * and buffered here; it is written out by log_flush(), so this never
+ * blocks. Use log_wants() first if building the arguments is any work.
+ * @param level the level of the message
+ * @param fmt printf style format of the message; a trailing newline is
+ * optional
+ */
+void log_msg(enum log_level level, const char *fmt, ...)
+{
+	char line[LOG_LINE_SIZE];
+	size_t len;
+	va_list args;
+	int n;
+
+	if(!log_wants(level))
+		return;
+
+	len = log_prefix(line, level);
+	va_start(args, fmt);
+	n = vsnprintf(line + len, LOG_LINE_SIZE - len, fmt, args);
+	va_end(args);
+	if(n < 0)
+		return;
+	len += (size_t)n;
+	if(len > LOG_LINE_SIZE - 2)
+		len = LOG_LINE_SIZE - 2;
+	/* exactly one newline, whatever the caller passed */
+	while(len && (line[len - 1] == '\n' || line[len - 1] == '\r'))
+		len--;
+	line[len++] = '\n';
+
+	if(log_append(line, len) == -1)
+		log_dropped++;
+}
+
+/**
+ * Write out as much of the waiting log messages as the destination takes
+ * without blocking. This is called from the event loop.
+ * @return 1 if messages are still waiting, 0 otherwise
+ */
+int log_flush(void)
+{
+	if(log_dropped && log_target != TARGET_NONE) {
+		char note[LOG_LINE_SIZE];
+		size_t len = log_prefix(note, LEVEL_WARN);
+		len += (size_t)sprintf(note + len, "%lu log messages dropped\n",
+				log_dropped);
+		if(log_append(note, len) == 0)
+			log_dropped = 0;
+	}
+
+	while(log_start < log_end) {
+		ssize_t n;
+
+		if(log_target == TARGET_SYSLOG) {
+			/* one datagram per message, without its newline */
+			char *msg = log_buf + log_start;
+			char *eol = memchr(msg, '\n', log_end - log_start);
+			n = send(log_fd, msg, (size_t)(eol - msg),
+					MSG_DONTWAIT | MSG_NOSIGNAL);
+			if(n >= 0)
+				n = eol - msg + 1;
+		} else if(log_fd >= 0) {
+			n = write(log_fd, log_buf + log_start, log_end - log_start);
+		} else {
+			n = (ssize_t)(log_end - log_start);
+		}
+
+		if(n < 0) {
+			if(errno == EAGAIN || errno == EWOULDBLOCK)
+				break;
+			if(errno == EINTR)
+				continue;
+			/* nowhere to put them; don't try again and again */
+			log_start = log_end;
+			break;
+		}
+		log_start += (size_t)n;
+	}
+
+	if(log_start == log_end) {
+		log_start = log_end = 0;
+		return 0;
+	}
+	return 1;
+}
+
+/* vim: set ts=4 sw=4 noet: */
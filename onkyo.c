@@ -24,9 +24,14 @@
 #define _XOPEN_SOURCE 600 /* SA_RESTART, strdup */
 
 #include <stdlib.h>
+#include <stdarg.h>
+#include <stddef.h> /* offsetof */
 #include <stdio.h>
+#include <ctype.h>
 #include <signal.h>
-#include <sys/select.h>
+#include <sys/epoll.h>
+#include <sys/resource.h>
+#include <sys/uio.h>
 #include <sys/time.h>
 #include <sys/types.h>
 #include <sys/socket.h>
@@ -45,16 +50,6 @@
 
 #include "onkyo.h"
 
-/** A connection to a receiver and associated receive buffer */
-struct conn {
-	int fd;
-	char *recv_buf;
-	char *recv_buf_pos;
-	struct conn *next;
-};
-
-/** file descriptor for raw output logging */
-static int logfd = -1;
 /** our list of receivers we send commands to */
 static struct receiver *receivers = NULL;
 /** our list of listening sockets/descriptors we accept connections on */
@@ -62,24 +57,358 @@ static int *listeners;
 static size_t listener_count = 0;
 /** our list of open connections we process commands on */
 static struct conn *connections = NULL;
-/** pipe used for async-safe signal handling in our select */
+/** number of connections ever opened, used as their serial numbers */
+static unsigned long conn_serial = 0;
+/** number of client connections ever opened, not counting scrapes */
+static unsigned long clients_total = 0;
+/** listening socket statistics are scraped from, -1 if none */
+static int stats_listener = -1;
+/** pipe used for async-safe signal handling in our event loop */
 static int signalpipe[2] = { -1, -1 };
+/** epoll instance every descriptor we monitor is registered with */
+static int epollfd = -1;
+/** open connections indexed by file descriptor, for dispatching events */
+static struct conn **conns_by_fd = NULL;
+static size_t conns_by_fd_size = 0;
+/** whether new connections get the known receiver status after the hello */
+static int send_snapshot = 0;
+/** longest command line accepted from a client, including the newline */
+static size_t max_line = BUF_SIZE;
+/** size of each connection's input buffer, derived from max_line */
+static size_t recv_size = RECV_BUF_SIZE;
+
+/** what to do with a connection whose output backlog fills its buffer */
+enum slow_policy {
+	SLOW_DROP,       /**< discard the oldest buffered lines */
+	SLOW_DISCONNECT, /**< close the connection */
+};
+static enum slow_policy slow_policy = SLOW_DROP;
+
+/** receiver command pacing and the shortest and longest time (in
+ * milliseconds) between commands for adaptive pacing, as given on the
+ * command line; -1 where the default of the receiver type applies */
+static int pacing = -1;
+static long pace_floor = -1;
+static long pace_timeout = -1;
+
+/** A key pattern a connection subscribed to: either an exact status key,
+ * e.g. "volume", or a key prefix, given as "zone2*" */
+struct subscription {
+	struct conn *conn;
+	/** the next subscription of the same connection */
+	struct subscription *next_conn;
+	/** the next subscription in the same hash bucket, or the next prefix */
+	struct subscription *next;
+	unsigned long hash;
+	/** length of the key, without the trailing '*' of a prefix */
+	size_t len;
+	int prefix;
+	char key[SUB_KEY_SIZE];
+};
+/** exact key subscriptions of all connections, hashed by key */
+static struct subscription *sub_buckets[SUB_BUCKETS];
+/** prefix subscriptions of all connections; there are only ever a few */
+static struct subscription *sub_prefixes = NULL;
+/** number of connections with subscriptions, which skip the lines they
+ * did not ask for */
+static size_t filtered_conns = 0;
+/** broadcast counters: lines, lines written to a connection, and lines a
+ * connection was spared by its subscriptions */
+static unsigned long bcast_seq = 0;
+static unsigned long bcast_deliveries = 0;
+static unsigned long bcast_filtered = 0;
+/** connections picked for the broadcast in progress */
+static struct conn *recipients[MAX_CONNECTIONS];
 
 /* common messages */
 static const char * const startup_msg = "OK:onkyocontrol v1.1\n";
 static const char * const invalid_cmd = "ERROR:Invalid Command\n";
 static const char * const max_conns = "ERROR:Max Connections Reached\n";
+static const char * const queue_full = "ERROR:Command Queue Full\n";
+static const char * const scrape_header = "HTTP/1.0 200 OK\r\n"
+	"Content-Type: text/plain; version=0.0.4\r\n\r\n";
 const char * const rcvr_err = "ERROR:Receiver Error\n";
 
+static void end_connection(struct conn *c, int freebufs);
+
+/**
+ * Set the events we are interested in for a file descriptor in our event
+ * loop.
+ * @param fd the file descriptor to monitor
+ * @param op EPOLL_CTL_ADD for a new descriptor, EPOLL_CTL_MOD otherwise
+ * @param events the epoll events to wait for
+ * @return 0 on success, -1 on failure
+ */
+static int watch_fd_events(int fd, int op, uint32_t events)
+{
+	struct epoll_event ev;
+
+	memset(&ev, 0, sizeof(struct epoll_event));
+	ev.events = events;
+	ev.data.fd = fd;
+	if(epoll_ctl(epollfd, op, fd, &ev) == -1) {
+		log_msg(LEVEL_ERROR, "epoll_ctl(): %s", strerror(errno));
+		return -1;
+	}
+	return 0;
+}
+
+/**
+ * Start monitoring a file descriptor for incoming data in our event loop.
+ * @param fd the file descriptor to monitor
+ * @return 0 on success, -1 on failure
+ */
+static int watch_fd(int fd)
+{
+	return watch_fd_events(fd, EPOLL_CTL_ADD, EPOLLIN);
+}
+
+/**
+ * Stop monitoring a file descriptor in our event loop. This must be called
+ * before the descriptor is closed.
+ * @param fd the file descriptor to stop monitoring
+ */
+static void unwatch_fd(int fd)
+{
+	struct epoll_event ev;
+
+	/* older kernels require a non-NULL event even though it is ignored */
+	epoll_ctl(epollfd, EPOLL_CTL_DEL, fd, &ev);
+}
+
+/**
+ * Record a connection in our file descriptor index, growing the index if
+ * the descriptor does not fit yet.
+ * @param c the connection to index
+ * @return 0 on success, -1 on allocation failure
+ */
+static int index_connection(struct conn *c)
+{
+	size_t fd = (size_t)c->fd;
+
+	if(fd >= conns_by_fd_size) {
+		struct conn **new_index;
+		size_t i, size = conns_by_fd_size ? conns_by_fd_size : 64;
+
+		while(size <= fd)
+			size *= 2;
+		new_index = realloc(conns_by_fd, size * sizeof(struct conn *));
+		if(!new_index) {
+			log_msg(LEVEL_ERROR, "realloc(): %s", strerror(errno));
+			return -1;
+		}
+		for(i = conns_by_fd_size; i < size; i++)
+			new_index[i] = NULL;
+		conns_by_fd = new_index;
+		conns_by_fd_size = size;
+	}
+	conns_by_fd[fd] = c;
+	return 0;
+}
+
+/**
+ * Check a subscription key pattern and find out what kind it is.
+ * @param pattern the pattern, lowercase letters, digits and '-', with an
+ * optional '*' at the end
+ * @param len where to store the length of the key, without any '*'
+ * @return 0 for an exact key, 1 for a prefix, -1 if the pattern is invalid
+ */
+static int parse_sub_pattern(const char *pattern, size_t *len)
+{
+	size_t i;
+
+	for(i = 0; pattern[i]; i++) {
+		char ch = pattern[i];
+		if(ch == '*' && pattern[i + 1] == '\0')
+			break;
+		if(!((ch >= 'a' && ch <= 'z') || (ch >= '0' && ch <= '9')
+					|| ch == '-'))
+			return -1;
+	}
+	if(i >= SUB_KEY_SIZE || (i == 0 && pattern[i] != '*'))
+		return -1;
+	*len = i;
+	return pattern[i] == '*';
+}
+
+/**
+ * Find the hash bucket or list a subscription lives on.
+ */
+static struct subscription **sub_list(const struct subscription *sub)
+{
+	if(sub->prefix)
+		return &sub_prefixes;
+	return &sub_buckets[sub->hash & (SUB_BUCKETS - 1)];
+}
+
+/**
+ * Take a subscription off its bucket or list, and off its connection.
+ * @param sub the subscription to remove; it is freed
+ */
+static void remove_subscription(struct subscription *sub)
+{
+	struct conn *c = sub->conn;
+	struct subscription **ptr;
+
+	for(ptr = sub_list(sub); *ptr != sub; ptr = &(*ptr)->next)
+		;
+	*ptr = sub->next;
+	for(ptr = &c->subs; *ptr != sub; ptr = &(*ptr)->next_conn)
+		;
+	*ptr = sub->next_conn;
+	free(sub);
+
+	if(--c->sub_count == 0)
+		filtered_conns--;
+}
+
+/**
+ * Subscribe a connection to status keys. Once a connection has any
+ * subscriptions, it is only sent broadcast status lines whose key matches
+ * one of them, along with lines that have no key, such as errors. Patterns
+ * the connection already has are ignored.
+ * @param c the connection
+ * @param patterns space separated key patterns, e.g. "volume zone2*"; this
+ * string is modified
+ * @return 0 on success, -1 if a pattern is invalid or there would be too
+ * many; no subscriptions are added then
+ */
+int conn_subscribe(struct conn *c, char *patterns)
+{
+	char *pattern, *save;
+	size_t count = c->sub_count;
+	char *added[MAX_SUBSCRIPTIONS];
+	size_t i, added_count = 0;
+
+	/* check everything first so a bad pattern leaves things as they were */
+	for(pattern = strtok_r(patterns, " ", &save); pattern;
+			pattern = strtok_r(NULL, " ", &save)) {
+		struct subscription *sub;
+		size_t len;
+
+		if(parse_sub_pattern(pattern, &len) == -1)
+			return -1;
+		for(sub = c->subs; sub; sub = sub->next_conn) {
+			if(strcmp(sub->key, pattern) == 0)
+				break;
+		}
+		for(i = 0; !sub && i < added_count; i++) {
+			if(strcmp(added[i], pattern) == 0)
+				break;
+		}
+		if(sub || i < added_count)
+			continue;
+		if(++count > MAX_SUBSCRIPTIONS)
+			return -1;
+		added[added_count++] = pattern;
+	}
+
+	for(i = 0; i < added_count; i++) {
+		struct subscription *sub, **list;
+
+		sub = calloc(1, sizeof(struct subscription));
+		if(!sub) {
+			log_msg(LEVEL_ERROR, "calloc(): %s", strerror(errno));
+			return -1;
+		}
+		/* the key is stored as given, '*' and all, for replies */
+		strcpy(sub->key, added[i]);
+		sub->prefix = parse_sub_pattern(sub->key, &sub->len);
+		sub->hash = sub->prefix ? 0 : hash_sdbm(sub->key);
+		sub->conn = c;
+		list = sub_list(sub);
+		sub->next = *list;
+		*list = sub;
+		sub->next_conn = c->subs;
+		c->subs = sub;
+		if(c->sub_count++ == 0)
+			filtered_conns++;
+	}
+	return 0;
+}
+
+/**
+ * Drop subscriptions of a connection. Patterns the connection does not
+ * have are ignored. Once the last one is gone, the connection is sent
+ * every broadcast line again.
+ * @param c the connection
+ * @param patterns space separated key patterns, or NULL to drop them all;
+ * this string is modified
+ * @return 0 on success, -1 if a pattern is invalid or there are more than
+ * anyone can have; nothing is dropped then
+ */
+int conn_unsubscribe(struct conn *c, char *patterns)
+{
+	char *pattern, *save;
+	char *dropped[MAX_SUBSCRIPTIONS];
+	size_t i, len, count = 0;
+
+	if(!patterns) {
+		while(c->subs)
+			remove_subscription(c->subs);
+		return 0;
+	}
+
+	for(pattern = strtok_r(patterns, " ", &save); pattern;
+			pattern = strtok_r(NULL, " ", &save)) {
+		if(parse_sub_pattern(pattern, &len) == -1 ||
+				count == MAX_SUBSCRIPTIONS)
+			return -1;
+		dropped[count++] = pattern;
+	}
+
+	for(i = 0; i < count; i++) {
+		struct subscription *sub;
+		for(sub = c->subs; sub; sub = sub->next_conn) {
+			if(strcmp(sub->key, dropped[i]) == 0) {
+				remove_subscription(sub);
+				break;
+			}
+		}
+	}
+	return 0;
+}
+
+/**
+ * Describe the subscriptions of a connection.
+ * @param c the connection
+ * @param buf where to write the space separated patterns, oldest first;
+ * "*" if the connection has none and so gets everything
+ * @param size the size of buf
+ * @return the length of the description
+ */
+size_t conn_subscriptions(const struct conn *c, char *buf, size_t size)
+{
+	const struct subscription *subs[MAX_SUBSCRIPTIONS];
+	const struct subscription *sub;
+	size_t i = 0, len = 0;
+
+	if(!c->subs)
+		return (size_t)snprintf(buf, size, "*");
+	/* the list is newest first */
+	for(sub = c->subs; sub && i < MAX_SUBSCRIPTIONS; sub = sub->next_conn)
+		subs[i++] = sub;
+	buf[0] = '\0';
+	while(i-- > 0 && len < size) {
+		len += (size_t)snprintf(buf + len, size - len, "%s%s",
+				len ? " " : "", subs[i]->key);
+	}
+	return len < size ? len : size - 1;
+}
+
 /**
  * Establish everything we need for a connection once it has been
  * accepted. This will set up send and receive buffers and start
- * tracking the connection in our array.
+ * tracking the connection in our array. If enabled, the hello message is
+ * followed by the last known status of each receiver. Scrapes get neither.
+ * Both go through the connection send buffer like any other output, so a
+ * client that does not read them is handled by the slow client policy.
  * @param fd the newly opened connection's file descriptor
+ * @param scrape whether the connection came in on the statistics listener
  * @return 0 if initial write was successful, -1 if max connections
  * reached, -2 on write failure (connection is closed for any failure)
  */
-static int open_connection(int fd)
+static int open_connection(int fd, int scrape)
 {
 	int i, on = 1;
 	struct conn *ptr, *prev = NULL;
@@ -89,12 +418,6 @@ static int open_connection(int fd)
 	/* We also want sockets to timeout if they die and we don't notice */
 	setsockopt(fd, SOL_SOCKET, SO_KEEPALIVE, &on, (socklen_t)sizeof(on));
 
-	/* attempt an initial status message write */
-	if(xwrite(fd, startup_msg, strlen(startup_msg)) == -1) {
-		xclose(fd);
-		return -2;
-	}
-
 	/* add it to our linked list, ensuring we don't have too many already */
 	ptr = connections;
 	for(i = 0; i < MAX_CONNECTIONS; i++) {
@@ -104,7 +427,7 @@ static int open_connection(int fd)
 		ptr = ptr->next;
 	}
 	if(i >= MAX_CONNECTIONS) {
-		fprintf(stderr, "max connections (%d) reached!\n", MAX_CONNECTIONS);
+		log_msg(LEVEL_WARN, "max connections (%d) reached!", MAX_CONNECTIONS);
 		xwrite(fd, max_conns, strlen(max_conns));
 		xclose(fd);
 		return -1;
@@ -116,15 +439,23 @@ static int open_connection(int fd)
 			return -1;
 	}
 	if(!ptr->recv_buf) {
-		ptr->recv_buf = calloc(BUF_SIZE, sizeof(char));
+		ptr->recv_buf = malloc(recv_size);
 		if(!ptr->recv_buf) {
 			free(ptr);
 			return -1;
 		}
-		ptr->recv_buf_pos = ptr->recv_buf;
 		ptr->next = NULL;
 	}
+	ptr->recv_len = 0;
+	ptr->recv_discard = 0;
 	ptr->fd = fd;
+	ptr->serial = ++conn_serial;
+	ptr->req_id[0] = '\0';
+	ptr->scrape = scrape;
+	ptr->closing = 0;
+	ptr->bytes_in = ptr->bytes_out = 0;
+	if(!scrape)
+		clients_total++;
 	if(prev) {
 		prev->next = ptr;
 	} else {
@@ -132,6 +463,33 @@ static int open_connection(int fd)
 		connections = ptr;
 	}
 
+	/* from here on, all output goes through the connection send buffer */
+	ptr->send_head = ptr->send_len = 0;
+	ptr->send_partial = 0;
+	ptr->send_grow = 0;
+	ptr->dropped = 0;
+	if(fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK) == -1 ||
+			index_connection(ptr) == -1 || watch_fd(fd) == -1) {
+		end_connection(ptr, 0);
+		return -1;
+	}
+
+	if(scrape)
+		return 0;
+	/* attempt an initial status message write */
+	if(write_to_connection(ptr, startup_msg) == -1)
+		return -2;
+	if(send_snapshot) {
+		struct receiver *r;
+		struct timeval now;
+
+		gettimeofday(&now, NULL);
+		for(r = receivers; r; r = r->next) {
+			if(rcvr_write_snapshot(r, ptr, &now) == -1)
+				return -2;
+		}
+	}
+
 	return 0;
 }
 
@@ -140,7 +498,7 @@ static int open_connection(int fd)
  * all buffers. This method will only attempt to close the file descriptor if
  * it is > -1. Buffers should only be freed if closing down; keeping them
  * around will save the need to continuously free and allocate memory, and they
- * are cleared no matter what.
+ * are emptied no matter what.
  * @param c the connection to end
  * @param freebufs whether to free the connection buffers
  */
@@ -148,28 +506,38 @@ static void end_connection(struct conn *c, int freebufs)
 {
 	int fd = c->fd;
 	c->fd = -1;
-	if(fd > -1)
+	if(fd > -1) {
+		if((size_t)fd < conns_by_fd_size)
+			conns_by_fd[fd] = NULL;
+		unwatch_fd(fd);
 		xclose(fd);
+	}
+	conn_unsubscribe(c, NULL);
 	if(freebufs) {
 		free(c->recv_buf);
 		c->recv_buf = NULL;
-	} else {
-		memset(c->recv_buf, 0, BUF_SIZE);
+		free(c->send_buf);
+		c->send_buf = NULL;
+		c->send_size = 0;
 	}
-	c->recv_buf_pos = c->recv_buf;
-	printf("connection closed\n");
+	c->recv_len = 0;
+	c->recv_discard = 0;
+	c->send_head = c->send_len = 0;
+	c->send_partial = 0;
+	log_msg(LEVEL_INFO, "connection closed");
 }
 
 /**
  * Cleanup all resources associated with our program, including memory,
  * open devices, files, sockets, etc. This function will not return.
  * The complete list of cleanup actions is the following:
- * - command queue (empty it)
- * - serial device (reset and close)
+ * - receiver devices and connections (reset and close)
  * - our listeners
  * - any open connections
+ * - our epoll instance
  * - our internal signal pipe
- * - our user command list
+ * - our user command and status lists
+ * - our log output
  * @param ret the eventual exit code for our program
  */
 static void cleanup(int ret) __attribute__ ((noreturn));
@@ -179,26 +547,18 @@ static void cleanup(int ret)
 
 	while(receivers) {
 		struct receiver *rcvr = receivers;
-		/* clear our command queue */
-		while(rcvr->queue) {
-			struct cmdqueue *ptr = rcvr->queue;
-			free(ptr->cmd);
-			rcvr->queue = ptr->next;
-			free(ptr);
-		}
 		/* reset/close our receiver device */
 		if(rcvr->fd > -1) {
 			xclose(rcvr->fd);
 		}
 		receivers = receivers->next;
+		free(rcvr->host);
+		free(rcvr->service);
 		free(rcvr);
 	}
 
-	/* close the log file descriptor */
-	if(logfd > -1) {
-		xclose(logfd);
-		logfd = -1;
-	}
+	/* write out and close the capture file */
+	capture_close();
 
 	/* loop through listener descriptors and close them */
 	for(i = 0; i < listener_count; i++) {
@@ -206,7 +566,7 @@ static void cleanup(int ret)
 			struct sockaddr saddr;
 			socklen_t sl = (socklen_t)sizeof(struct sockaddr);
 			if(getsockname(listeners[i], &saddr, &sl)) {
-				perror("getsockname()");
+				log_msg(LEVEL_ERROR, "getsockname(): %s", strerror(errno));
 			} else {
 				/* for unix sockets, we want to unlink the path */
 				if(saddr.sa_family == AF_UNIX) {
@@ -226,6 +586,15 @@ static void cleanup(int ret)
 		connections = connections->next;
 		free(ptr);
 	}
+	free(conns_by_fd);
+	conns_by_fd = NULL;
+	conns_by_fd_size = 0;
+
+	/* close our event loop descriptor */
+	if(epollfd > -1) {
+		xclose(epollfd);
+		epollfd = -1;
+	}
 
 	/* close our signal listener */
 	if(signalpipe[WRITE] > -1) {
@@ -237,12 +606,19 @@ static void cleanup(int ret)
 		signalpipe[READ] = -1;
 	}
 
+	/* free our command and status lookup tables */
+	free_commands();
+	free_statuses();
+
+	/* write out anything still waiting to be logged */
+	log_close();
+
 	exit(ret);
 }
 
 /**
  * Handle a signal in an async-safe fashion. The signal is written
- * to a pipe monitored in our main select() loop and will be handled
+ * to a pipe monitored in our main event loop and will be handled
  * just as the other file descriptors there are.
  * @param signo the signal number
  */
@@ -266,8 +642,19 @@ static void show_status(void)
 	size_t i;
 
 	for(r = receivers; r; r = r->next) {
-		printf("receiver      : %d (%d, %ld)\n",
-				r->fd, r->type, r->last_cmd.tv_sec);
+		if(r->type == RCVR_NET) {
+			printf("receiver      : %d (network %s port %s%s, %ld)\n",
+					r->fd, r->host, r->service,
+					r->connecting ? ", connecting" :
+					r->fd < 0 ? ", disconnected" : "",
+					r->last_cmd.tv_sec);
+		} else {
+			printf("receiver      : %d (serial, %ld)\n",
+					r->fd, r->last_cmd.tv_sec);
+		}
+		printf("pacing        : %s (floor %ld ms, timeout %ld ms)\n",
+				r->pacing == PACING_FIXED ? "fixed" : "adaptive",
+				r->pace_floor, r->pace_timeout);
 		printf("power status  : %X; main (%s)  zone2 (%s)  zone3 (%s)\n",
 				r->power,
 				r->power & MAIN_POWER  ? "ON" : "off",
@@ -277,24 +664,56 @@ static void show_status(void)
 				r->zone2_sleep.tv_sec, r->zone3_sleep.tv_sec,
 				r->next_sleep_update.tv_sec);
 		printf("cmds sent     : %lu\n", r->cmds_sent);
+		printf("reply time    : %ld ms (deviation %ld ms, %lu missed)\n",
+				r->reply_avg / 1000, r->reply_dev / 1000, r->replies_missed);
+		printf("cmd queue     : %zu (high water %zu, %lu rejected)\n",
+				r->queue.len, r->queue.high_water, r->queue.rejected);
+		printf("superseded    : %lu  aged (%lu)  deduped (%lu)"
+				"  skipped (%lu)\n", r->queue.superseded, r->queue.aged, r->queue.deduped,
+				r->queue.skipped);
+		for(i = 0; i < PRIO_COUNT; i++) {
+			static const char * const prio_names[PRIO_COUNT] = {
+				"power", "set", "query",
+			};
+			struct cmd_class *cls = &r->queue.prios[i];
+			printf("  %-5s       : %zu waiting, %lu sent, wait avg %llu ms"
+					" max %lu ms\n", prio_names[i], cls->len, cls->sent,
+					cls->sent ? cls->wait_total / cls->sent / 1000 : 0,
+					cls->wait_max / 1000);
+		}
 		printf("msgs received : %lu\n", r->msgs_received);
 	}
-	printf("log file      : %d\n", logfd);
+	capture_show_status();
+	printf("log level     : %s\n", log_level_name(log_get_level()));
+	printf("epoll         : %d\n", epollfd);
 
 	printf("listeners     : ");
 	for(i = 0; i < listener_count; i++) {
 		printf("%d ", listeners[i]);
 	}
 
-	printf("\nconnections   : ");
+	printf("\nbroadcasts    : %lu lines, %lu deliveries, %lu filtered\n",
+			bcast_seq, bcast_deliveries, bcast_filtered);
+
+	printf("connections   : ");
 	for(c = connections; c; c = c->next) {
 		printf("%d ", c->fd);
 	}
 	printf("\n");
+	/* only connections with something interesting to say */
+	for(c = connections; c; c = c->next) {
+		if(c->fd > -1 && (c->send_len || c->dropped || c->subs)) {
+			char subs[MAX_SUBSCRIPTIONS * SUB_KEY_SIZE];
+			conn_subscriptions(c, subs, sizeof(subs));
+			printf("  fd %-9d : backlog %zu bytes, %lu lines dropped,"
+					" subscribed to %s\n",
+					c->fd, c->send_len, c->dropped, subs);
+		}
+	}
 }
 
 /**
- * Handler for signals called when a signal was detected in our select()
+ * Handler for signals called when a signal was detected in our event
  * loop. This ensures we can safely handle the signal and not have weird
  * interactions with interrupted system calls and other such fun. This
  * should never be called from within the signal handler set via sigaction.
@@ -303,25 +722,14 @@ static void show_status(void)
 static void realhandler(int signo)
 {
 	if(signo == SIGINT) {
-		fprintf(stderr, "\ninterrupt signal received\n");
+		log_msg(LEVEL_INFO, "interrupt signal received");
 		cleanup(EXIT_SUCCESS);
 	} else if(signo == SIGPIPE) {
-		fprintf(stderr, "attempted IO to a closed socket/pipe\n");
+		log_msg(LEVEL_WARN, "attempted IO to a closed socket/pipe");
 	} else if(signo == SIGUSR1) {
 		show_status();
-	}
-}
-
-/**
- * Create and open a logfile for the raw serial device output.
- * @param path the path to the logfile
- */
-static void log_raw_serial(const char *path)
-{
-	logfd = creat(path, S_IRUSR | S_IWUSR | S_IRGRP | S_IROTH);
-	if (logfd < 0) {
-		perror(path);
-		cleanup(EXIT_FAILURE);
+	} else if(signo == SIGUSR2) {
+		log_toggle_debug();
 	}
 }
 
@@ -367,6 +775,46 @@ static void daemonize(void)
 	}
 }
 
+/**
+ * Set how commands to a receiver are paced: as given on the command line,
+ * or else as suits the kind of receiver.
+ * @param rcvr the receiver to set up
+ * @param mode the pacing mode to use unless one was given
+ * @param floor the adaptive pacing floor to use unless one was given
+ * @param timeout the adaptive pacing timeout to use unless one was given
+ * @return 0 on success, -1 if the floor ends up longer than the timeout
+ */
+static int init_pacing(struct receiver *rcvr, enum pacing mode,
+		long floor, long timeout)
+{
+	rcvr->pacing = pacing == -1 ? mode : (enum pacing)pacing;
+	rcvr->pace_floor = pace_floor == -1 ? floor : pace_floor;
+	rcvr->pace_timeout = pace_timeout == -1 ? timeout : pace_timeout;
+	if(rcvr->pace_floor > rcvr->pace_timeout) {
+		fprintf(stderr, "pacing floor can't be longer than the timeout\n");
+		return -1;
+	}
+	return 0;
+}
+
+/**
+ * Add a receiver to the end of our global list of receivers.
+ * @param rcvr the receiver to add
+ */
+static void add_receiver(struct receiver *rcvr)
+{
+	if(!receivers) {
+		rcvr->id = 0;
+		receivers = rcvr;
+	} else {
+		struct receiver *ptr = receivers;
+		while(ptr->next)
+			ptr = ptr->next;
+		rcvr->id = ptr->id + 1;
+		ptr->next = rcvr;
+	}
+}
+
 /**
  * Open the serial device at the given path for use as a destination
  * receiver. Also adds it to our global list of serial devices.
@@ -381,6 +829,12 @@ static int open_serial_device(const char *path)
 
 	if (!(rcvr = calloc(1, sizeof(struct receiver))))
 		goto cleanup;
+	rcvr->fd = -1;
+	rcvr->type = RCVR_SERIAL;
+	if(init_pacing(rcvr, PACING_FIXED, PACE_FLOOR, PACE_TIMEOUT) == -1) {
+		free(rcvr);
+		return -1;
+	}
 
 	/* Open serial device for reading and writing, but not as controlling
 	 * TTY because we don't want to get killed if linenoise sends CTRL-C.
@@ -403,10 +857,11 @@ static int open_serial_device(const char *path)
 	newtio.c_iflag = IGNPAR;
 	/* raw output mode */
 	newtio.c_oflag = 0;
-	/* canonical input mode- end read at a line descriptor */
-	newtio.c_lflag = ICANON;
-	/* add the Onkyo-used EOF char to allow canonical read */
-	newtio.c_cc[VEOL] = (cc_t)END_RECV[strlen(END_RECV) - 1];
+	/* raw input mode- we find the ends of messages ourselves, so a read
+	 * returns whatever has arrived, at least one byte */
+	newtio.c_lflag = 0;
+	newtio.c_cc[VMIN] = 1;
+	newtio.c_cc[VTIME] = 0;
 
 	/* clean the line and activate the settings */
 	ret = tcflush(rcvr->fd, TCIOFLUSH);
@@ -420,26 +875,164 @@ static int open_serial_device(const char *path)
 	/* a few more pieces of info filled in */
 	rcvr->power = POWER_OFF;
 	/* queue up an initial power command */
-	process_command(rcvr, "power");
+	process_command(rcvr, NULL, "power");
+
+	if(watch_fd(rcvr->fd) == -1)
+		goto cleanup;
 
 	/* place the device in our global list */
-	if(!receivers) {
-		receivers = rcvr;
-	} else {
-		struct receiver *ptr = rcvr;
-		while(ptr->next)
-			ptr = ptr->next;
-		ptr->next = rcvr;
-	}
+	add_receiver(rcvr);
 
 	return rcvr->fd;
 
 cleanup:
 	perror(path);
+	if(rcvr && rcvr->fd > -1)
+		xclose(rcvr->fd);
 	free(rcvr);
 	return -1;
 }
 
+/**
+ * Schedule the next attempt to connect to a network receiver, waiting
+ * twice as long as the last time up to RECONNECT_MAX.
+ * @param r the receiver to connect to later
+ */
+static void schedule_reconnect(struct receiver *r)
+{
+	if(r->connect_wait < RECONNECT_MIN)
+		r->connect_wait = RECONNECT_MIN;
+	gettimeofday(&r->next_connect, NULL);
+	r->next_connect.tv_sec += r->connect_wait;
+	log_msg(LEVEL_INFO, "connecting to receiver %s again in %ld seconds",
+			r->host, r->connect_wait);
+	r->connect_wait *= 2;
+	if(r->connect_wait > RECONNECT_MAX)
+		r->connect_wait = RECONNECT_MAX;
+}
+
+/**
+ * Start connecting to a network receiver. The connection is done once the
+ * socket becomes writable, see finish_connect(). If the attempt can't even
+ * be started, the next one is scheduled.
+ * @param r the receiver to connect to
+ */
+static void connect_receiver(struct receiver *r)
+{
+	int ret, fd = -1;
+	struct addrinfo hints;
+	struct addrinfo *result, *rp;
+
+	timeval_clear(r->next_connect);
+
+	memset(&hints, 0, sizeof(struct addrinfo));
+	hints.ai_family = AF_UNSPEC;
+	hints.ai_socktype = SOCK_STREAM;
+	ret = getaddrinfo(r->host, r->service, &hints, &result);
+	if(ret != 0) {
+		log_msg(LEVEL_ERROR, "receiver %s: %s", r->host, gai_strerror(ret));
+		schedule_reconnect(r);
+		return;
+	}
+
+	/* take the first address a connection can be started to; a receiver
+	 * that is switched off will fail all of them the same way */
+	for(rp = result; rp != NULL; rp = rp->ai_next) {
+		fd = socket(rp->ai_family, rp->ai_socktype, rp->ai_protocol);
+		if(fd == -1)
+			continue;
+		if(fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK) == 0 &&
+				(connect(fd, rp->ai_addr, rp->ai_addrlen) == 0 ||
+				 errno == EINPROGRESS))
+			break;
+		log_msg(LEVEL_WARN, "receiver %s: %s", r->host, strerror(errno));
+		xclose(fd);
+		fd = -1;
+	}
+	freeaddrinfo(result);
+
+	/* either way we hear about it once the socket is writable */
+	if(fd == -1 || watch_fd_events(fd, EPOLL_CTL_ADD, EPOLLOUT) == -1) {
+		if(fd > -1)
+			xclose(fd);
+		schedule_reconnect(r);
+		return;
+	}
+	r->fd = fd;
+	r->connecting = 1;
+}
+
+/**
+ * Finish connecting to a network receiver once its socket is writable. On
+ * success we start reading status messages and ask for the power status,
+ * which may have changed while we were not connected.
+ * @param r the receiver being connected to
+ */
+static void finish_connect(struct receiver *r)
+{
+	int err = 0, on = 1;
+	socklen_t len = sizeof(err);
+
+	if(getsockopt(r->fd, SOL_SOCKET, SO_ERROR, &err, &len) == -1)
+		err = errno;
+	if(err == 0 && watch_fd_events(r->fd, EPOLL_CTL_MOD, EPOLLIN) == -1)
+		err = errno;
+	if(err != 0) {
+		log_msg(LEVEL_WARN, "receiver %s: %s", r->host, strerror(err));
+		unwatch_fd(r->fd);
+		xclose(r->fd);
+		r->fd = -1;
+		r->connecting = 0;
+		schedule_reconnect(r);
+		return;
+	}
+
+	/* commands are short and should go out right away */
+	setsockopt(r->fd, IPPROTO_TCP, TCP_NODELAY, &on, (socklen_t)sizeof(on));
+	/* and we want to notice a receiver that went away without a word */
+	setsockopt(r->fd, SOL_SOCKET, SO_KEEPALIVE, &on, (socklen_t)sizeof(on));
+
+	r->connecting = 0;
+	r->connect_wait = 0;
+	log_msg(LEVEL_INFO, "connected to receiver %s port %s",
+			r->host, r->service);
+	process_command(r, NULL, "power");
+}
+
+/**
+ * Set up a receiver on the network, which we talk to using eISCP. Also
+ * adds it to our global list of receivers. The connection is made from
+ * our event loop, and made again whenever it is lost.
+ * @param host the host name or address of the receiver
+ * @param service the port number, NULL for the eISCP default
+ * @return 0 on success, -1 on failure
+ */
+static int open_net_receiver(const char *host, const char *service)
+{
+	struct receiver *rcvr;
+
+	if(!(rcvr = calloc(1, sizeof(struct receiver)))) {
+		perror("calloc()");
+		return -1;
+	}
+	rcvr->fd = -1;
+	rcvr->type = RCVR_NET;
+	rcvr->host = strdup(host);
+	rcvr->service = strdup(service && *service ? service : EISCP_PORT);
+	if(!rcvr->host || !rcvr->service ||
+			init_pacing(rcvr, PACING_ADAPTIVE,
+				NET_PACE_FLOOR, NET_PACE_TIMEOUT) == -1) {
+		free(rcvr->host);
+		free(rcvr->service);
+		free(rcvr);
+		return -1;
+	}
+	rcvr->power = POWER_OFF;
+	add_receiver(rcvr);
+	connect_receiver(rcvr);
+	return 0;
+}
+
 /**
  * Attempt to listen on an open fd, and if successful, add it to our listener
  * list. This does not do any sort of socket opening call; that is left to the
@@ -454,6 +1047,10 @@ static int listen_and_add(int fd)
 		perror("listen()");
 		fd = -1;
 	}
+	if(fd != -1 && watch_fd(fd) == -1) {
+		xclose(fd);
+		fd = -1;
+	}
 
 	/* add the listener to our list */
 	if(fd != -1) {
@@ -508,7 +1105,7 @@ static int open_net_listener(const char * restrict host,
 	struct addrinfo hints;
 	struct addrinfo *result, *rp;
 
-	printf("host %s, service %s\n", host, service);
+	log_msg(LEVEL_INFO, "host %s, service %s", host, service);
 
 	/* set up our hints structure with known info */
 	memset(&hints, 0, sizeof(struct addrinfo));
@@ -600,11 +1197,40 @@ static int open_socket_listener(const char *path)
 	return listen_and_add(fd);
 }
 
+/**
+ * Work out how long after the previous command the next one may be sent.
+ * With fixed pacing this is always COMMAND_WAIT. With adaptive pacing it is
+ * the floor once the previous command was answered; until then we wait a
+ * bit longer than the receiver usually takes to reply, but never longer
+ * than the timeout.
+ * @param receiver the receiver to check
+ * @return the time to wait, in microseconds
+ */
+static long command_gap(struct receiver *receiver)
+{
+	long gap;
+
+	if(receiver->pacing == PACING_FIXED)
+		return 1000L * COMMAND_WAIT;
+	if(!receiver->awaiting_len)
+		return 1000L * receiver->pace_floor;
+	if(!receiver->reply_avg)
+		return 1000L * receiver->pace_timeout;
+	/* the same margin as a TCP retransmit timeout, but at least the floor */
+	gap = 4 * receiver->reply_dev;
+	if(gap < 1000L * receiver->pace_floor)
+		gap = 1000L * receiver->pace_floor;
+	gap += receiver->reply_avg;
+	if(gap > 1000L * receiver->pace_timeout)
+		gap = 1000L * receiver->pace_timeout;
+	return gap;
+}
+
 /**
  * Determine if we can send a command to the receiver by ensuring it has been
- * a certain time since the previous sent command. If we can send a command,
- * 1 is returned and timeoutval is left undefined. If we cannot send, then 0
- * is returned and the timeoutval is set accordingly.
+ * a certain time since the previous sent command, see command_gap(). If we
+ * can send a command, 1 is returned and timeoutval is left undefined. If we
+ * cannot send, then 0 is returned and the timeoutval is set accordingly.
  * @param receiver the receiver to check for last time sent
  * @param now time value to use as 'now'
  * @param timeoutval location to store timeout before next permitted send
@@ -619,7 +1245,7 @@ static int can_send_command(struct receiver *receiver,
 	/* ensure it has been long enough since the last sent command */
 	timeval_diff(now, &receiver->last_cmd, &diff);
 
-	wait.tv_usec = 1000 * COMMAND_WAIT;
+	wait.tv_usec = command_gap(receiver);
 	wait.tv_sec = wait.tv_usec / 1000000;
 	wait.tv_usec -= wait.tv_sec * 1000000;
 
@@ -627,7 +1253,7 @@ static int can_send_command(struct receiver *receiver,
 	 * scenario and we should just forget the prior last sent command time */
 	if(diff.tv_sec < 0) {
 		/* clock went backwards; reset the last_cmd time and wait another
-		 * COMMAND_WAIT milliseconds */
+		 * full gap */
 		receiver->last_cmd.tv_sec = now->tv_sec;
 		receiver->last_cmd.tv_usec = now->tv_usec;
 		timeoutval->tv_sec = wait.tv_sec;
@@ -648,135 +1274,859 @@ static int can_send_command(struct receiver *receiver,
 }
 
 /**
- * Process input from our input file descriptor and chop it into commands.
- * @param c the connection to read, write, and buffer from
- * @return 0 on success, -1 on end of (input) file, -2 on a failed write
- * to the output buffer, -3 on attempted buffer overflow
+ * Take the request ID off the front of a command line, e.g. "@42 volume 30".
+ * @param c the connection the line came from; the ID is stored in it
+ * @param line the command line
+ * @return the rest of the line, NULL if the request ID is invalid
  */
-static int process_input(struct conn *c)
+static const char *take_request_id(struct conn *c, const char *line)
 {
-	/* a convienence ptr one past the end of our buffer */
-	const char * const end_pos = &(c->recv_buf[BUF_SIZE]);
+	size_t i;
 
-	int ret = 0;
-	ssize_t count;
+	for(i = 1; line[i] && line[i] != ' '; i++) {
+		char ch = line[i];
+		if(!isalnum((unsigned char)ch) && ch != '-' && ch != '_'
+				&& ch != '.')
+			return NULL;
+	}
+	if(i == 1 || i > REQ_ID_SIZE)
+		return NULL;
+	memcpy(c->req_id, line + 1, i - 1);
+	c->req_id[i - 1] = '\0';
+	while(line[i] == ' ')
+		i++;
+	return line + i;
+}
 
-	/*
-	 * Picture time! Let's get overly verbose since we don't do this
-	 * stuff too often.
-	 *
-	 *           ( read #1 ) ( read #2 ... )
-	 * recv_buf: [v] [o] [l] [u] [m] [e] [\n] [p] [ ] ... [ ] [ ]
-	 *       recv_buf_pos-----^                       end_pos-----^
-	 * count: 5
-	 *
-	 * Basically we will perform a read, getting as many chars as are
-	 * available. If we didn't get a newline on the first read, then
-	 * pos will be located at the end of the previous read. If we find
-	 * a newline, we will substring from start to pos (excluding newline)
-	 * and pass that off to our command parser. We will then memmove
-	 * anything remaining in our buffer to the beginning and continue
-	 * the cycle.
-	 */
+/**
+ * Run a single command line received on a connection. A line may start
+ * with a request ID, e.g. "@42 volume 30"; the connection is then sent
+ * "ACK:42:..." lines telling it what became of each receiver command, see
+ * request_ack(), or "ACK:42:done" if no receiver command was needed and
+ * "ACK:42:error" instead of the usual error line. A scrape is sent the
+ * statistics once the blank line ending its request arrives.
+ * @param c the connection the command came from
+ * @param line the command, without its newline
+ * @return 0 on success, -2 if the connection was closed
+ */
+static int run_command_line(struct conn *c, const char *line)
+{
+	int processret = 0;
+	struct receiver *r;
+	struct request_tag req;
+
+	if(c->scrape) {
+		/* a blank line ends the request, whatever it asked for */
+		if(c->closing || (line[0] != '\0' && strcmp(line, "\r") != 0))
+			return 0;
+		write_to_connection(c, scrape_header);
+		write_stats(c);
+		if(c->fd > -1 && c->send_len)
+			c->closing = 1;
+		else
+			end_connection(c, 0);
+		return -2;
+	}
 
-	count = xread(c->fd, c->recv_buf_pos, end_pos - c->recv_buf_pos);
-	if(count == 0)
-		ret = -1;
-	/* loop through each character we read. We are looking for newlines
-	 * so we can parse out and execute one command. */
-	while(count > 0) {
-		if(*c->recv_buf_pos == '\n') {
-			int processret = 0;
-			size_t remaining;
-			struct receiver *r;
-			/* We have a newline. This means we should have a full command
-			 * and can attempt to interpret it. */
-			*c->recv_buf_pos = '\0';
-			r = receivers;
-			while(r) {
-				processret = process_command(r, c->recv_buf);
-				r = r->next;
-			}
-			if(processret == -1) {
-				/* watch our write for a failure */
-				if(xwrite(c->fd, invalid_cmd, strlen(invalid_cmd)) == -1)
-					ret = -2;
-			} else if(processret == -2) {
-				end_connection(c, 0);
-			}
-			/* now move our remaining buffer to the start of our buffer */
-			c->recv_buf_pos++;
-			remaining = (size_t)count - 1;
-			memmove(c->recv_buf, c->recv_buf_pos, remaining);
-			c->recv_buf_pos = c->recv_buf;
-			memset(&(c->recv_buf_pos[remaining]), 0,
-					end_pos - &(c->recv_buf_pos[remaining]));
-			if(ret == -2)
-				break;
+	if(line[0] == '@' && !(line = take_request_id(c, line))) {
+		if(write_to_connection(c, invalid_cmd) == -1)
+			return -2;
+		return 0;
+	}
+	c->req_acks = 0;
+
+	processret = process_conn_command(c, line);
+	if(processret == 1) {
+		processret = 0;
+		for(r = receivers; r; r = r->next) {
+			int ret = process_command(r, c, line);
+			/* one receiver with a full queue is worth telling about */
+			if(ret != 0)
+				processret = ret;
 		}
-		else if(end_pos - c->recv_buf_pos <= 1) {
-			/* We have a buffer overflow, we haven't seen a newline yet
-			 * and we are on the last character available in our buffer.
-			 * Squash whatever is in our buffer. */
-			fprintf(stderr, "process_input, buffer size exceeded\n");
-			c->recv_buf_pos = c->recv_buf;
-			memset(c->recv_buf, 0, BUF_SIZE);
-			ret = -3;
+	}
+	if(processret == -2) {
+		end_connection(c, 0);
+		return -2;
+	}
+	/* a reply may have closed the connection under the slow client policy;
+	 * the rest of its input must not be run then */
+	if(c->fd < 0)
+		return -2;
+	if(conn_request(c, &req)) {
+		c->req_id[0] = '\0';
+		if(processret == -1)
+			request_ack(&req, "error", NULL);
+		else if(!c->req_acks)
+			request_ack(&req, "done", NULL);
+		return c->fd < 0 ? -2 : 0;
+	}
+	if(processret == -1 || processret == -3) {
+		/* watch our write for a failure */
+		if(write_to_connection(c, processret == -1 ?
+					invalid_cmd : queue_full) == -1)
+			return -2;
+	}
+	return 0;
+}
+
+/**
+ * Process input from our input file descriptor and chop it into commands.
+ * Every complete line found is run as a command. Lines longer than
+ * max_line are answered with an error and skipped up to their newline.
+ * @param c the connection to read, write, and buffer from
+ * @return 0 on success, -1 on end of (input) file or read error, -2 if the
+ * connection was closed, -3 on an overlong line
+ */
+static int process_input(struct conn *c)
+{
+	int ret = 0;
+	ssize_t count;
+	char *start, *scan, *end, *nl;
+
+	/*
+	 *           ( read #1 ) ( read #2 ......................... )
+	 * recv_buf: [v] [o] [l] [u] [m] [e] [\n] [p] [o] [w] [e] [r] [ ] ...
+	 *     start--^       scan--^                           end--^
+	 *
+	 * Only the bytes from the current read are scanned for newlines; what
+	 * was left over from previous reads is a partial line, so it has none.
+	 * Every complete line is terminated in place and run, and whatever
+	 * partial line is left at the end is moved to the front of the buffer
+	 * once, ready for the next read.
+	 */
+
+	/* our connections are non-blocking, so don't use xread() here; it would
+	 * spin until data arrives */
+	do {
+		count = read(c->fd, c->recv_buf + c->recv_len,
+				recv_size - c->recv_len);
+	} while(count == -1 && errno == EINTR);
+	if(count == -1 && (errno == EAGAIN || errno == EWOULDBLOCK))
+		return 0;
+	if(count <= 0)
+		return -1;
+	c->bytes_in += (size_t)count;
+
+	start = c->recv_buf;
+	scan = c->recv_buf + c->recv_len;
+	end = scan + count;
+	while((nl = memchr(scan, '\n', (size_t)(end - scan)))) {
+		if(c->recv_discard) {
+			/* this is the end of an overlong line, nothing to run */
+			c->recv_discard = 0;
+		} else {
+			*nl = '\0';
+			if(run_command_line(c, start) == -2)
+				return -2;
+		}
+		start = scan = nl + 1;
+	}
+
+	c->recv_len = (size_t)(end - start);
+	if(c->recv_discard) {
+		c->recv_len = 0;
+	} else if(c->recv_len >= max_line) {
+		log_msg(LEVEL_WARN, "process_input, max line length exceeded");
+		c->recv_len = 0;
+		c->recv_discard = 1;
+		if(!c->scrape && write_to_connection(c, invalid_cmd) == -1)
+			return -2;
+		ret = -3;
+	} else if(start != c->recv_buf && c->recv_len) {
+		memmove(c->recv_buf, start, c->recv_len);
+	}
+
+	return ret;
+}
+
+/**
+ * Copy data into a connection's send ring buffer, wrapping around the end
+ * of the buffer as necessary.
+ * @param c the connection
+ * @param pos the ring position to start copying to
+ * @param data the data to copy
+ * @param len the number of bytes to copy, at most the buffer size
+ */
+static void send_buf_put(struct conn *c, size_t pos,
+		const char *data, size_t len)
+{
+	size_t first = c->send_size - pos;
+
+	if(first > len)
+		first = len;
+	memcpy(c->send_buf + pos, data, first);
+	memcpy(c->send_buf, data + first, len - first);
+}
+
+/**
+ * Find the length of a buffered line, including its newline.
+ * @param c the connection
+ * @param off the offset from the head of the buffer the line starts at
+ * @return the line length, or the remaining backlog if there is no newline
+ */
+static size_t send_buf_line(struct conn *c, size_t off)
+{
+	size_t len = 0;
+
+	while(off + len < c->send_len) {
+		len++;
+		if(c->send_buf[(c->send_head + off + len - 1) % c->send_size] == '\n')
 			break;
+	}
+	return len;
+}
+
+/**
+ * Discard the oldest complete line in a connection's send buffer. If the
+ * oldest line was already partly written to the socket, its remainder has
+ * to go out to keep the stream intact, so the line after it is discarded.
+ * @param c the connection
+ * @return 1 if a line was discarded, 0 if there was nothing to discard
+ */
+static int send_buf_drop_line(struct conn *c)
+{
+	char keep[SEND_BUF_SIZE];
+	size_t keeplen = 0, len;
+
+	if(c->send_partial) {
+		size_t i;
+		keeplen = send_buf_line(c, 0);
+		for(i = 0; i < keeplen; i++)
+			keep[i] = c->send_buf[(c->send_head + i) % c->send_size];
+	}
+	len = send_buf_line(c, keeplen);
+	if(len == 0)
+		return 0;
+
+	/* skip over both lines, then put the kept remainder back in front */
+	c->send_head = (c->send_head + keeplen + len) % c->send_size;
+	c->send_len -= keeplen + len;
+	if(keeplen) {
+		c->send_head = (c->send_head + c->send_size - keeplen) % c->send_size;
+		c->send_len += keeplen;
+		send_buf_put(c, c->send_head, keep, keeplen);
+	}
+	c->dropped++;
+	return 1;
+}
+
+/**
+ * Make a connection's send buffer bigger, so it has room for more data.
+ * What is buffered moves to the start of the new buffer.
+ * @param c the connection
+ * @param len the number of bytes that must fit in addition to the backlog
+ * @return 0 on success, -1 on allocation failure
+ */
+static int send_buf_grow(struct conn *c, size_t len)
+{
+	size_t size = c->send_size * 2, first;
+	char *buf;
+
+	while(size - c->send_len < len)
+		size *= 2;
+	buf = malloc(size);
+	if(!buf)
+		return -1;
+	first = c->send_size - c->send_head;
+	if(first > c->send_len)
+		first = c->send_len;
+	memcpy(buf, c->send_buf + c->send_head, first);
+	memcpy(buf + first, c->send_buf, c->send_len - first);
+	free(c->send_buf);
+	c->send_buf = buf;
+	c->send_size = size;
+	c->send_head = 0;
+	return 0;
+}
+
+/**
+ * Write as much of a connection's send buffer as the socket will take.
+ * Once the buffer is empty, we stop waiting for the socket to be writable.
+ * @param c the connection to flush
+ * @return 0 on success (even if data remains), -1 if the connection was
+ * closed because of a write failure
+ */
+static int flush_connection(struct conn *c)
+{
+	while(c->send_len) {
+		struct iovec iov[2];
+		int iovcnt = 1;
+		ssize_t count;
+		size_t last;
+
+		iov[0].iov_base = c->send_buf + c->send_head;
+		iov[0].iov_len = c->send_size - c->send_head;
+		if(iov[0].iov_len >= c->send_len) {
+			iov[0].iov_len = c->send_len;
+		} else {
+			iov[1].iov_base = c->send_buf;
+			iov[1].iov_len = c->send_len - iov[0].iov_len;
+			iovcnt = 2;
 		}
-		else {
-			/* nothing special, just keep looking */
-			c->recv_buf_pos++;
+		count = writev(c->fd, iov, iovcnt);
+		if(count == -1 && errno == EINTR)
+			continue;
+		if(count == -1 && (errno == EAGAIN || errno == EWOULDBLOCK))
+			return 0;
+		if(count <= 0) {
+			end_connection(c, 0);
+			return -1;
 		}
-		count--;
+		c->bytes_out += (size_t)count;
+		last = (c->send_head + (size_t)count - 1) % c->send_size;
+		c->send_partial = c->send_buf[last] != '\n';
+		c->send_head = (last + 1) % c->send_size;
+		c->send_len -= (size_t)count;
 	}
 
-	return ret;
+	c->send_head = 0;
+	if(c->send_size > SEND_BUF_SIZE) {
+		/* a big reply is out; the next output gets a normal buffer */
+		free(c->send_buf);
+		c->send_buf = NULL;
+		c->send_size = 0;
+	}
+	if(c->closing) {
+		end_connection(c, 0);
+		return -1;
+	}
+	watch_fd_events(c->fd, EPOLL_CTL_MOD, EPOLLIN);
+	return 0;
 }
 
 /**
- * Write a message to the currently connected clients.
+ * Write a message to a single connected client. Whatever the socket does
+ * not take right away is buffered and sent once the socket is writable.
+ * If the buffer is full, the slow client policy decides whether the oldest
+ * buffered lines are dropped or the connection is ended. The connection is
+ * also ended if the write fails.
+ * @param c the connection to write to
  * @param msg the message to write, including trailing newline
  * @return 0 on success, -1 on failure
  */
-int write_to_connections(const char *msg)
+int write_to_connection(struct conn *c, const char *msg)
 {
-	struct conn *c;
 	size_t len = strlen(msg);
-	/* print to stdout and all current open connections */
-	printf("response: %s", msg);
-	c = connections;
-	while(c) {
-		if(c->fd > -1) {
-			ssize_t ret = xwrite(c->fd, msg, len);
-			if(ret == -1)
+
+	if(c->fd < 0)
+		return -1;
+
+	/* the common case: nothing is waiting, so try the socket directly */
+	if(c->send_len == 0) {
+		ssize_t count;
+		do {
+			count = write(c->fd, msg, len);
+		} while(count == -1 && errno == EINTR);
+		if(count > 0)
+			c->bytes_out += (size_t)count;
+		if(count == (ssize_t)len)
+			return 0;
+		if(count == -1 && errno != EAGAIN && errno != EWOULDBLOCK) {
+			end_connection(c, 0);
+			return -1;
+		}
+		if(count > 0) {
+			msg += count;
+			len -= (size_t)count;
+			c->send_partial = 1;
+		}
+	}
+
+	if(!c->send_buf) {
+		c->send_buf = malloc(SEND_BUF_SIZE);
+		if(!c->send_buf) {
+			log_msg(LEVEL_ERROR, "malloc(): %s", strerror(errno));
+			end_connection(c, 0);
+			return -1;
+		}
+		c->send_size = SEND_BUF_SIZE;
+	}
+	while(c->send_size - c->send_len < len) {
+		if(c->send_grow) {
+			if(send_buf_grow(c, len) == -1) {
+				log_msg(LEVEL_ERROR, "malloc(): %s", strerror(errno));
 				end_connection(c, 0);
+				return -1;
+			}
+			break;
+		}
+		if(slow_policy == SLOW_DISCONNECT) {
+			log_msg(LEVEL_WARN, "connection %d not keeping up, closing", c->fd);
+			end_connection(c, 0);
+			return -1;
+		}
+		if(!send_buf_drop_line(c)) {
+			/* nothing left to make room with; lose this message instead */
+			c->dropped++;
+			return 0;
+		}
+	}
+
+	if(c->send_len == 0)
+		watch_fd_events(c->fd, EPOLL_CTL_MOD, EPOLLIN | EPOLLOUT);
+	send_buf_put(c, (c->send_head + c->send_len) % c->send_size, msg, len);
+	c->send_len += len;
+	return 0;
+}
+
+/**
+ * Get the request a connection is running a command line for.
+ * @param c the connection, may be NULL
+ * @param req where to store the request
+ * @return req, NULL if the command line has no request ID
+ */
+struct request_tag *conn_request(struct conn *c, struct request_tag *req)
+{
+	if(!c || !c->req_id[0])
+		return NULL;
+	req->conn = c;
+	req->serial = c->serial;
+	strcpy(req->id, c->req_id);
+	return req;
+}
+
+/**
+ * Tell a client what became of a command it gave a request ID, with a line
+ * like "ACK:42:sent:MVL1E". Events are "queued", "deduped" (an identical
+ * command was already waiting), "superseded" (a newer value replaced it
+ * before it was sent), "rejected" (the queue was full), "skipped" (the
+ * receiver is off), "sent", "answered", and "unanswered" (no reply came
+ * before the next command was sent or the receiver went away).
+ * @param req who asked for the command, may be NULL or have no ID; nothing
+ * is sent if the connection has been closed since
+ * @param event what happened to the command
+ * @param cmd the receiver command, e.g. "MVL1E"; NULL for none
+ */
+void request_ack(const struct request_tag *req, const char *event,
+		const char *cmd)
+{
+	struct conn *c;
+	char msg[BUF_SIZE * 2];
+
+	if(!req || !req->id[0])
+		return;
+	c = req->conn;
+	if(c->fd < 0 || c->serial != req->serial)
+		return;
+	if(cmd)
+		snprintf(msg, sizeof(msg), "ACK:%s:%s:%s\n", req->id, event, cmd);
+	else
+		snprintf(msg, sizeof(msg), "ACK:%s:%s\n", req->id, event);
+	if(strcmp(req->id, c->req_id) == 0)
+		c->req_acks++;
+	write_to_connection(c, msg);
+}
+
+/**
+ * Pick a connection for the broadcast in progress, unless it already is.
+ * @param c the connection
+ * @param count the number of connections picked so far, updated
+ */
+static void add_recipient(struct conn *c, size_t *count)
+{
+	if(c->bcast_seq != bcast_seq && c->fd > -1 && !c->scrape) {
+		c->bcast_seq = bcast_seq;
+		recipients[(*count)++] = c;
+	}
+}
+
+/**
+ * Write a message to the currently connected clients. Connections with
+ * subscriptions only get it if its key, the part between the first and
+ * the second colon, matches one of them; messages without a key go to
+ * everyone.
+ * @param msg the message to write, including trailing newline
+ * @return 0 on success, -1 on failure
+ */
+int write_to_connections(const char *msg)
+{
+	struct conn *c;
+	struct subscription *sub;
+	const char *key;
+	size_t i, len, count = 0, open_count = 0;
+
+	/* log and write to all current open connections */
+	log_msg(LEVEL_DEBUG, "response: %s", msg);
+	bcast_seq++;
+
+	key = strchr(msg, ':');
+	len = key ? strcspn(++key, ":\n") : 0;
+	if(filtered_conns == 0 || !key || key[len] != ':') {
+		for(c = connections; c; c = c->next)
+			add_recipient(c, &count);
+		open_count = count;
+	} else {
+		for(c = connections; c; c = c->next) {
+			if(c->fd > -1) {
+				open_count++;
+				if(!c->subs)
+					add_recipient(c, &count);
+			}
+		}
+		if(len < SUB_KEY_SIZE) {
+			char name[SUB_KEY_SIZE];
+			unsigned long hash;
+
+			memcpy(name, key, len);
+			name[len] = '\0';
+			hash = hash_sdbm(name);
+			for(sub = sub_buckets[hash & (SUB_BUCKETS - 1)]; sub;
+					sub = sub->next) {
+				if(sub->hash == hash && strcmp(sub->key, name) == 0)
+					add_recipient(sub->conn, &count);
+			}
+		}
+		for(sub = sub_prefixes; sub; sub = sub->next) {
+			if(sub->len <= len && memcmp(sub->key, key, sub->len) == 0)
+				add_recipient(sub->conn, &count);
+		}
+	}
+
+	/* writing may end connections and drop their subscriptions, so only
+	 * start once everyone is picked */
+	for(i = 0; i < count; i++)
+		write_to_connection(recipients[i], msg);
+	bcast_deliveries += count;
+	bcast_filtered += open_count - count;
+	return 0;
+}
+
+/** Counters and gauges kept for each receiver, found by their offset in
+ * struct receiver */
+static const struct rcvr_metric {
+	const char *name;
+	const char *type;
+	size_t offset;
+	/** whether the field is a size_t rather than an unsigned long */
+	int is_size;
+} rcvr_metrics[] = {
+	{ "onkyo_queue_depth", "gauge",
+		offsetof(struct receiver, queue.len), 1 },
+	{ "onkyo_queue_high_water", "gauge",
+		offsetof(struct receiver, queue.high_water), 1 },
+	{ "onkyo_commands_sent_total", "counter",
+		offsetof(struct receiver, cmds_sent), 0 },
+	{ "onkyo_commands_rejected_total", "counter",
+		offsetof(struct receiver, queue.rejected), 0 },
+	{ "onkyo_commands_skipped_total", "counter",
+		offsetof(struct receiver, queue.skipped), 0 },
+	{ "onkyo_commands_deduped_total", "counter",
+		offsetof(struct receiver, queue.deduped), 0 },
+	{ "onkyo_commands_superseded_total", "counter",
+		offsetof(struct receiver, queue.superseded), 0 },
+	{ "onkyo_commands_aged_total", "counter",
+		offsetof(struct receiver, queue.aged), 0 },
+	{ "onkyo_replies_missed_total", "counter",
+		offsetof(struct receiver, replies_missed), 0 },
+	{ "onkyo_messages_total", "counter",
+		offsetof(struct receiver, msgs_received), 0 },
+	{ "onkyo_messages_unparsed_total", "counter",
+		offsetof(struct receiver, msgs_unparsed), 0 },
+	{ "onkyo_messages_invalid_total", "counter",
+		offsetof(struct receiver, msgs_invalid), 0 },
+	{ "onkyo_read_errors_total", "counter",
+		offsetof(struct receiver, read_errors), 0 },
+	{ "onkyo_write_errors_total", "counter",
+		offsetof(struct receiver, write_errors), 0 },
+};
+
+/** Histograms kept for each receiver */
+static const struct rcvr_histogram {
+	const char *name;
+	size_t offset;
+} rcvr_histograms[] = {
+	{ "onkyo_queue_wait_ms", offsetof(struct receiver, queue.wait_hist) },
+	{ "onkyo_reply_ms",      offsetof(struct receiver, reply_hist) },
+};
+
+/**
+ * Write one line of statistics to a connection, as a protocol reply or,
+ * for a scrape, as it is.
+ * @param c the connection to write to
+ * @param fmt printf style format of the line, without a newline
+ */
+static void stats_printf(struct conn *c, const char *fmt, ...)
+	PRINTF_LIKE(2, 3);
+static void stats_printf(struct conn *c, const char *fmt, ...)
+{
+	char line[BUF_SIZE * 2];
+	size_t len = 0;
+	va_list args;
+	int n;
+
+	if(!c->scrape)
+		len = (size_t)sprintf(line, "OK:stats:");
+	va_start(args, fmt);
+	n = vsnprintf(line + len, sizeof(line) - len - 1, fmt, args);
+	va_end(args);
+	if(n < 0)
+		return;
+	len += (size_t)n;
+	if(len > sizeof(line) - 2)
+		len = sizeof(line) - 2;
+	line[len++] = '\n';
+	line[len] = '\0';
+	write_to_connection(c, line);
+}
+
+/**
+ * Announce the type of the metric whose values follow; only scrapes care.
+ */
+static void stats_type(struct conn *c, const char *name, const char *type)
+{
+	if(c->scrape)
+		stats_printf(c, "# TYPE %s %s", name, type);
+}
+
+/**
+ * Write out our statistics in the Prometheus text format: counters and
+ * gauges of the connections and of each receiver, and histograms of how
+ * long receiver commands waited in the queue and how long the receiver
+ * took to answer them. Clients get every line with "OK:stats:" in front.
+ * The statistics are easily more than the send buffer holds, so it grows
+ * to take all of them; only if an earlier reply that made it grow is still
+ * not sent does the slow client policy apply as usual.
+ * @param c the connection to write to
+ */
+void write_stats(struct conn *c)
+{
+	struct receiver *r;
+	struct conn *ptr;
+	size_t i, j, n, open = 0;
+
+	c->send_grow = c->send_size <= SEND_BUF_SIZE;
+
+	for(ptr = connections; ptr; ptr = ptr->next) {
+		if(ptr->fd > -1 && !ptr->scrape)
+			open++;
+	}
+	stats_type(c, "onkyo_connections", "gauge");
+	stats_printf(c, "onkyo_connections %zu", open);
+	stats_type(c, "onkyo_connections_total", "counter");
+	stats_printf(c, "onkyo_connections_total %lu", clients_total);
+	stats_type(c, "onkyo_broadcasts_total", "counter");
+	stats_printf(c, "onkyo_broadcasts_total %lu", bcast_seq);
+	stats_type(c, "onkyo_broadcast_deliveries_total", "counter");
+	stats_printf(c, "onkyo_broadcast_deliveries_total %lu",
+			bcast_deliveries);
+	stats_type(c, "onkyo_broadcast_filtered_total", "counter");
+	stats_printf(c, "onkyo_broadcast_filtered_total %lu", bcast_filtered);
+
+	for(i = 0; i < 2; i++) {
+		const char *name = i ? "onkyo_connection_bytes_out_total" :
+			"onkyo_connection_bytes_in_total";
+		stats_type(c, name, "counter");
+		for(ptr = connections; ptr; ptr = ptr->next) {
+			if(ptr->fd < 0 || ptr->scrape)
+				continue;
+			stats_printf(c, "%s{conn=\"%lu\"} %llu", name, ptr->serial,
+					i ? ptr->bytes_out : ptr->bytes_in);
+		}
+	}
+
+	for(i = 0; i < sizeof(rcvr_metrics) / sizeof(rcvr_metrics[0]); i++) {
+		const struct rcvr_metric *m = &rcvr_metrics[i];
+
+		stats_type(c, m->name, m->type);
+		for(r = receivers, n = 0; r; r = r->next, n++) {
+			const char *field = (const char *)r + m->offset;
+			unsigned long value;
+
+			if(m->is_size)
+				value = (unsigned long)*(const size_t *)field;
+			else
+				value = *(const unsigned long *)field;
+			stats_printf(c, "%s{receiver=\"%zu\"} %lu", m->name, n, value);
+		}
+	}
+
+	for(i = 0; i < sizeof(rcvr_histograms) / sizeof(rcvr_histograms[0]);
+			i++) {
+		const char *name = rcvr_histograms[i].name;
+
+		stats_type(c, name, "histogram");
+		for(r = receivers, n = 0; r; r = r->next, n++) {
+			const struct histogram *h = (const struct histogram *)
+				((const char *)r + rcvr_histograms[i].offset);
+			unsigned long total = 0;
+
+			for(j = 0; j < HIST_BUCKETS - 1; j++) {
+				total += h->counts[j];
+				stats_printf(c, "%s_bucket{receiver=\"%zu\",le=\"%lu\"} %lu",
+						name, n, histogram_bounds[j], total);
+			}
+			stats_printf(c, "%s_bucket{receiver=\"%zu\",le=\"+Inf\"} %lu",
+					name, n, h->count);
+			stats_printf(c, "%s_sum{receiver=\"%zu\"} %llu.%03llu", name, n,
+					h->sum / 1000, h->sum % 1000);
+			stats_printf(c, "%s_count{receiver=\"%zu\"} %lu", name, n,
+					h->count);
+		}
+	}
+	c->send_grow = 0;
+}
+
+/**
+ * Accept an incoming connection on a listening socket and set it up.
+ * @param listener the listening socket with a pending connection
+ */
+static void accept_connection(int listener)
+{
+	struct sockaddr saddr;
+	socklen_t sl = (socklen_t)sizeof(struct sockaddr);
+	int fd = accept(listener, &saddr, &sl);
+
+	if(fd >= 0) {
+		char remote[64];
+		char *ptr = remote;
+		switch(saddr.sa_family) {
+			case AF_INET:
+				inet_ntop(AF_INET, &((struct sockaddr_in *)&saddr)->sin_addr, ptr, sl);
+				break;
+			case AF_INET6:
+				inet_ntop(AF_INET6, &((struct sockaddr_in6 *)&saddr)->sin6_addr, ptr, sl);
+				break;
+			case AF_UNIX:
+				/* The sun_path field will be empty since this is the remote saddr */
+				ptr = "(unix socket)";
+				break;
+			default:
+				ptr = "(unknown)";
 		}
-		c = c->next;
+		log_msg(LEVEL_INFO, "connection opened, source: %s", ptr);
+		open_connection(fd, listener == stats_listener);
+	} else if(fd == -1 && (errno != EAGAIN && errno != EINTR)) {
+		log_msg(LEVEL_ERROR, "accept(): %s", strerror(errno));
+	}
+}
+
+/**
+ * Find the receiver using a given file descriptor.
+ * @param fd the file descriptor to look up
+ * @return the receiver, NULL if fd does not belong to a receiver
+ */
+static struct receiver *find_receiver(int fd)
+{
+	struct receiver *r;
+	for(r = receivers; r; r = r->next) {
+		if(r->fd == fd)
+			return r;
+	}
+	return NULL;
+}
+
+/**
+ * Stop using a receiver whose device went away, e.g. a USB serial adapter
+ * that was unplugged. It stays in our list, but nothing is sent to or
+ * read from it any more. A network receiver is connected to again later;
+ * commands queued until then are sent once it is back.
+ * @param r the receiver to close
+ */
+static void close_receiver(struct receiver *r)
+{
+	log_msg(LEVEL_ERROR, "closing receiver device %d", r->fd);
+	unwatch_fd(r->fd);
+	xclose(r->fd);
+	r->fd = -1;
+	/* whatever we were waiting for will not come */
+	if(r->awaiting_len) {
+		request_ack(&r->awaiting_req, "unanswered", r->awaiting);
+		r->awaiting_len = 0;
+	}
+	if(r->type == RCVR_NET) {
+		/* nothing of the old connection carries over */
+		r->recv_len = 0;
+		r->recv_discard = 0;
+		r->recv_skip = 0;
+		schedule_reconnect(r);
+	}
+}
+
+/**
+ * Determine if a file descriptor is one of our listening sockets.
+ * @param fd the file descriptor to look up
+ * @return 1 if fd is a listener, 0 otherwise
+ */
+static int is_listener(int fd)
+{
+	size_t i;
+	for(i = 0; i < listener_count; i++) {
+		if(listeners[i] == fd)
+			return 1;
 	}
 	return 0;
 }
 
+/**
+ * Raise our open file limit so it does not cap us below MAX_CONNECTIONS.
+ * Only the soft limit is touched; failure is not fatal.
+ */
+static void raise_fd_limit(void)
+{
+	struct rlimit rl;
+	/* leave room for receivers, listeners, logs and our own pipes */
+	rlim_t wanted = MAX_CONNECTIONS + 32;
+
+	if(getrlimit(RLIMIT_NOFILE, &rl) == -1 || rl.rlim_cur >= wanted)
+		return;
+	rl.rlim_cur = rl.rlim_max < wanted ? rl.rlim_max : wanted;
+	if(setrlimit(RLIMIT_NOFILE, &rl) == -1)
+		log_msg(LEVEL_WARN, "setrlimit(): %s", strerror(errno));
+}
+
 static const struct option opts[] = {
 	{"bind",      optional_argument, 0, 'b'},
 	{"daemon",    no_argument,       0, 'd'},
 	{"help",      no_argument,       0, 'h'},
 	{"log",       required_argument, 0, 'l'},
+	{"log-level", required_argument, 0, 'L'},
+	{"log-output",   required_argument, 0, 'o'},
+	{"log-rotate",   required_argument, 0, 'r'},
+	{"log-sync",     required_argument, 0, 'y'},
+	{"max-line",  required_argument, 0, 'm'},
+	{"net",       required_argument, 0, 'n'},
+	{"pacing",    required_argument, 0, 'p'},
+	{"pace-floor",   required_argument, 0, 'f'},
+	{"pace-timeout", required_argument, 0, 't'},
 	{"serial",    required_argument, 0, 's'},
+	{"slow",      required_argument, 0, 'w'},
+	{"snapshot",  no_argument,       0, 'S'},
 	{"socket",    required_argument, 0, 'u'},
+	{"stats",     required_argument, 0, 'x'},
 	{0,           0,                 0, 0  },
 };
 
 static void usage(char *argv[])
 {
 	printf("Usage: %s [options]\n\n", argv[0]);
-	printf("Daemon to monitor and control an Onkyo A/V receiver. Options are:\n\n");
-	printf("  -b, --bind [addr]      Bind and listen for incoming connections\n");
+	printf("Daemon to monitor and control an Onkyo A/V receiver. "
+			"Options are:\n\n");
+	printf("  -b, --bind [addr]      Bind and listen for incoming "
+			"connections\n");
 	printf("  -d, --daemon           Fork and run in background\n");
 	printf("  -h, --help             Show this help\n");
-	printf("  -l, --log <file>       Log raw I/O to specified file\n");
+	printf("  -l, --log <file>       Capture raw receiver I/O to specified "
+			"file\n");
+	printf("  -r, --log-rotate <kB>  Rotate the capture file at this size\n");
+	printf("  -y, --log-sync <when>  When to sync the capture file to disk\n");
+	printf("  -L, --log-level <lvl>  Log messages up to this level "
+			"(default info)\n");
+	printf("  -o, --log-output <dst> Where to log messages (default stderr)\n");
+	printf("  -m, --max-line <len>   Longest accepted command line "
+			"(default %d)\n", BUF_SIZE);
+	printf("  -p, --pacing <mode>    How to space out receiver commands\n");
+	printf("  -f, --pace-floor <n>   Adaptive pacing minimum gap in ms\n");
+	printf("  -t, --pace-timeout <n> Adaptive pacing reply timeout in ms\n");
+	printf("  -n, --net <addr>       Network address of an eISCP receiver\n");
 	printf("  -s, --serial <dev>     Serial device receiver is connected to\n");
+	printf("  -S, --snapshot         Send known receiver status to new "
+			"connections\n");
+	printf("  -w, --slow <policy>    What to do with clients that can't "
+			"keep up\n");
 	printf("  -u, --socket <file>    Listen for connections on UNIX socket\n");
+	printf("  -x, --stats <addr>     Serve statistics to scrapes on this "
+			"address\n");
 	printf("\n");
 	printf("By default, the daemon is dumb- it will not connect to a receiver "
 			"or listen on\nany address. Command line flags must be passed to "
@@ -787,6 +2137,46 @@ static void usage(char *argv[])
 			"acceptable. The default is to bind to all interfaces and use\n"
 			"port 8701.\n\n");
 
+	printf("A client that does not read its messages has up to %d bytes "
+			"buffered for it,\nplus a whole stats reply. After that, the "
+			"--slow policy applies: \"drop\"\n(the default) discards its "
+			"oldest messages, "
+			"\"disconnect\" closes the connection.\n\n", SEND_BUF_SIZE);
+
+	printf("For the -n/--net option, the address is given in host:port "
+			"format, where the\nport defaults to %s. A lost connection to a "
+			"network receiver is made again\nas soon as the receiver can be "
+			"reached.\n\n", EISCP_PORT);
+
+	printf("Receiver commands are sent %d ms apart with the \"fixed\" --pacing "
+			"(the default\nfor serial receivers). With \"adaptive\" pacing "
+			"(the default for network\nreceivers), the next command goes "
+			"out as soon as the receiver answers the\nprevious one, but no "
+			"sooner than the floor; a command that is not answered\nholds up "
+			"the next one for a little longer than the receiver usually takes "
+			"to\nanswer, and at most for the timeout. The floor and timeout "
+			"default to %d and\n%d ms for serial receivers, %d and %d ms for "
+			"network receivers.\n\n", COMMAND_WAIT, PACE_FLOOR, PACE_TIMEOUT,
+			NET_PACE_FLOOR, NET_PACE_TIMEOUT);
+
+	printf("The -x/--stats address is a host:service like for --bind, or the "
+			"path of a UNIX\nsocket. Statistics are served in the Prometheus "
+			"text format over HTTP, as\nthe \"stats\" command gives them to "
+			"clients.\n\n");
+
+	printf("The -l/--log capture records everything read from and written to "
+			"the receivers,\nwith a time stamp. It is written out in batches, "
+			"at least every %d ms. With\n--log-rotate, a full capture file is "
+			"renamed to file.1 (and older ones to\nfile.2 up to file.%d) and a "
+			"new one started. --log-sync is \"none\", \"rotate\"\n(the "
+			"default, sync each file once it is complete) or \"flush\" (sync "
+			"every\nbatch).\n\n", CAPTURE_FLUSH, CAPTURE_KEEP);
+
+	printf("Log levels are \"error\", \"warn\", \"info\" and \"debug\"; debug "
+			"logs every\ncommand and response. SIGUSR2 switches debug logging "
+			"on and off again. The\n--log-output can be \"stderr\", "
+			"\"syslog\", \"none\" or a file to append to.\n\n");
+
 	printf("Example:\n");
 	printf("  %s -d -b -s /dev/ttyS0\n\n", argv[0]);
 	printf("This will daemonize, listen on the default *:8701 address, and "
@@ -797,8 +2187,8 @@ static void usage(char *argv[])
 /**
  * Program main routine. Responsible for setting up all our initial monitoring
  * such as the signal pipe, serial devices, listeners, and valid commands. We
- * then enter our main event loop which does a select() on all available file
- * descriptors and takes the correct actions based on the results. This loop
+ * then enter our main event loop which waits on our epoll instance and takes
+ * the correct actions for each ready file descriptor. This loop
  * does not end unless a SIGINT is received, which will eventually trickle
  * down and call the #cleanup() function.
  * @param argc
@@ -812,10 +2202,14 @@ int main(int argc, char *argv[])
 	/* options storage */
 	int daemon = 0, bind_all = 0;
 	char *bind_addr = NULL, *socket_path = NULL;
-	char *log_path = NULL, *serialdev_path = NULL;
+	char *log_path = NULL, *serialdev_path = NULL, *log_dest = NULL;
+	char *net_addr = NULL, *stats_addr = NULL;
+	size_t log_rotate = 0;
+	enum capture_sync log_sync = SYNC_ROTATE;
 
 	/* options parsing */
-	while((opt = getopt_long(argc, argv, "b::dhl:s:u:", opts, NULL))) {
+	while((opt = getopt_long(argc, argv,
+			"b::df:hl:L:m:n:o:p:r:s:St:u:w:x:y:", opts, NULL))) {
 		if(opt < 0)
 			break;
 		switch(opt) {
@@ -835,12 +2229,104 @@ int main(int argc, char *argv[])
 			case 'l':
 				log_path = strdup(optarg);
 				break;
+			case 'L': {
+				int level = log_parse_level(optarg);
+				if(level == -1) {
+					usage(argv);
+					cleanup(EXIT_FAILURE);
+				}
+				log_set_level((enum log_level)level);
+				break;
+			}
+			case 'o':
+				if(log_open(optarg) == -1)
+					cleanup(EXIT_FAILURE);
+				free(log_dest);
+				log_dest = strdup(optarg);
+				break;
+			case 'm': {
+				char *end;
+				unsigned long len = strtoul(optarg, &end, 10);
+				/* leave room for at least one character and a newline */
+				if(*end || len < 2 || len > MAX_LINE_LIMIT) {
+					fprintf(stderr, "max line length must be between 2 "
+							"and %d\n", MAX_LINE_LIMIT);
+					cleanup(EXIT_FAILURE);
+				}
+				max_line = len;
+				recv_size = max_line > RECV_BUF_SIZE ? max_line : RECV_BUF_SIZE;
+				break;
+			}
+			case 'p':
+				if(strcmp(optarg, "fixed") == 0) {
+					pacing = PACING_FIXED;
+				} else if(strcmp(optarg, "adaptive") == 0) {
+					pacing = PACING_ADAPTIVE;
+				} else {
+					usage(argv);
+					cleanup(EXIT_FAILURE);
+				}
+				break;
+			case 'f':
+			case 't': {
+				char *end;
+				long ms = strtol(optarg, &end, 10);
+				if(*end || ms < 0 || ms > 60000) {
+					fprintf(stderr, "pacing times must be between 0 "
+							"and 60000 ms\n");
+					cleanup(EXIT_FAILURE);
+				}
+				if(opt == 'f')
+					pace_floor = ms;
+				else
+					pace_timeout = ms;
+				break;
+			}
+			case 'r': {
+				char *end;
+				unsigned long kb = strtoul(optarg, &end, 10);
+				if(*end || kb > 1048576) {
+					fprintf(stderr, "capture rotate size must be between 0 "
+							"and 1048576 kB\n");
+					cleanup(EXIT_FAILURE);
+				}
+				log_rotate = (size_t)kb * 1024;
+				break;
+			}
+			case 'y': {
+				int sync = capture_parse_sync(optarg);
+				if(sync == -1) {
+					usage(argv);
+					cleanup(EXIT_FAILURE);
+				}
+				log_sync = (enum capture_sync)sync;
+				break;
+			}
+			case 'n':
+				net_addr = strdup(optarg);
+				break;
 			case 's':
 				serialdev_path = strdup(optarg);
 				break;
+			case 'S':
+				send_snapshot = 1;
+				break;
 			case 'u':
 				socket_path = strdup(optarg);
 				break;
+			case 'x':
+				stats_addr = strdup(optarg);
+				break;
+			case 'w':
+				if(strcmp(optarg, "drop") == 0) {
+					slow_policy = SLOW_DROP;
+				} else if(strcmp(optarg, "disconnect") == 0) {
+					slow_policy = SLOW_DISCONNECT;
+				} else {
+					usage(argv);
+					cleanup(EXIT_FAILURE);
+				}
+				break;
 			case '?':
 				usage(argv);
 				cleanup(EXIT_FAILURE);
@@ -848,8 +2334,18 @@ int main(int argc, char *argv[])
 		}
 	}
 
+	/* set up our event loop, no descriptors can be opened before this */
+	raise_fd_limit();
+	epollfd = epoll_create1(0);
+	if(epollfd == -1) {
+		perror("epoll_create1()");
+		cleanup(EXIT_FAILURE);
+	}
+
 	/* set up our signal handlers */
 	pipe(signalpipe);
+	if(watch_fd(signalpipe[READ]) == -1)
+		cleanup(EXIT_FAILURE);
 	memset(&sa, 0, sizeof(struct sigaction));
 	sa.sa_handler = &pipehandler;
 	sa.sa_flags = SA_RESTART;
@@ -858,6 +2354,14 @@ int main(int argc, char *argv[])
 	sigaction(SIGINT, &sa, NULL);
 	sigaction(SIGPIPE, &sa, NULL);
 	sigaction(SIGUSR1, &sa, NULL);
+	sigaction(SIGUSR2, &sa, NULL);
+
+	/* init our command list; opening a receiver already queues commands */
+	if(init_commands() == -1)
+		cleanup(EXIT_FAILURE);
+	/* init our status processing */
+	if(init_statuses() == -1)
+		cleanup(EXIT_FAILURE);
 
 	/* open the serial connection to the receiver */
 	if(serialdev_path) {
@@ -866,11 +2370,19 @@ int main(int argc, char *argv[])
 		if(retval == -1)
 			cleanup(EXIT_FAILURE);
 	}
-
-	/* init our command list */
-	init_commands();
-	/* init our status processing */
-	init_statuses();
+	/* and the network receiver; the connection is made in the background */
+	if(net_addr) {
+		/* attempt to split our receiver address into host:port */
+		char *pos = strrchr(net_addr, ':');
+		if(pos) {
+			*pos = '\0';
+			pos++;
+		}
+		retval = open_net_receiver(net_addr, pos);
+		free(net_addr);
+		if(retval == -1)
+			cleanup(EXIT_FAILURE);
+	}
 
 	/* open our listener connections */
 	if(bind_all) {
@@ -896,57 +2408,76 @@ int main(int argc, char *argv[])
 		if(retval == -1)
 			cleanup(EXIT_FAILURE);
 	}
+	if(stats_addr) {
+		if(strchr(stats_addr, '/')) {
+			stats_listener = open_socket_listener(stats_addr);
+		} else {
+			/* host:port, as for the bind address */
+			char *pos = strrchr(stats_addr, ':');
+			if(pos) {
+				*pos = '\0';
+				pos++;
+			}
+			stats_listener = open_net_listener(stats_addr, pos);
+		}
+		free(stats_addr);
+		if(stats_listener == -1)
+			cleanup(EXIT_FAILURE);
+	}
 
-	/* log if we have a path from options parsing */
+	/* capture if we have a path from options parsing */
 	if(log_path) {
-		log_raw_serial(log_path);
+		retval = capture_open(log_path, log_rotate, log_sync);
 		free(log_path);
 		log_path = NULL;
+		if(retval == -1)
+			cleanup(EXIT_FAILURE);
 	}
 
 	/* background if everything was successful */
 	if(daemon) {
+		log_flush();
 		daemonize();
+		/* stderr is gone now */
+		if(!log_dest || strcmp(log_dest, "stderr") == 0)
+			log_open("none");
 	}
+	free(log_dest);
 
 	/* Terminal settings are all done. Now it is time to watch for input
 	 * on our socket and handle it as necessary. We also handle incoming
 	 * status messages from the receiver.
 	 *
-	 * Attempt to keep the crazyness in order:
-	 * signalpipe, receivers, listeners, connections
+	 * Every descriptor was registered with our epoll instance when it was
+	 * opened, so each pass only looks at the ones that are ready. Receivers
+	 * are walked on every pass for their timers and command queues, but
+	 * there are only ever a few of them.
 	 */
 	for(;;) {
-		int maxfd = -1;
-		fd_set readfds, writefds;
+		struct epoll_event events[MAX_EVENTS];
 		struct timeval now, timeoutval = { 0, 0 };
-		struct timeval *timeout = NULL;
-
-		size_t i;
+		int timeout = -1, send_ready = 0, n, i;
 		struct receiver *r;
-		struct conn *c;
-
-		/* get our file descriptor sets set up */
-		FD_ZERO(&readfds);
-		FD_ZERO(&writefds);
-		/* add our signal pipe file descriptor */
-		FD_SET(signalpipe[READ], &readfds);
-		maxfd = signalpipe[READ] > maxfd ? signalpipe[READ] : maxfd;
 
 		/* used for all timeout, etc. calculations */
 		gettimeofday(&now, NULL);
 
-		/* add our receiver list */
 		r = receivers;
 		while(r) {
 			struct timeval diff;
 
+			/* is it time to connect to a network receiver again? */
+			if(r->fd < 0 && r->next_connect.tv_sec) {
+				timeval_diff(&r->next_connect, &now, &diff);
+				if(timeval_positive(&diff))
+					timeoutval = timeval_min(&timeoutval, &diff);
+				else
+					connect_receiver(r);
+			}
 			if(r->fd < 0) {
 				r = r->next;
 				continue;
 			}
-			FD_SET(r->fd, &readfds);
-			maxfd = r->fd > maxfd ? r->fd : maxfd;
 
 			/* do we need to queue a power off command for sleep? */
 			if(r->zone2_sleep.tv_sec) {
@@ -954,7 +2485,7 @@ int main(int argc, char *argv[])
 				if(timeval_positive(&diff)) {
 					timeoutval = timeval_min(&timeoutval, &diff);
 				} else {
-					process_command(r, "zone2power off");
+					process_command(r, NULL, "zone2power off");
 					write_fakesleep_status(r, now, '2');
 					timeval_clear(r->zone2_sleep);
 				}
@@ -964,7 +2495,7 @@ int main(int argc, char *argv[])
 				if(timeval_positive(&diff)) {
 					timeoutval = timeval_min(&timeoutval, &diff);
 				} else {
-					process_command(r, "zone3power off");
+					process_command(r, NULL, "zone3power off");
 					write_fakesleep_status(r, now, '3');
 					timeval_clear(r->zone3_sleep);
 				}
@@ -989,10 +2520,10 @@ int main(int argc, char *argv[])
 				timeval_clear(r->next_sleep_update);
 			}
 
-			/* check for write possibility if we have commands in queue */
-			if(r->queue) {
+			/* don't block at all if we have commands ready to send */
+			if(r->queue.len && !r->connecting) {
 				if(can_send_command(r, &now, &diff)) {
-					FD_SET(r->fd, &writefds);
+					send_ready = 1;
 				} else {
 					/* We want the smallest timeout, so replace the
 					 * existing if new is smaller. */
@@ -1002,61 +2533,97 @@ int main(int argc, char *argv[])
 
 			r = r->next;
 		}
-		/* add all of our listeners */
-		for(i = 0; i < listener_count; i++) {
-			if(listeners[i] > -1) {
-				FD_SET(listeners[i], &readfds);
-				maxfd = listeners[i] > maxfd ? listeners[i] : maxfd;
-			}
-		}
-		/* add all of our active connections */
-		c = connections;
-		while(c) {
-			if(c->fd > -1) {
-				FD_SET(c->fd, &readfds);
-				maxfd = c->fd > maxfd ? c->fd : maxfd;
-			}
-			c = c->next;
-		}
 
-		if(timeoutval.tv_sec != 0 || timeoutval.tv_usec != 0) {
-			timeout = &timeoutval;
+		if(send_ready) {
+			timeout = 0;
+		} else if(timeoutval.tv_sec != 0 || timeoutval.tv_usec != 0) {
+			/* round up so we never wake up just before a deadline */
+			timeout = (int)(timeoutval.tv_sec * 1000 +
+					(timeoutval.tv_usec + 999) / 1000);
 		}
+		/* write out what was logged since the last time around; try again
+		 * soon if the log output could not take all of it */
+		if(log_flush() && (timeout == -1 || timeout > LOG_RETRY))
+			timeout = LOG_RETRY;
+		/* captured traffic is written out in batches */
+		n = capture_flush();
+		if(n != -1 && (timeout == -1 || timeout > n))
+			timeout = n;
 		/* our main waiting point */
-		retval = select(maxfd + 1, &readfds, &writefds, NULL, timeout);
-		if(retval == -1 && errno == EINTR)
+		n = epoll_wait(epollfd, events, MAX_EVENTS, timeout);
+		if(n == -1 && errno == EINTR)
 			continue;
-		if(retval == -1) {
-			perror("select()");
+		if(n == -1) {
+			log_msg(LEVEL_ERROR, "epoll_wait(): %s", strerror(errno));
 			cleanup(EXIT_FAILURE);
 		}
-		/* check to see if we have signals waiting */
-		if(FD_ISSET(signalpipe[READ], &readfds)) {
-			int signo;
-			/* We don't want to read more than one signal out of the pipe.
-			 * Anything else in there will be handled the next go-around. */
-			xread(signalpipe[READ], &signo, sizeof(int));
-			realhandler(signo);
+
+		for(i = 0; i < n; i++) {
+			int fd = events[i].data.fd;
+			struct conn *c;
+
+			if(fd == signalpipe[READ]) {
+				int signo;
+				/* We don't want to read more than one signal out of the
+				 * pipe. Anything else in there will be handled the next
+				 * go-around. */
+				xread(signalpipe[READ], &signo, sizeof(int));
+				realhandler(signo);
+			} else if((size_t)fd < conns_by_fd_size && conns_by_fd[fd]) {
+				c = conns_by_fd[fd];
+				/* a connection with buffered output that can take more */
+				if(events[i].events & EPOLLOUT) {
+					if(flush_connection(c) == -1)
+						continue;
+				}
+				/* a connection with data ready to read */
+				if(events[i].events & ~EPOLLOUT) {
+					int ret = process_input(c);
+					/* ret == 0: success
+					 * ret == -1: connection hit EOF or a read error
+					 * ret == -2: connection already closed
+					 */
+					if(ret == -1)
+						end_connection(c, 0);
+				}
+			} else if((r = find_receiver(fd))) {
+				if(r->connecting) {
+					/* a network receiver connection is done or failed */
+					finish_connect(r);
+				} else if(process_incoming_message(r) == -2) {
+					/* status messages from a receiver */
+					close_receiver(r);
+				}
+			}
+		}
+		/* Accept new connections only after everything else has been
+		 * handled. A descriptor closed above may be handed out again by
+		 * accept(), and must not be mistaken for a ready connection. */
+		for(i = 0; i < n; i++) {
+			if(is_listener(events[i].data.fd))
+				accept_connection(events[i].data.fd);
 		}
+
+		gettimeofday(&now, NULL);
 		r = receivers;
 		while(r) {
+			struct timeval diff;
+
 			if(r->fd < 0) {
 				r = r->next;
 				continue;
 			}
-			/* check if we have a status message from the receivers */
-			if(FD_ISSET(r->fd, &readfds)) {
-				process_incoming_message(r, logfd);
-			}
 			/* check if we have outgoing messages to send to receiver */
-			if(r->queue != NULL && FD_ISSET(r->fd, &writefds)) {
-				rcvr_send_command(r);
+			if(r->queue.len && !r->connecting &&
+					can_send_command(r, &now, &diff) &&
+					rcvr_send_command(r) == -2) {
+				close_receiver(r);
+				r = r->next;
+				continue;
 			}
 			/* do we need to send a sleep status update? */
 			if(r->next_sleep_update.tv_sec) {
-				struct timeval diff, *next;
-				gettimeofday(&now, NULL);
-				next = &r->next_sleep_update;
+				struct timeval *next = &r->next_sleep_update;
 
 				timeval_diff(&now, next, &diff);
 				if(timeval_positive(&diff)) {
@@ -1075,51 +2642,6 @@ int main(int argc, char *argv[])
 			}
 			r = r->next;
 		}
-		/* check to see if we have listeners ready to accept */
-		for(i = 0; i < listener_count; i++) {
-			if(listeners[i] > -1 && FD_ISSET(listeners[i], &readfds)) {
-				/* accept the incoming connection on the socket */
-				struct sockaddr saddr;
-				socklen_t sl = (socklen_t)sizeof(struct sockaddr);
-				int fd = accept(listeners[i], &saddr, &sl);
-				if(fd >= 0) {
-					char remote[64];
-					char *ptr = remote;
-					switch(saddr.sa_family) {
-						case AF_INET:
-							inet_ntop(AF_INET, &((struct sockaddr_in *)&saddr)->sin_addr, ptr, sl);
-							break;
-						case AF_INET6:
-							inet_ntop(AF_INET6, &((struct sockaddr_in6 *)&saddr)->sin6_addr, ptr, sl);
-							break;
-						case AF_UNIX:
-							/* The sun_path field will be empty since this is the remote saddr */
-							ptr = "(unix socket)";
-							break;
-						default:
-							ptr = "(unknown)";
-					}
-					printf("connection opened, source: %s\n", ptr);
-					open_connection(fd);
-				} else if(fd == -1 && (errno != EAGAIN && errno != EINTR)) {
-					perror("accept()");
-				}
-			}
-		}
-		/* check if we have connections with data ready to read */
-		c = connections;
-		while(c) {
-			if(c->fd > -1 && FD_ISSET(c->fd, &readfds)) {
-				int ret = process_input(c);
-				/* ret == 0: success */
-				/* ret == -1: connection hit EOF
-				 * ret == -2: connection closed, failed write
-				 */
-				if(ret == -1 || ret == -2)
-					end_connection(c, 0);
-			}
-			c = c->next;
-		}
 	}
 	cleanup(EXIT_FAILURE);
 }
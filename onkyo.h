@@ -13,20 +13,121 @@
 /** The default port number to listen on (note: it is a string, not a num) */
 #define LISTENPORT "8701"
 
+/** The port network receivers accept eISCP connections on */
+#define EISCP_PORT "60128"
+
+/** Length of the header in front of every eISCP message */
+#define EISCP_HEADER_SIZE 16
+
 /** Max size for our connection pool */
-#define MAX_CONNECTIONS 200
+#define MAX_CONNECTIONS 4096
+
+/** Max number of ready descriptors handled per event loop wakeup */
+#define MAX_EVENTS 64
+
+/** Number of buckets of a latency histogram; the last one has no upper
+ * bound */
+#define HIST_BUCKETS 12
+
+/** Size of a request ID a client may put in front of a command line,
+ * including the terminating NUL */
+#define REQ_ID_SIZE 16
+
+/** Max number of key patterns a connection may subscribe to */
+#define MAX_SUBSCRIPTIONS 16
+
+/** Size of a subscription key pattern, including the terminating NUL */
+#define SUB_KEY_SIZE 32
+
+/** Number of hash buckets for exact key subscriptions; this must be a
+ * power of two */
+#define SUB_BUCKETS 64
 
 /** Size to use for all static buffers */
 #define BUF_SIZE 64
 
+/** Minimum size of the input buffer of each connection; it is never
+ * smaller than the max line length */
+#define RECV_BUF_SIZE 4096
+
+/** Size of the input buffer of each receiver; this is also the longest
+ * status message we accept */
+#define RCVR_BUF_SIZE 512
+
+/** Upper bound for the configurable max line length of client commands */
+#define MAX_LINE_LIMIT 65536
+
+/** Size of the output buffer of each connection; this is also the backlog
+ * at which the slow client policy kicks in. The buffer grows as needed to
+ * hold a whole statistics reply, and shrinks back once it is sent. */
+#define SEND_BUF_SIZE 4096
+
 /** Time (in milliseconds) to wait between receiver commands */
 #define COMMAND_WAIT 80
 
-/* allow marking of unused function parameters */
+/** Default shortest time (in milliseconds) between receiver commands when
+ * pacing by replies */
+#define PACE_FLOOR 10
+
+/** Default longest time (in milliseconds) to wait for a reply when pacing
+ * by replies */
+#define PACE_TIMEOUT 500
+
+/** The same for network receivers, which answer within a few milliseconds
+ * instead of having to wait for a 9600 baud serial line */
+#define NET_PACE_FLOOR 5
+#define NET_PACE_TIMEOUT 250
+
+/** Shortest and longest time (in seconds) to wait before connecting to a
+ * network receiver again */
+#define RECONNECT_MIN 1
+#define RECONNECT_MAX 60
+
+/** Max number of commands waiting to be sent to a receiver; this must be
+ * a power of two */
+#define CMD_QUEUE_SIZE 256
+
+/** Time (in milliseconds) a command may wait behind commands of a higher
+ * priority before it is sent anyway */
+#define CMD_QUEUE_AGING 1000
+
+/** Size of the buffer log messages wait in until the event loop writes
+ * them out */
+#define LOG_BUF_SIZE 65536
+
+/** Time (in milliseconds) to wait before retrying to write log messages
+ * the log destination did not take */
+#define LOG_RETRY 100
+
+/** Size of each of the two buffers captured receiver traffic waits in;
+ * the event loop fills one while the capture writer thread writes out the
+ * other */
+#define CAPTURE_BUF_SIZE 65536
+
+/** Time (in milliseconds) captured receiver traffic may wait before it is
+ * written out */
+#define CAPTURE_FLUSH 1000
+
+/** Time (in milliseconds) to wait before handing captured traffic to the
+ * capture writer thread again when it was still busy */
+#define CAPTURE_RETRY 100
+
+/** Number of rotated capture files kept besides the current one */
+#define CAPTURE_KEEP 4
+
+/** Max number of distinct status keys remembered per receiver */
+#define STATUS_CACHE_SIZE 64
+
+/** Time (in seconds) after which a remembered status value is stale */
+#define STATUS_CACHE_AGE 300
+
+/* allow marking of unused function parameters and printf-like functions */
 #if defined(__GNUC__)
 #define UNUSED __attribute__((unused))
+#define PRINTF_LIKE(fmt, args) __attribute__((format(printf, fmt, args)))
 #else
 #define UNUSED
+#define PRINTF_LIKE(fmt, args)
 #endif
 
 /* characters standard to the start and end of our communication messages */
@@ -44,53 +145,337 @@ enum power {
 	POWER_ON    = -1,
 };
 
+/** Log message levels; a message is logged if its level is at or below
+ * the current log level */
+enum log_level {
+	LEVEL_ERROR = 0,
+	LEVEL_WARN,
+	LEVEL_INFO,
+	LEVEL_DEBUG,
+};
+
+/** How a receiver is attached */
+enum rcvr_type {
+	RCVR_SERIAL, /**< serial device, ISCP */
+	RCVR_NET,    /**< TCP connection, eISCP */
+};
+
+/** Which way captured receiver traffic went */
+enum capture_dir {
+	CAPTURE_RX = 'r', /**< read from the receiver */
+	CAPTURE_TX = 't', /**< written to the receiver */
+};
+
+/** When a capture file is synced to disk */
+enum capture_sync {
+	SYNC_NONE = 0, /**< never, leave it to the kernel */
+	SYNC_ROTATE,   /**< once it is complete, when rotated or closed */
+	SYNC_FLUSH,    /**< every time buffered traffic is written out */
+};
+
+/** How the time between two receiver commands is decided */
+enum pacing {
+	PACING_FIXED,    /**< always wait COMMAND_WAIT */
+	PACING_ADAPTIVE, /**< send as soon as the previous command is answered */
+};
+
 /** Keep track of two paired file descriptors */
 enum pipehalfs { READ = 0, WRITE = 1 };
 
+/** How a queued command combines with commands for the same setting that
+ * are already waiting to be sent */
+enum cmd_kind {
+	/** status request, e.g. "MVLQSTN"; an identical waiting one is enough */
+	CMD_QUERY,
+	/** relative change or opaque command, e.g. "MVLUP"; an identical
+	 * waiting one is enough */
+	CMD_STEP,
+	/** absolute value, e.g. "MVL28"; replaces a waiting older value */
+	CMD_SET,
+};
+
+/** Order in which waiting receiver commands are sent, highest first */
+enum cmd_priority {
+	PRIO_POWER = 0,
+	PRIO_SET,
+	PRIO_QUERY,
+	PRIO_COUNT,
+};
+
+/** How many times (in microseconds) fell into each of a fixed set of
+ * buckets, see histogram_bounds */
+struct histogram {
+	unsigned long counts[HIST_BUCKETS];
+	unsigned long count;
+	unsigned long long sum;
+};
+
+/** Who asked for a receiver command by request ID, to be told what
+ * becomes of it */
+struct request_tag {
+	struct conn *conn;
+	/** serial number of the connection; conn may have been reused for
+	 * another connection since */
+	unsigned long serial;
+	/** the request ID, empty if nobody is waiting to hear about it */
+	char id[REQ_ID_SIZE];
+};
+
 /** Represents a command waiting to be sent to the receiver */
-struct cmdqueue {
+struct queued_cmd {
+	/** hash of the setting the command changes, e.g. "MVL" */
 	unsigned long hash;
+	/** next slot + 1 in the same hash bucket, 0 if this is the last */
+	unsigned short chain;
+	/** next slot + 1 of the same priority (or of the free list), 0 if this
+	 * is the last */
+	unsigned short next;
+	/** length of the setting prefix at the start of cmd */
+	unsigned char key_len;
+	unsigned char kind;
+	unsigned char prio;
+	struct timeval queued;
+	struct request_tag req;
 	char cmd[BUF_SIZE];
-	struct cmdqueue *next;
+};
+
+/** The FIFO of waiting commands of one priority, and how long the commands
+ * of that priority had to wait */
+struct cmd_class {
+	/** oldest and newest slot + 1, 0 if empty */
+	unsigned short head;
+	unsigned short tail;
+	size_t len;
+	unsigned long sent;
+	/** total and longest time (in microseconds) spent waiting */
+	unsigned long long wait_total;
+	unsigned long wait_max;
+};
+
+/** Commands waiting to be sent to the receiver, in one FIFO per priority.
+ * Queued commands are also chained into hash buckets of their setting by
+ * slot number, newest first, so finding a duplicate or an older value never
+ * needs a walk of the whole queue. */
+struct cmdqueue {
+	struct queued_cmd slots[CMD_QUEUE_SIZE];
+	/** first slot + 1 of each bucket chain, 0 for an empty bucket */
+	unsigned short buckets[CMD_QUEUE_SIZE];
+	struct cmd_class prios[PRIO_COUNT];
+	/** first slot + 1 of the list of released slots, 0 if empty */
+	unsigned short free;
+	/** number of slots ever handed out */
+	unsigned short used;
+	size_t len;
+	/** the most commands that were ever waiting at once */
+	size_t high_water;
+	/** commands refused because the queue was full */
+	unsigned long rejected;
+	/** waiting values replaced by a newer value before being sent */
+	unsigned long superseded;
+	/** commands sent ahead of higher priorities because they waited
+	 * too long */
+	unsigned long aged;
+	/** commands not queued because the same command was already waiting */
+	unsigned long deduped;
+	/** commands thrown away because the receiver was off */
+	unsigned long skipped;
+	/** time spent waiting by the commands of all priorities */
+	struct histogram wait_hist;
+};
+
+/** The last status message seen for a given status key, e.g. "volume" */
+struct cached_status {
+	unsigned long hash;
+	struct timeval when;
+	char msg[BUF_SIZE];
 };
 
 /** Our Receiver device and associated dealings */
 struct receiver {
 	int fd;
-	int type;
+	enum rcvr_type type;
+	/** position in the list of receivers, counting from 0 */
+	unsigned int id;
+	/** address of a network receiver, kept for reconnecting */
+	char *host;
+	char *service;
+	/** whether a connect() to a network receiver is still in progress */
+	int connecting;
+	/** when to try again to connect to a network receiver, and how long
+	 * to wait (in seconds) if that fails too */
+	struct timeval next_connect;
+	long connect_wait;
 	enum power power;
 	unsigned long cmds_sent;
 	unsigned long msgs_received;
+	/** messages we have no translation for, sent on as "OK:todo:" */
+	unsigned long msgs_unparsed;
+	/** messages that were not receiver messages at all */
+	unsigned long msgs_invalid;
+	unsigned long read_errors;
+	unsigned long write_errors;
 	struct timeval last_cmd;
+	/** how commands are paced, and the adaptive pacing floor and timeout
+	 * in milliseconds */
+	enum pacing pacing;
+	long pace_floor;
+	long pace_timeout;
+	/** the last command sent while its reply is outstanding; a reply has
+	 * to start with its first awaiting_len characters */
+	char awaiting[BUF_SIZE];
+	size_t awaiting_len;
+	/** whether a reply to an earlier command may still arrive, which makes
+	 * the time it takes to reply to this one unreliable */
+	int awaiting_late;
+	/** who asked for the command awaiting a reply */
+	struct request_tag awaiting_req;
+	/** smoothed time (in microseconds) the receiver takes to reply and its
+	 * mean deviation; 0 until the first reply is seen */
+	long reply_avg;
+	long reply_dev;
+	/** commands that got no reply before the next one was sent */
+	unsigned long replies_missed;
+	/** time the receiver took to reply */
+	struct histogram reply_hist;
 	struct timeval zone2_sleep;
 	struct timeval zone3_sleep;
 	struct timeval next_sleep_update;
-	struct cmdqueue *queue;
+	struct cmdqueue queue;
+	struct cached_status cache[STATUS_CACHE_SIZE];
+	/** bytes of a not yet complete status message */
+	char recv_buf[RCVR_BUF_SIZE];
+	size_t recv_len;
+	/** whether we are skipping the rest of an overlong message */
+	int recv_discard;
+	/** bytes of an overlong eISCP message still to be skipped */
+	size_t recv_skip;
 	struct receiver *next;
 };
 
+/** A connection to a receiver and associated receive and send buffers */
+struct conn {
+	int fd;
+	/** number of connections opened before this one, plus one */
+	unsigned long serial;
+	/** request ID of the command line being run, empty if none */
+	char req_id[REQ_ID_SIZE];
+	/** acknowledgements sent for the command line being run */
+	unsigned int req_acks;
+	/** whether this is a statistics scrape rather than a client; it is
+	 * sent nothing but the statistics, then closed */
+	int scrape;
+	/** whether to close the connection once its output is sent */
+	int closing;
+	unsigned long long bytes_in;
+	unsigned long long bytes_out;
+	char *recv_buf;
+	/** number of bytes of a not yet complete line in recv_buf */
+	size_t recv_len;
+	/** whether we are skipping the rest of an overlong line */
+	int recv_discard;
+	/** ring buffer of output not yet accepted by the socket */
+	char *send_buf;
+	/** size of send_buf, SEND_BUF_SIZE unless it grew for a reply */
+	size_t send_size;
+	size_t send_head;
+	size_t send_len;
+	/** whether send_buf may grow instead of the slow client policy
+	 * applying, while a reply is written that should arrive whole */
+	int send_grow;
+	/** whether the oldest line in send_buf has already been partly sent */
+	int send_partial;
+	/** number of lines discarded because the client could not keep up */
+	unsigned long dropped;
+	/** key patterns this connection wants; NULL means everything */
+	struct subscription *subs;
+	size_t sub_count;
+	/** number of the last broadcast this connection was picked for */
+	unsigned long bcast_seq;
+	struct conn *next;
+};
+
+
+/** A key in a hash_index; an empty slot has a NULL key */
+struct hash_slot {
+	unsigned long hash;
+	const char *key;
+	void *value;
+};
+
+/** An open addressing (linear probing) hash table of string keys */
+struct hash_index {
+	size_t mask;
+	struct hash_slot *slots;
+};
 
 /* onkyo.c - general functions */
+int write_to_connection(struct conn *c, const char *msg);
 int write_to_connections(const char *msg);
+int conn_subscribe(struct conn *c, char *patterns);
+int conn_unsubscribe(struct conn *c, char *patterns);
+size_t conn_subscriptions(const struct conn *c, char *buf, size_t size);
+struct request_tag *conn_request(struct conn *c, struct request_tag *req);
+void write_stats(struct conn *c);
+void request_ack(const struct request_tag *req, const char *event,
+		const char *cmd);
 
 /* receiver.c - receiver interaction functions, status processing */
-void init_statuses(void);
+int init_statuses(void);
+void free_statuses(void);
+int rcvr_queue_command(struct receiver *rcvr, const char *prefix,
+		const char *arg, const struct request_tag *req);
 int rcvr_send_command(struct receiver *rcvr);
-int process_incoming_message(struct receiver *rcvr, int logfd);
+int process_incoming_message(struct receiver *rcvr);
+const char *rcvr_cached_status(struct receiver *rcvr, const char *key,
+		struct timeval *now);
+int rcvr_write_snapshot(struct receiver *rcvr, struct conn *c,
+		struct timeval *now);
 
 /* command.c - user command processing */
-void init_commands(void);
-int process_command(struct receiver *rcvr, const char *str);
+int init_commands(void);
+void free_commands(void);
+int process_command(struct receiver *rcvr, struct conn *c, const char *str);
+int process_conn_command(struct conn *c, const char *str);
 int is_power_command(const char *cmd);
 int write_fakesleep_status(struct receiver *rcvr,
 		struct timeval now, char zone);
 
+/* log.c - buffered, leveled logging */
+extern int log_threshold;
+/** whether messages of a level end up anywhere at all */
+#define log_wants(level) ((int)(level) <= log_threshold)
+int log_open(const char *dest);
+void log_close(void);
+void log_set_level(enum log_level level);
+enum log_level log_get_level(void);
+void log_toggle_debug(void);
+const char *log_level_name(enum log_level level);
+int log_parse_level(const char *name);
+void log_msg(enum log_level level, const char *fmt, ...) PRINTF_LIKE(2, 3);
+int log_flush(void);
+
+/* capture.c - timestamped capture of raw receiver traffic */
+int capture_parse_sync(const char *name);
+int capture_open(const char *path, size_t rotate, enum capture_sync sync);
+void capture_close(void);
+void capture_record(enum capture_dir dir, const struct receiver *rcvr,
+		const char *data, size_t len);
+int capture_flush(void);
+void capture_show_status(void);
+
 /* util.c - trivial utility functions */
 int xopen(const char *path, int oflag);
 int xclose(int fd);
 ssize_t xread(int fd, void *buf, size_t len);
 ssize_t xwrite(int fd, const void *buf, size_t len);
 unsigned long hash_sdbm(const char *str);
+int hash_index_init(struct hash_index *idx, size_t count);
+int hash_index_add(struct hash_index *idx, const char *key, void *value);
+void *hash_index_find(const struct hash_index *idx,
+		const char *key, unsigned long hash);
+void hash_index_free(struct hash_index *idx);
+extern const unsigned long histogram_bounds[HIST_BUCKETS - 1];
+void histogram_add(struct histogram *h, unsigned long usec);
 
 void timeval_diff(struct timeval * restrict a,
 		struct timeval * restrict b, struct timeval * restrict result);
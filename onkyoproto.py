@@ -0,0 +1,116 @@
+"""
+The daemon's line protocol as its clients see it: the hello line, the status
+keys and how to decode their values, shared by frontend.py (python2) and
+asyncclient.py (python3).
+"""
+
+HELLO_MESSAGE = "OK:onkyocontrol"
+STATUSES = [ 'power', 'mute', 'mode', 'volume', 'input', 'tune', 'sleep',
+        'zone2power', 'zone2mute', 'zone2volume', 'zone2input', 'zone2tune',
+        'zone2sleep' ]
+
+def verify_frequency(freq):
+    """
+    Verify that a frequency value given by the user can be mapped to an FM
+    or AM frequency. If it is a valid FM frequency, return the value as a
+    float; if it is a valid AM frequency return it as an int. If the frequency
+    is not valid, raise a CommandException.
+    """
+    try:
+        floatval = float(freq)
+    except ValueError:
+        raise CommandException("Frequency not valid: %s" % freq)
+    # attempt to validate the frequency
+    if floatval < 87.4 or floatval > 108.0:
+        # try AM instead
+        if floatval < 530 or floatval > 1710:
+            # we failed both validity tests
+            raise CommandException("Frequency not valid: %s" % freq)
+        else:
+            # valid AM frequency
+            return "AM", int(floatval)
+    else:
+        # valid FM frequency
+        return "FM", floatval
+
+def _onoff(value):
+    return value == "on"
+
+# Every status key the daemon emits, mapped to the converter for the value
+# portion of its "OK:key:value" line. Values keep any embedded colons, e.g.
+# "OK:mode:Neo:6 Cinema".
+RESPONSES = {
+    'power': _onoff,
+    'mute': _onoff,
+    'volume': int,
+    'dbvolume': int,
+    'input': str,
+    'mode': str,
+    'tune': str,
+    'preset': int,
+    'sleep': int,
+    'swlevel': int,
+    'avsync': int,
+    'memory': str,
+    'display': str,
+    'dimmer': str,
+    'latenight': str,
+    're-eq': _onoff,
+    'audyssey': _onoff,
+    'dynamiceq': _onoff,
+    'hdmiout': _onoff,
+    'resolution': str,
+    'audioselector': str,
+    'triggera': _onoff,
+    'triggerb': _onoff,
+    'triggerc': _onoff,
+
+    'zone2power': _onoff,
+    'zone2mute': _onoff,
+    'zone2mode': str,
+    'zone2volume': int,
+    'zone2dbvolume': int,
+    'zone2input': str,
+    'zone2tune': str,
+    'zone2preset': int,
+    'zone2sleep': int,
+
+    'zone3power': _onoff,
+    'zone3mute': _onoff,
+    'zone3volume': int,
+    'zone3dbvolume': int,
+    'zone3input': str,
+    'zone3tune': str,
+    'zone3preset': int,
+    'zone3sleep': int,
+
+    # raw receiver messages the daemon does not know how to translate
+    'todo': str,
+}
+
+def decode_line(line):
+    """
+    Decode a single "OK:key:value" response line into a (key, value) tuple
+    using the RESPONSES table. Returns None if the line is not a status
+    message we know about; raises ValueError if the value is malformed.
+    """
+    # this runs for every line received, so keep it to a single split
+    try:
+        code, key, value = line.split(":", 2)
+    except ValueError:
+        return None
+    converter = RESPONSES.get(key)
+    if converter is None or code != "OK":
+        return None
+    return key, converter(value)
+
+class OnkyoClientException(Exception):
+    pass
+
+class ConnectionError(OnkyoClientException):
+    pass
+
+class CommandException(OnkyoClientException):
+    pass
+
+# vim: set ts=4 sw=4 et:
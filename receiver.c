@@ -22,6 +22,8 @@
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
+#include <unistd.h>
+#include <errno.h>
 
 #include "onkyo.h"
 
@@ -29,7 +31,6 @@ extern const char * const rcvr_err;
 
 /** A mapping of receiver status value to returned message */
 struct status {
-	unsigned long hash;
 	const char *key;
 	const char *value;
 };
@@ -37,328 +38,769 @@ struct status {
 /** A mapping of receiver power status value to returned message as well as
  * helping to internally track power on/off state */
 struct power_status {
-	unsigned long hash;
 	const char *key;
 	const char *value;
 	int zone;
 	int power;
 };
 
+/**
+ * Work out how a receiver command argument changes its setting.
+ * @param arg the command without its prefix, e.g. "QSTN" or "28"
+ * @return the kind of command
+ */
+static enum cmd_kind arg_kind(const char *arg)
+{
+	if(strcmp(arg, "QSTN") == 0)
+		return CMD_QUERY;
+	if(strncmp(arg, "UP", 2) == 0 || strncmp(arg, "DOWN", 4) == 0
+			|| strcmp(arg, "TG") == 0)
+		return CMD_STEP;
+	return CMD_SET;
+}
+
+/**
+ * Work out how a receiver command combines with waiting commands for the
+ * same setting.
+ * @param prefix the setting part of the command, e.g. "MVL"; empty for
+ * commands we know nothing about
+ * @param arg the rest of the command, e.g. "QSTN" or "28"
+ * @return the kind of command
+ */
+static enum cmd_kind command_kind(const char *prefix, const char *arg)
+{
+	if(!*prefix)
+		return CMD_STEP;
+	return arg_kind(arg);
+}
+
+/**
+ * Record who asked for a queued command.
+ * @param qc the queued command
+ * @param req who asked for it, NULL if nobody
+ */
+static void set_request(struct queued_cmd *qc, const struct request_tag *req)
+{
+	if(req) {
+		qc->req = *req;
+	} else {
+		qc->req.conn = NULL;
+		qc->req.id[0] = '\0';
+	}
+}
+
+/**
+ * Queue a receiver command to be sent when the receiver is ready for it.
+ * If the same command is already waiting in the queue, it is not queued
+ * again. A new absolute value for a setting replaces a value for the same
+ * setting that has not been sent yet, keeping its place in the queue,
+ * unless a relative change of that setting was queued in between.
+ * @param rcvr the receiver the command should be queued for
+ * @param prefix the setting part of the command, e.g. "MVL"; may be empty
+ * @param arg the rest of the command, e.g. "QSTN" or "28"
+ * @param req who asked for the command and is told what becomes of it,
+ * NULL if nobody
+ * @return 0 if the command is now queued, -1 if it is too long, -3 if the
+ * queue is full
+ */
+int rcvr_queue_command(struct receiver *rcvr, const char *prefix,
+		const char *arg, const struct request_tag *req)
+{
+	struct cmdqueue *q = &rcvr->queue;
+	struct queued_cmd *qc;
+	struct cmd_class *cls;
+	enum cmd_kind kind;
+	unsigned long hashval;
+	unsigned short *bucket, i;
+	size_t slot, key_len;
+	char cmd[BUF_SIZE];
+
+	if(strlen(prefix) + strlen(arg) >= BUF_SIZE) {
+		request_ack(req, "rejected", NULL);
+		return -1;
+	}
+	sprintf(cmd, "%s%s", prefix, arg);
+
+	/* commands we know nothing about are their own setting */
+	kind = command_kind(prefix, arg);
+	key_len = *prefix ? strlen(prefix) : strlen(cmd);
+	hashval = hash_sdbm(*prefix ? prefix : cmd);
+	bucket = &q->buckets[hashval & (CMD_QUEUE_SIZE - 1)];
+	for(i = *bucket; i; i = q->slots[i - 1].chain) {
+		qc = &q->slots[i - 1];
+		if(qc->hash != hashval || qc->key_len != key_len
+				|| strncmp(qc->cmd, cmd, key_len) != 0)
+			continue;
+		if(strcmp(qc->cmd, cmd) == 0) {
+			/* command already in our queue, skip second copy; whoever
+			 * asks for it first hears about it */
+			q->deduped++;
+			if(req && !qc->req.id[0]) {
+				qc->req = *req;
+				request_ack(req, "queued", cmd);
+			} else {
+				request_ack(req, "deduped", cmd);
+			}
+			return 0;
+		}
+		if(kind != CMD_SET || qc->kind == CMD_QUERY)
+			continue;
+		if(qc->kind == CMD_STEP) {
+			/* the older value must go out before the relative change */
+			break;
+		}
+		/* newest waiting value for this setting, overwrite it */
+		request_ack(&qc->req, "superseded", qc->cmd);
+		strcpy(qc->cmd, cmd);
+		set_request(qc, req);
+		request_ack(req, "queued", cmd);
+		q->superseded++;
+		return 0;
+	}
+
+	if(q->len == CMD_QUEUE_SIZE) {
+		log_msg(LEVEL_WARN, "command queue full, dropping %s", cmd);
+		q->rejected++;
+		request_ack(req, "rejected", cmd);
+		return -3;
+	}
+
+	if(q->free) {
+		slot = q->free - 1;
+		q->free = q->slots[slot].next;
+	} else {
+		slot = q->used++;
+	}
+	qc = &q->slots[slot];
+	qc->hash = hashval;
+	qc->key_len = (unsigned char)key_len;
+	qc->kind = (unsigned char)kind;
+	strcpy(qc->cmd, cmd);
+	set_request(qc, req);
+	gettimeofday(&qc->queued, NULL);
+	qc->chain = *bucket;
+	*bucket = (unsigned short)(slot + 1);
+
+	/* power first so everything after it is not thrown away, then anything
+	 * a user asked to change, then status queries */
+	if(is_power_command(*prefix ? prefix : cmd))
+		qc->prio = PRIO_POWER;
+	else if(kind == CMD_QUERY)
+		qc->prio = PRIO_QUERY;
+	else
+		qc->prio = PRIO_SET;
+	cls = &q->prios[qc->prio];
+	qc->next = 0;
+	if(cls->tail)
+		q->slots[cls->tail - 1].next = (unsigned short)(slot + 1);
+	else
+		cls->head = (unsigned short)(slot + 1);
+	cls->tail = (unsigned short)(slot + 1);
+	cls->len++;
+
+	q->len++;
+	if(q->len > q->high_water)
+		q->high_water = q->len;
+	request_ack(req, "queued", cmd);
+	return 0;
+}
+
+/**
+ * Pick the priority the next command should come from. This is the highest
+ * priority with a waiting command, unless the oldest command of some
+ * priority has waited longer than CMD_QUEUE_AGING; then the command that
+ * has waited longest of those goes first.
+ * @param q the queue to look at; it must not be empty
+ * @param now time value to use as 'now'
+ * @return the priority to take the next command from
+ */
+static enum cmd_priority queue_pick(struct cmdqueue *q, struct timeval *now)
+{
+	struct timeval *oldest = NULL;
+	int prio, pick = -1, first = -1;
+
+	/* the usual case: everything waiting has the same priority */
+	for(prio = 0; prio < PRIO_COUNT; prio++) {
+		if(q->prios[prio].len == q->len)
+			return (enum cmd_priority)prio;
+	}
+
+	for(prio = 0; prio < PRIO_COUNT; prio++) {
+		struct queued_cmd *qc;
+		struct timeval diff;
+
+		if(!q->prios[prio].head)
+			continue;
+		if(first == -1)
+			first = prio;
+		qc = &q->slots[q->prios[prio].head - 1];
+		timeval_diff(now, &qc->queued, &diff);
+		if(diff.tv_sec * 1000 + diff.tv_usec / 1000 < CMD_QUEUE_AGING)
+			continue;
+		if(!oldest || timercmp(&qc->queued, oldest, <)) {
+			oldest = &qc->queued;
+			pick = prio;
+		}
+	}
+
+	if(pick == -1)
+		return (enum cmd_priority)first;
+	if(pick != first)
+		q->aged++;
+	return (enum cmd_priority)pick;
+}
+
+/**
+ * Remove the next command to send from a command queue, see queue_pick().
+ * @param q the queue to remove from
+ * @param now time value to use as 'now'
+ * @return the removed command, which stays valid until the next command
+ * is queued; NULL if the queue is empty
+ */
+static struct queued_cmd *queue_pop(struct cmdqueue *q, struct timeval *now)
+{
+	struct queued_cmd *qc;
+	struct cmd_class *cls;
+	struct timeval diff;
+	unsigned short *link, slot;
+	unsigned long waited;
+
+	if(q->len == 0)
+		return NULL;
+
+	cls = &q->prios[queue_pick(q, now)];
+	slot = cls->head;
+	qc = &q->slots[slot - 1];
+	cls->head = qc->next;
+	if(!cls->head)
+		cls->tail = 0;
+	cls->len--;
+
+	/* unlink it from its bucket chain; chains are almost always one long */
+	link = &q->buckets[qc->hash & (CMD_QUEUE_SIZE - 1)];
+	while(*link != slot)
+		link = &q->slots[*link - 1].chain;
+	*link = qc->chain;
+
+	qc->next = q->free;
+	q->free = slot;
+	q->len--;
+
+	/* the clock may have been set back while the command waited */
+	timeval_diff(now, &qc->queued, &diff);
+	waited = diff.tv_sec < 0 ? 0 :
+		(unsigned long)(diff.tv_sec * 1000000 + diff.tv_usec);
+	cls->sent++;
+	cls->wait_total += waited;
+	if(waited > cls->wait_max)
+		cls->wait_max = waited;
+	histogram_add(&q->wait_hist, waited);
+	return qc;
+}
+
 /**
  * Get the next receiver command that should be sent. This implementation has
  * logic to discard non-power commands if the receiver is not powered up.
  * @param rcvr the receiver to pull a command out of the queue for
- * @return the command to send (must be freed), NULL if none available
+ * @return the command to send, which stays valid until the next command is
+ * queued; NULL if none available
  */
-static struct cmdqueue *next_rcvr_command(struct receiver *rcvr)
+static struct queued_cmd *next_rcvr_command(struct receiver *rcvr)
 {
+	struct queued_cmd *qc;
+	struct timeval now;
+
 	/* Determine whether we should send the command. This depends on two
 	 * factors:
 	 * 1. If the power is on, always send the command.
 	 * 2. If the power is off, send only power commands through.
 	 */
-	while(rcvr->queue) {
-		/* dequeue the next cmd queue item */
-		struct cmdqueue *ptr = rcvr->queue;
-		rcvr->queue = rcvr->queue->next;
-
-		if(rcvr->power || is_power_command(ptr->cmd)) {
-			return ptr;
+	gettimeofday(&now, NULL);
+	while((qc = queue_pop(&rcvr->queue, &now))) {
+		if(rcvr->power || is_power_command(qc->cmd)) {
+			return qc;
 		} else {
-			printf("skipping command as receiver power appears to be off\n");
-			free(ptr);
+			log_msg(LEVEL_DEBUG,
+					"skipping command as receiver power appears to be off");
+			rcvr->queue.skipped++;
+			request_ack(&qc->req, "skipped", qc->cmd);
 		}
 	}
 	return NULL;
 }
 
+/** Store a 32 bit number in network byte order. */
+static void put_be32(unsigned char *p, unsigned long val)
+{
+	p[0] = (unsigned char)(val >> 24);
+	p[1] = (unsigned char)(val >> 16);
+	p[2] = (unsigned char)(val >> 8);
+	p[3] = (unsigned char)val;
+}
+
+/** Read a 32 bit number in network byte order. */
+static unsigned long get_be32(const char *buf)
+{
+	const unsigned char *p = (const unsigned char *)buf;
+
+	return ((unsigned long)p[0] << 24) | ((unsigned long)p[1] << 16) |
+		((unsigned long)p[2] << 8) | (unsigned long)p[3];
+}
+
+/**
+ * Fill in the eISCP header for a message.
+ * @param buf the start of the packet, with room for the header
+ * @param len the length of the message following the header
+ */
+static void eiscp_header(char *buf, size_t len)
+{
+	unsigned char *hdr = (unsigned char *)buf;
+
+	memcpy(hdr, "ISCP", 4);
+	put_be32(hdr + 4, EISCP_HEADER_SIZE);
+	put_be32(hdr + 8, (unsigned long)len);
+	/* version 1, then three reserved bytes */
+	hdr[12] = 1;
+	hdr[13] = hdr[14] = hdr[15] = 0;
+}
+
 /** 
  * Send a command to the receiver. This should be used when a write() to the
  * given file descriptor is known to be non-blocking; e.g. after a select()
  * call on the descriptor.
  * @param rcvr the receiver to send a command to from the attached queue
- * @return 0 on success or no action taken, -1 on failure
+ * @return 0 on success or no action taken, -1 on failure, -2 if the
+ * receiver did not take the command and has to be closed
  */
 int rcvr_send_command(struct receiver *rcvr)
 {
-	struct cmdqueue *ptr;
+	struct queued_cmd *ptr;
 
-	if(!rcvr->queue)
+	if(!rcvr->queue.len)
 		return -1;
 
 	ptr = next_rcvr_command(rcvr);
 	if(ptr) {
 		ssize_t retval;
-		size_t cmdsize;
-		char fullcmd[BUF_SIZE * 2];
+		size_t cmdsize, hdrsize;
+		char fullcmd[EISCP_HEADER_SIZE + BUF_SIZE * 2];
 
 		cmdsize = strlen(START_SEND) + strlen(ptr->cmd) + strlen(END_SEND);
 		if(cmdsize >= BUF_SIZE * 2) {
-			fprintf(stderr, "send_command, command too large: %zd\n", cmdsize);
+			log_msg(LEVEL_ERROR, "send_command, command too large: %zd",
+					cmdsize);
 			return -1;
 		}
 
-		sprintf(fullcmd, START_SEND "%s" END_SEND, ptr->cmd);
-
-		/* write the command */
-		retval = xwrite(rcvr->fd, fullcmd, cmdsize);
+		/* network receivers want the header in front of the message */
+		hdrsize = rcvr->type == RCVR_NET ? EISCP_HEADER_SIZE : 0;
+		sprintf(fullcmd + hdrsize, START_SEND "%s" END_SEND, ptr->cmd);
+		if(hdrsize)
+			eiscp_header(fullcmd, cmdsize);
+		cmdsize += hdrsize;
+
+		/* write the command; a network receiver gets a single try, as
+		 * waiting for room on its socket would stall everything else */
+		if(rcvr->type == RCVR_NET) {
+			do {
+				retval = write(rcvr->fd, fullcmd, cmdsize);
+			} while(retval == -1 && errno == EINTR);
+		} else {
+			retval = xwrite(rcvr->fd, fullcmd, cmdsize);
+		}
+		if(retval > 0)
+			capture_record(CAPTURE_TX, rcvr, fullcmd, (size_t)retval);
 		/* set our last sent time */
 		gettimeofday(&(rcvr->last_cmd), NULL);
-		/* print command to console; newline is already in command */
-		printf("command:  %s", fullcmd);
-		free(ptr);
+		/* The receiver answers a new value with that value, and anything
+		 * else with a status message of the same prefix; seeing it is what
+		 * paces the next command. */
+		rcvr->awaiting_late = rcvr->awaiting_len != 0;
+		if(rcvr->awaiting_late) {
+			rcvr->replies_missed++;
+			request_ack(&rcvr->awaiting_req, "unanswered", rcvr->awaiting);
+		}
+		strcpy(rcvr->awaiting, ptr->cmd);
+		rcvr->awaiting_req = ptr->req;
+		rcvr->awaiting_len = strlen(ptr->cmd);
+		if(rcvr->awaiting_len > 3 && arg_kind(ptr->cmd + 3) != CMD_SET)
+			rcvr->awaiting_len = 3;
+		log_msg(LEVEL_DEBUG, "command:  %s", fullcmd + hdrsize);
 
 		if(retval < 0 || ((size_t)retval) != cmdsize) {
-			fprintf(stderr, "send_command, write returned %zd\n", retval);
-			printf("%s", rcvr_err);
-			return -1;
+			log_msg(LEVEL_ERROR, "send_command, write returned %zd", retval);
+			rcvr->write_errors++;
+			/* a network receiver that takes nothing more, or only part of a
+			 * message, is stuck; start over with a new connection */
+			return rcvr->type == RCVR_NET ? -2 : -1;
 		}
 		rcvr->cmds_sent++;
+		request_ack(&ptr->req, "sent", ptr->cmd);
 	}
 	return 0;
 }
 
-/** 
- * Handle a pending status message coming from the receiver. This is most
- * likely called after a select() on the serial fd returned that a read will
- * not block. It may also be used to get the status message that is returned
- * after sending a command.
- * @param serialfd the file descriptor the receiver is accessible on
- * @param status the status string returned by the receiver
- * @return the read size on success, -1 on failure
- */
-static ssize_t rcvr_handle_status(int serialfd, char **status)
-{
-	ssize_t retval;
-	char buf[BUF_SIZE];
-
-	memset(buf, 0, BUF_SIZE);
-	/* read the status message that should be present */
-	retval = xread(serialfd, &buf, BUF_SIZE - 1);
-
-	/* if we had a returned status, we are good to go */
-	if(retval > 0) {
-		buf[retval] = '\0';
-		/* return the status message if asked for */
-		if(status)  {
-			size_t alloc_size = (size_t)retval + 1;
-			*status = malloc(alloc_size * sizeof(char));
-			if(*status)
-				memcpy(*status, buf, alloc_size);
-		}
-		return retval;
-	}
-
-	fprintf(stderr, "handle_status, read value was empty\n");
-	return -1;
-}
-
 /**
  * Array to hold all status messages that can easily be transposed into
  * one of our own status messages. We can't handle all of them this way,
  * but for those we can this is a code and time saver.
  */
 static struct status statuses[] = {
-	{ 0, "AMT00", "OK:mute:off\n" },
-	{ 0, "AMT01", "OK:mute:on\n" },
-
-	{ 0, "SLI00", "OK:input:DVR\n" },
-	{ 0, "SLI01", "OK:input:Cable\n" },
-	{ 0, "SLI02", "OK:input:TV\n" },
-	{ 0, "SLI03", "OK:input:AUX\n" },
-	{ 0, "SLI04", "OK:input:AUX2\n" },
-	{ 0, "SLI05", "OK:input:PC\n" },
-	{ 0, "SLI10", "OK:input:DVD\n" },
-	{ 0, "SLI20", "OK:input:Tape\n" },
-	{ 0, "SLI22", "OK:input:Phono\n" },
-	{ 0, "SLI23", "OK:input:CD\n" },
-	{ 0, "SLI24", "OK:input:FM Tuner\n" },
-	{ 0, "SLI25", "OK:input:AM Tuner\n" },
-	{ 0, "SLI26", "OK:input:Tuner\n" },
-	{ 0, "SLI27", "OK:input:Music Server\n" },
-	{ 0, "SLI28", "OK:input:Internet Radio\n" },
-	{ 0, "SLI29", "OK:input:USB\n" },
-	{ 0, "SLI2A", "OK:input:USB Rear\n" },
-	{ 0, "SLI40", "OK:input:Port\n" },
-	{ 0, "SLI30", "OK:input:Multichannel\n" },
-	{ 0, "SLI31", "OK:input:XM Radio\n" },
-	{ 0, "SLI32", "OK:input:Sirius Radio\n" },
-	{ 0, "SLIFF", "OK:input:Audyssey Speaker Setup\n" },
-
-	{ 0, "LMD00", "OK:mode:Stereo\n" },
-	{ 0, "LMD01", "OK:mode:Direct\n" },
-	{ 0, "LMD07", "OK:mode:Mono Movie\n" },
-	{ 0, "LMD08", "OK:mode:Orchestra\n" },
-	{ 0, "LMD09", "OK:mode:Unplugged\n" },
-	{ 0, "LMD0A", "OK:mode:Studio-Mix\n" },
-	{ 0, "LMD0B", "OK:mode:TV Logic\n" },
-	{ 0, "LMD0C", "OK:mode:All Channel Stereo\n" },
-	{ 0, "LMD0D", "OK:mode:Theater-Dimensional\n" },
-	{ 0, "LMD0F", "OK:mode:Mono\n" },
-	{ 0, "LMD10", "OK:mode:Test Tone\n" },
-	{ 0, "LMD11", "OK:mode:Pure Audio\n" },
-	{ 0, "LMD13", "OK:mode:Full Mono\n" },
-	{ 0, "LMD15", "OK:mode:DTS Surround Sensation\n" },
-	{ 0, "LMD16", "OK:mode:Audyssey DSX\n" },
-	{ 0, "LMD40", "OK:mode:Straight Decode\n" },
-	{ 0, "LMD41", "OK:mode:Dolby EX/DTS ES\n" },
-	{ 0, "LMD42", "OK:mode:THX Cinema\n" },
-	{ 0, "LMD43", "OK:mode:THX Surround EX\n" },
-	{ 0, "LMD44", "OK:mode:THX Music\n" },
-	{ 0, "LMD45", "OK:mode:THX Games\n" },
-	{ 0, "LMD80", "OK:mode:Pro Logic IIx Movie\n" },
-	{ 0, "LMD81", "OK:mode:Pro Logic IIx Music\n" },
-	{ 0, "LMD82", "OK:mode:Neo:6 Cinema\n" },
-	{ 0, "LMD83", "OK:mode:Neo:6 Music\n" },
-	{ 0, "LMD84", "OK:mode:PLIIx THX Cinema\n" },
-	{ 0, "LMD85", "OK:mode:Neo:6 THX Cinema\n" },
-	{ 0, "LMD86", "OK:mode:Pro Logic IIx Game\n" },
-	{ 0, "LMD88", "OK:mode:Neural THX\n" },
-	{ 0, "LMDN/A", "ERROR:mode:N/A\n" },
-
-	{ 0, "MEMLOCK", "OK:memory:locked\n" },
-	{ 0, "MEMUNLK", "OK:memory:unlocked\n" },
-	{ 0, "MEMN/A",  "ERROR:memory:N/A\n" },
-
-	{ 0, "ZMT00", "OK:zone2mute:off\n" },
-	{ 0, "ZMT01", "OK:zone2mute:on\n" },
-
-	{ 0, "ZVLN/A", "ERROR:zone2volume:N/A\n" },
-
-	{ 0, "SLZ00", "OK:zone2input:DVR\n" },
-	{ 0, "SLZ01", "OK:zone2input:Cable\n" },
-	{ 0, "SLZ02", "OK:zone2input:TV\n" },
-	{ 0, "SLZ03", "OK:zone2input:AUX\n" },
-	{ 0, "SLZ04", "OK:zone2input:AUX2\n" },
-	{ 0, "SLZ10", "OK:zone2input:DVD\n" },
-	{ 0, "SLZ20", "OK:zone2input:Tape\n" },
-	{ 0, "SLZ22", "OK:zone2input:Phono\n" },
-	{ 0, "SLZ23", "OK:zone2input:CD\n" },
-	{ 0, "SLZ24", "OK:zone2input:FM Tuner\n" },
-	{ 0, "SLZ25", "OK:zone2input:AM Tuner\n" },
-	{ 0, "SLZ26", "OK:zone2input:Tuner\n" },
-	{ 0, "SLZ30", "OK:zone2input:Multichannel\n" },
-	{ 0, "SLZ31", "OK:zone2input:XM Radio\n" },
-	{ 0, "SLZ32", "OK:zone2input:Sirius Radio\n" },
-	{ 0, "SLZ7F", "OK:zone2input:Off\n" },
-	{ 0, "SLZ80", "OK:zone2input:Source\n" },
-
-	{ 0, "MT300", "OK:zone3mute:off\n" },
-	{ 0, "MT301", "OK:zone3mute:on\n" },
-
-	{ 0, "VL3N/A", "ERROR:zone3volume:N/A\n" },
-
-	{ 0, "SL300", "OK:zone3input:DVR\n" },
-	{ 0, "SL301", "OK:zone3input:Cable\n" },
-	{ 0, "SL302", "OK:zone3input:TV\n" },
-	{ 0, "SL303", "OK:zone3input:AUX\n" },
-	{ 0, "SL304", "OK:zone3input:AUX2\n" },
-	{ 0, "SL310", "OK:zone3input:DVD\n" },
-	{ 0, "SL320", "OK:zone3input:Tape\n" },
-	{ 0, "SL322", "OK:zone3input:Phono\n" },
-	{ 0, "SL323", "OK:zone3input:CD\n" },
-	{ 0, "SL324", "OK:zone3input:FM Tuner\n" },
-	{ 0, "SL325", "OK:zone3input:AM Tuner\n" },
-	{ 0, "SL326", "OK:zone3input:Tuner\n" },
-	{ 0, "SL330", "OK:zone3input:Multichannel\n" },
-	{ 0, "SL331", "OK:zone3input:XM Radio\n" },
-	{ 0, "SL332", "OK:zone3input:Sirius Radio\n" },
-	{ 0, "SL37F", "OK:zone3input:Off\n" },
-	{ 0, "SL380", "OK:zone3input:Source\n" },
-
-	{ 0, "DIF00", "OK:display:Volume\n" },
-	{ 0, "DIF01", "OK:display:Mode\n" },
-	{ 0, "DIF02", "OK:display:Digital Format\n" },
-	{ 0, "DIFN/A", "ERROR:display:N/A\n" },
-
-	{ 0, "DIM00", "OK:dimmer:Bright\n" },
-	{ 0, "DIM01", "OK:dimmer:Dim\n" },
-	{ 0, "DIM02", "OK:dimmer:Dark\n" },
-	{ 0, "DIM03", "OK:dimmer:Shut-off\n" },
-	{ 0, "DIM08", "OK:dimmer:Bright (LED off)\n" },
-	{ 0, "DIMN/A", "ERROR:dimmer:N/A\n" },
-
-	{ 0, "LTN00", "OK:latenight:off\n" },
-	{ 0, "LTN01", "OK:latenight:low\n" },
-	{ 0, "LTN02", "OK:latenight:high\n" },
-
-	{ 0, "RAS00", "OK:re-eq:off\n" },
-	{ 0, "RAS01", "OK:re-eq:on\n" },
-
-	{ 0, "ADY00", "OK:audyssey:off\n" },
-	{ 0, "ADY01", "OK:audyssey:on\n" },
-	{ 0, "ADQ00", "OK:dynamiceq:off\n" },
-	{ 0, "ADQ01", "OK:dynamiceq:on\n" },
-
-	{ 0, "HDO00", "OK:hdmiout:off\n" },
-	{ 0, "HDO01", "OK:hdmiout:on\n" },
-
-	{ 0, "RES00", "OK:resolution:Through\n" },
-	{ 0, "RES01", "OK:resolution:Auto\n" },
-	{ 0, "RES02", "OK:resolution:480p\n" },
-	{ 0, "RES03", "OK:resolution:720p\n" },
-	{ 0, "RES04", "OK:resolution:1080i\n" },
-	{ 0, "RES05", "OK:resolution:1080p\n" },
-
-	{ 0, "SLA00", "OK:audioselector:Auto\n" },
-	{ 0, "SLA01", "OK:audioselector:Multichannel\n" },
-	{ 0, "SLA02", "OK:audioselector:Analog\n" },
-	{ 0, "SLA03", "OK:audioselector:iLink\n" },
-	{ 0, "SLA04", "OK:audioselector:HDMI\n" },
-
-	{ 0, "TGA00", "OK:triggera:off\n" },
-	{ 0, "TGA01", "OK:triggera:on\n" },
-	{ 0, "TGAN/A", "ERROR:triggera:N/A\n" },
-
-	{ 0, "TGB00", "OK:triggerb:off\n" },
-	{ 0, "TGB01", "OK:triggerb:on\n" },
-	{ 0, "TGBN/A", "ERROR:triggerb:N/A\n" },
-
-	{ 0, "TGC00", "OK:triggerc:off\n" },
-	{ 0, "TGC01", "OK:triggerc:on\n" },
-	{ 0, "TGCN/A", "ERROR:triggerc:N/A\n" },
+	{ "AMT00", "OK:mute:off\n" },
+	{ "AMT01", "OK:mute:on\n" },
+
+	{ "SLI00", "OK:input:DVR\n" },
+	{ "SLI01", "OK:input:Cable\n" },
+	{ "SLI02", "OK:input:TV\n" },
+	{ "SLI03", "OK:input:AUX\n" },
+	{ "SLI04", "OK:input:AUX2\n" },
+	{ "SLI05", "OK:input:PC\n" },
+	{ "SLI10", "OK:input:DVD\n" },
+	{ "SLI20", "OK:input:Tape\n" },
+	{ "SLI22", "OK:input:Phono\n" },
+	{ "SLI23", "OK:input:CD\n" },
+	{ "SLI24", "OK:input:FM Tuner\n" },
+	{ "SLI25", "OK:input:AM Tuner\n" },
+	{ "SLI26", "OK:input:Tuner\n" },
+	{ "SLI27", "OK:input:Music Server\n" },
+	{ "SLI28", "OK:input:Internet Radio\n" },
+	{ "SLI29", "OK:input:USB\n" },
+	{ "SLI2A", "OK:input:USB Rear\n" },
+	{ "SLI40", "OK:input:Port\n" },
+	{ "SLI30", "OK:input:Multichannel\n" },
+	{ "SLI31", "OK:input:XM Radio\n" },
+	{ "SLI32", "OK:input:Sirius Radio\n" },
+	{ "SLIFF", "OK:input:Audyssey Speaker Setup\n" },
+
+	{ "LMD00", "OK:mode:Stereo\n" },
+	{ "LMD01", "OK:mode:Direct\n" },
+	{ "LMD07", "OK:mode:Mono Movie\n" },
+	{ "LMD08", "OK:mode:Orchestra\n" },
+	{ "LMD09", "OK:mode:Unplugged\n" },
+	{ "LMD0A", "OK:mode:Studio-Mix\n" },
+	{ "LMD0B", "OK:mode:TV Logic\n" },
+	{ "LMD0C", "OK:mode:All Channel Stereo\n" },
+	{ "LMD0D", "OK:mode:Theater-Dimensional\n" },
+	{ "LMD0F", "OK:mode:Mono\n" },
+	{ "LMD10", "OK:mode:Test Tone\n" },
+	{ "LMD11", "OK:mode:Pure Audio\n" },
+	{ "LMD13", "OK:mode:Full Mono\n" },
+	{ "LMD15", "OK:mode:DTS Surround Sensation\n" },
+	{ "LMD16", "OK:mode:Audyssey DSX\n" },
+	{ "LMD40", "OK:mode:Straight Decode\n" },
+	{ "LMD41", "OK:mode:Dolby EX/DTS ES\n" },
+	{ "LMD42", "OK:mode:THX Cinema\n" },
+	{ "LMD43", "OK:mode:THX Surround EX\n" },
+	{ "LMD44", "OK:mode:THX Music\n" },
+	{ "LMD45", "OK:mode:THX Games\n" },
+	{ "LMD80", "OK:mode:Pro Logic IIx Movie\n" },
+	{ "LMD81", "OK:mode:Pro Logic IIx Music\n" },
+	{ "LMD82", "OK:mode:Neo:6 Cinema\n" },
+	{ "LMD83", "OK:mode:Neo:6 Music\n" },
+	{ "LMD84", "OK:mode:PLIIx THX Cinema\n" },
+	{ "LMD85", "OK:mode:Neo:6 THX Cinema\n" },
+	{ "LMD86", "OK:mode:Pro Logic IIx Game\n" },
+	{ "LMD88", "OK:mode:Neural THX\n" },
+	{ "LMDN/A", "ERROR:mode:N/A\n" },
+
+	{ "MEMLOCK", "OK:memory:locked\n" },
+	{ "MEMUNLK", "OK:memory:unlocked\n" },
+	{ "MEMN/A",  "ERROR:memory:N/A\n" },
+
+	{ "ZMT00", "OK:zone2mute:off\n" },
+	{ "ZMT01", "OK:zone2mute:on\n" },
+
+	{ "ZVLN/A", "ERROR:zone2volume:N/A\n" },
+
+	{ "SLZ00", "OK:zone2input:DVR\n" },
+	{ "SLZ01", "OK:zone2input:Cable\n" },
+	{ "SLZ02", "OK:zone2input:TV\n" },
+	{ "SLZ03", "OK:zone2input:AUX\n" },
+	{ "SLZ04", "OK:zone2input:AUX2\n" },
+	{ "SLZ10", "OK:zone2input:DVD\n" },
+	{ "SLZ20", "OK:zone2input:Tape\n" },
+	{ "SLZ22", "OK:zone2input:Phono\n" },
+	{ "SLZ23", "OK:zone2input:CD\n" },
+	{ "SLZ24", "OK:zone2input:FM Tuner\n" },
+	{ "SLZ25", "OK:zone2input:AM Tuner\n" },
+	{ "SLZ26", "OK:zone2input:Tuner\n" },
+	{ "SLZ30", "OK:zone2input:Multichannel\n" },
+	{ "SLZ31", "OK:zone2input:XM Radio\n" },
+	{ "SLZ32", "OK:zone2input:Sirius Radio\n" },
+	{ "SLZ7F", "OK:zone2input:Off\n" },
+	{ "SLZ80", "OK:zone2input:Source\n" },
+
+	{ "MT300", "OK:zone3mute:off\n" },
+	{ "MT301", "OK:zone3mute:on\n" },
+
+	{ "VL3N/A", "ERROR:zone3volume:N/A\n" },
+
+	{ "SL300", "OK:zone3input:DVR\n" },
+	{ "SL301", "OK:zone3input:Cable\n" },
+	{ "SL302", "OK:zone3input:TV\n" },
+	{ "SL303", "OK:zone3input:AUX\n" },
+	{ "SL304", "OK:zone3input:AUX2\n" },
+	{ "SL310", "OK:zone3input:DVD\n" },
+	{ "SL320", "OK:zone3input:Tape\n" },
+	{ "SL322", "OK:zone3input:Phono\n" },
+	{ "SL323", "OK:zone3input:CD\n" },
+	{ "SL324", "OK:zone3input:FM Tuner\n" },
+	{ "SL325", "OK:zone3input:AM Tuner\n" },
+	{ "SL326", "OK:zone3input:Tuner\n" },
+	{ "SL330", "OK:zone3input:Multichannel\n" },
+	{ "SL331", "OK:zone3input:XM Radio\n" },
+	{ "SL332", "OK:zone3input:Sirius Radio\n" },
+	{ "SL37F", "OK:zone3input:Off\n" },
+	{ "SL380", "OK:zone3input:Source\n" },
+
+	{ "DIF00", "OK:display:Volume\n" },
+	{ "DIF01", "OK:display:Mode\n" },
+	{ "DIF02", "OK:display:Digital Format\n" },
+	{ "DIFN/A", "ERROR:display:N/A\n" },
+
+	{ "DIM00", "OK:dimmer:Bright\n" },
+	{ "DIM01", "OK:dimmer:Dim\n" },
+	{ "DIM02", "OK:dimmer:Dark\n" },
+	{ "DIM03", "OK:dimmer:Shut-off\n" },
+	{ "DIM08", "OK:dimmer:Bright (LED off)\n" },
+	{ "DIMN/A", "ERROR:dimmer:N/A\n" },
+
+	{ "LTN00", "OK:latenight:off\n" },
+	{ "LTN01", "OK:latenight:low\n" },
+	{ "LTN02", "OK:latenight:high\n" },
+
+	{ "RAS00", "OK:re-eq:off\n" },
+	{ "RAS01", "OK:re-eq:on\n" },
+
+	{ "ADY00", "OK:audyssey:off\n" },
+	{ "ADY01", "OK:audyssey:on\n" },
+	{ "ADQ00", "OK:dynamiceq:off\n" },
+	{ "ADQ01", "OK:dynamiceq:on\n" },
+
+	{ "HDO00", "OK:hdmiout:off\n" },
+	{ "HDO01", "OK:hdmiout:on\n" },
+
+	{ "RES00", "OK:resolution:Through\n" },
+	{ "RES01", "OK:resolution:Auto\n" },
+	{ "RES02", "OK:resolution:480p\n" },
+	{ "RES03", "OK:resolution:720p\n" },
+	{ "RES04", "OK:resolution:1080i\n" },
+	{ "RES05", "OK:resolution:1080p\n" },
+
+	{ "SLA00", "OK:audioselector:Auto\n" },
+	{ "SLA01", "OK:audioselector:Multichannel\n" },
+	{ "SLA02", "OK:audioselector:Analog\n" },
+	{ "SLA03", "OK:audioselector:iLink\n" },
+	{ "SLA04", "OK:audioselector:HDMI\n" },
+
+	{ "TGA00", "OK:triggera:off\n" },
+	{ "TGA01", "OK:triggera:on\n" },
+	{ "TGAN/A", "ERROR:triggera:N/A\n" },
+
+	{ "TGB00", "OK:triggerb:off\n" },
+	{ "TGB01", "OK:triggerb:on\n" },
+	{ "TGBN/A", "ERROR:triggerb:N/A\n" },
+
+	{ "TGC00", "OK:triggerc:off\n" },
+	{ "TGC01", "OK:triggerc:on\n" },
+	{ "TGCN/A", "ERROR:triggerc:N/A\n" },
 
 	/* Do not remove! */
-	{ 0, NULL,    NULL },
+	{ NULL,    NULL },
 };
 
 static struct power_status power_statuses[] = {
-	{ 0, "PWR00", "OK:power:off\n",      1, 0 },
-	{ 0, "PWR01", "OK:power:on\n",       1, 1 },
+	{ "PWR00", "OK:power:off\n",      1, 0 },
+	{ "PWR01", "OK:power:on\n",       1, 1 },
 
-	{ 0, "ZPW00", "OK:zone2power:off\n", 2, 0 },
-	{ 0, "ZPW01", "OK:zone2power:on\n",  2, 1 },
+	{ "ZPW00", "OK:zone2power:off\n", 2, 0 },
+	{ "ZPW01", "OK:zone2power:on\n",  2, 1 },
 
-	{ 0, "PW300", "OK:zone3power:off\n", 3, 0 },
-	{ 0, "PW301", "OK:zone3power:on\n",  3, 1 },
+	{ "PW300", "OK:zone3power:off\n", 3, 0 },
+	{ "PW301", "OK:zone3power:on\n",  3, 1 },
 
 	/* Do not remove! */
-	{ 0, NULL,    NULL,            -1,-1 },
+	{ NULL,    NULL,            -1,-1 },
 };
 
+/** Indexes of statuses and power_statuses, built by init_statuses() */
+static struct hash_index status_index;
+static struct hash_index power_status_index;
+
 /**
  * Initialize our list of static statuses. This must be called before the first
- * call to process_incoming_message(). This initialization gives us a slight
- * performance gain by pre-hashing our status values to unsigned longs,
- * allowing the status lookups to be relatively low-cost.
+ * call to process_incoming_message(). The status values are placed in hash
+ * indexes, so looking up a status costs the same no matter how many we know.
+ * @return 0 on success, -1 on allocation failure
  */
-void init_statuses(void)
+int init_statuses(void)
 {
-	unsigned int status_count = 0;
+	unsigned int status_count = 0, power_count = 0;
 	struct status *status;
 	struct power_status *pwr_status;
-	for(status = statuses; status->key; status++) {
-		status->hash = hash_sdbm(status->key);
+
+	for(status = statuses; status->key; status++)
 		status_count++;
+	for(pwr_status = power_statuses; pwr_status->key; pwr_status++)
+		power_count++;
+	if(hash_index_init(&status_index, status_count) == -1 ||
+			hash_index_init(&power_status_index, power_count) == -1)
+		return -1;
+
+	for(status = statuses; status->key; status++)
+		hash_index_add(&status_index, status->key, status);
+	for(pwr_status = power_statuses; pwr_status->key; pwr_status++)
+		hash_index_add(&power_status_index, pwr_status->key, pwr_status);
+
+	log_msg(LEVEL_INFO, "%u status messages prehashed in status list.",
+			status_count + power_count);
+	return 0;
+}
+
+/**
+ * Free the memory used by our status indexes.
+ */
+void free_statuses(void)
+{
+	hash_index_free(&status_index);
+	hash_index_free(&power_status_index);
+}
+
+static void update_power_status(struct receiver *rcvr, int zone, int value);
+
+/**
+ * Find the cache slot for the status key of a message. The key is the part
+ * of the message between the first and second colons, e.g. "volume" in
+ * "OK:volume:42\n". Only messages starting with "OK:" have a slot.
+ * @param rcvr the receiver whose cache should be searched
+ * @param msg a status message, or just the key itself if is_key is set
+ * @param is_key whether msg is a bare key rather than a full message
+ * @param create whether to claim an empty slot if the key is not found
+ * @return the cache slot, NULL if not found or the cache is full
+ */
+static struct cached_status *find_cached_status(struct receiver *rcvr,
+		const char *msg, int is_key, int create)
+{
+	char key[BUF_SIZE];
+	const char *end;
+	size_t len;
+	unsigned long hashval;
+	struct cached_status *cs, *empty = NULL;
+
+	if(!is_key) {
+		if(strncmp(msg, "OK:", 3) != 0)
+			return NULL;
+		msg += 3;
 	}
-	for(pwr_status = power_statuses; pwr_status->key; pwr_status++) {
-		pwr_status->hash = hash_sdbm(pwr_status->key);
-		status_count++;
+	end = strchr(msg, ':');
+	len = end ? (size_t)(end - msg) : strlen(msg);
+	if(len == 0 || len >= BUF_SIZE)
+		return NULL;
+	memcpy(key, msg, len);
+	key[len] = '\0';
+	hashval = hash_sdbm(key);
+
+	for(cs = rcvr->cache; cs < rcvr->cache + STATUS_CACHE_SIZE; cs++) {
+		if(cs->hash == 0) {
+			if(!empty)
+				empty = cs;
+			continue;
+		}
+		/* make sure a hash collision doesn't hand back the wrong key */
+		if(cs->hash == hashval && strncmp(cs->msg + 3, key, len) == 0
+				&& cs->msg[3 + len] == ':')
+			return cs;
+	}
+	if(create && empty) {
+		empty->hash = hashval;
+		return empty;
 	}
-	printf("%u status messages prehashed in status list.\n", status_count);
+	return NULL;
 }
 
-static void update_power_status(struct receiver *rcvr, int zone, int value);
+/**
+ * Look up the last known status message for a given key.
+ * @param rcvr the receiver to look up the status for
+ * @param key the status key, e.g. "volume"
+ * @param now time value to use as 'now'
+ * @return the full status message, NULL if the key has not been seen or
+ * the value is more than STATUS_CACHE_AGE seconds old
+ */
+const char *rcvr_cached_status(struct receiver *rcvr, const char *key,
+		struct timeval *now)
+{
+	struct timeval diff;
+	struct cached_status *cs = find_cached_status(rcvr, key, 1, 0);
+
+	if(!cs)
+		return NULL;
+	timeval_diff(now, &cs->when, &diff);
+	/* treat a clock that went backwards as stale as well */
+	if(diff.tv_sec < 0 || diff.tv_sec >= STATUS_CACHE_AGE)
+		return NULL;
+	return cs->msg;
+}
+
+/**
+ * Write every status message in the receiver's status cache that is not
+ * yet stale to a connection, in the order the keys were first seen.
+ * Messages are gathered up front so this is a single write, or a few if
+ * they don't fit in a connection send buffer together.
+ * @param rcvr the receiver whose cached status should be written
+ * @param c the connection to write to
+ * @param now time value to use as 'now'
+ * @return 0 on success, -1 if the connection was closed
+ */
+int rcvr_write_snapshot(struct receiver *rcvr, struct conn *c,
+		struct timeval *now)
+{
+	char buf[SEND_BUF_SIZE + 1];
+	size_t len = 0;
+	struct cached_status *cs;
+
+	for(cs = rcvr->cache; cs < rcvr->cache + STATUS_CACHE_SIZE; cs++) {
+		struct timeval diff;
+		size_t msglen;
+
+		if(cs->hash == 0)
+			continue;
+		timeval_diff(now, &cs->when, &diff);
+		if(diff.tv_sec < 0 || diff.tv_sec >= STATUS_CACHE_AGE)
+			continue;
+		msglen = strlen(cs->msg);
+		if(len + msglen > SEND_BUF_SIZE) {
+			buf[len] = '\0';
+			if(write_to_connection(c, buf) == -1)
+				return -1;
+			len = 0;
+		}
+		memcpy(buf + len, cs->msg, msglen);
+		len += msglen;
+	}
+	if(len == 0)
+		return 0;
+	buf[len] = '\0';
+	return write_to_connection(c, buf);
+}
+
+/**
+ * Remember a status message in the receiver's status cache and send it on
+ * to all connected clients. Anything that is not an "OK:" status for a
+ * known key (errors, "OK:todo:" messages) is only sent.
+ * @param rcvr the receiver the message was received from
+ * @param msg the message to cache and write, including trailing newline
+ */
+static void broadcast_status(struct receiver *rcvr, const char *msg)
+{
+	if(strncmp(msg, "OK:todo:", 8) != 0 && strlen(msg) < BUF_SIZE) {
+		struct cached_status *cs = find_cached_status(rcvr, msg, 0, 1);
+		if(cs) {
+			strcpy(cs->msg, msg);
+			gettimeofday(&cs->when, NULL);
+		}
+	}
+	write_to_connections(msg);
+}
 
 /**
  * Form the human readable status message from the receiver return value.
@@ -374,19 +816,16 @@ static int parse_status(struct receiver *rcvr, size_t size, char *status)
 {
 	unsigned long hashval;
 	char buf[BUF_SIZE];
-	char *sptr, *eptr;
+	char *sptr;
 	struct status *st;
 	struct power_status *pwr_st;
 
-	/* Trim the start and end portions off. We want to strip any leading
-	 * garbage, including null bytes, and just start where we find the
-	 * START_RECV characters. */
+	/* Trim the start portion off; the end was already cut off when the
+	 * message was framed. We want to strip any leading garbage, including
+	 * null bytes, and just start where we find the START_RECV characters. */
 	sptr = memmem(status, size, START_RECV, strlen(START_RECV));
 	if(sptr) {
 		sptr += strlen(START_RECV);
-		eptr = strstr(sptr, END_RECV);
-		if(eptr)
-			*eptr = '\0';
 	} else {
 		/* Hmm, we couldn't find the start chars. WTF? */
 		write_to_connections(rcvr_err);
@@ -394,24 +833,17 @@ static int parse_status(struct receiver *rcvr, size_t size, char *status)
 	}
 
 	hashval = hash_sdbm(sptr);
-	/* this depends on the {NULL} entry at the end of the list */
-	st = statuses;
-	while(st->hash != 0) {
-		if(st->hash == hashval) {
-			write_to_connections(st->value);
-			return 0;
-		}
-		st++;
+	st = hash_index_find(&status_index, sptr, hashval);
+	if(st) {
+		broadcast_status(rcvr, st->value);
+		return 0;
 	}
 
-	pwr_st = power_statuses;
-	while(pwr_st->hash != 0) {
-		if(pwr_st->hash == hashval) {
-			update_power_status(rcvr, pwr_st->zone, pwr_st->power);
-			write_to_connections(pwr_st->value);
-			return 0;
-		}
-		pwr_st++;
+	pwr_st = hash_index_find(&power_status_index, sptr, hashval);
+	if(pwr_st) {
+		update_power_status(rcvr, pwr_st->zone, pwr_st->power);
+		broadcast_status(rcvr, pwr_st->value);
+		return 0;
 	}
 
 	/* We couldn't use our easy method of matching statuses to messages,
@@ -439,7 +871,7 @@ static int parse_status(struct receiver *rcvr, size_t size, char *status)
 		}
 		/* this block is special compared to the rest; we write out buf2 here
 		 * but let the normal write at the end handle buf as usual */
-		write_to_connections(buf2);
+		broadcast_status(rcvr, buf2);
 	}
 
 	/* TUN, TUZ, TU3 */
@@ -510,9 +942,10 @@ static int parse_status(struct receiver *rcvr, size_t size, char *status)
 
 	else {
 		snprintf(buf, BUF_SIZE, "OK:todo:%s\n", sptr);
+		rcvr->msgs_unparsed++;
 	}
 
-	write_to_connections(buf);
+	broadcast_status(rcvr, buf);
 	return 0;
 }
 
@@ -546,35 +979,240 @@ static void update_power_status(struct receiver *rcvr, int zone, int value)
 }
 
 /**
- * Process a status message to be read from the receiver (one that the
- * receiver initiated). Return a human-readable status message.
- * @param rcvr the receiver to process the command for
- * @param logfd the fd used for logging raw status messages
- * @return 0 on successful processing, -1 on failure
+ * Check whether a status message answers the last command sent, and if so
+ * fold the time it took into the receiver's smoothed reply time. The
+ * smoothing is the same as for TCP round trip times, and like there, no
+ * time is taken while an earlier command may still be answered.
+ * @param rcvr the receiver the message came from
+ * @param size the length of the message
+ * @param status the message, including its start and end characters
+ * @return 1 if the message answers the last command sent, 0 otherwise
  */
-int process_incoming_message(struct receiver *rcvr, int logfd)
+static int note_reply(struct receiver *rcvr, size_t size, const char *status)
 {
-	int ret;
-	ssize_t size;
-	char *status = NULL;
-
-	/* get the output from the receiver */
-	size = rcvr_handle_status(rcvr->fd, &status);
-	if(size >= 0) {
-		/* log the message if we have a logfd */
-		if(logfd > 0)
-			xwrite(logfd, status, (size_t)size + 1);
-		/* parse the return and output a status message */
-		ret = parse_status(rcvr, (size_t)size, status);
-		if(!ret)
-			rcvr->msgs_received++;
+	struct timeval now, diff;
+	const char *sptr;
+	long sample;
+
+	if(!rcvr->awaiting_len)
+		return 0;
+	sptr = memmem(status, size, START_RECV, strlen(START_RECV));
+	if(!sptr || strncmp(sptr + strlen(START_RECV), rcvr->awaiting,
+				rcvr->awaiting_len) != 0)
+		return 0;
+	rcvr->awaiting_len = 0;
+	if(rcvr->awaiting_late)
+		return 1;
+
+	gettimeofday(&now, NULL);
+	timeval_diff(&now, &rcvr->last_cmd, &diff);
+	if(diff.tv_sec < 0)
+		return 1;
+	sample = diff.tv_sec * 1000000 + diff.tv_usec;
+	histogram_add(&rcvr->reply_hist, (unsigned long)sample);
+	if(rcvr->reply_avg == 0) {
+		rcvr->reply_avg = sample;
+		rcvr->reply_dev = sample / 2;
 	} else {
-		write_to_connections(rcvr_err);
+		long delta = sample - rcvr->reply_avg;
+		rcvr->reply_dev += ((delta < 0 ? -delta : delta)
+				- rcvr->reply_dev) / 4;
+		rcvr->reply_avg += delta / 8;
+	}
+	return 1;
+}
+
+/**
+ * Whether a character ends a receiver status message. Receivers end their
+ * messages with an EOF character, some follow it up with CR LF, and some
+ * send CR LF only.
+ * @param ch the character to check
+ * @return 1 if this ends a message, 0 otherwise
+ */
+static int is_end_char(char ch)
+{
+	return ch == END_RECV[0] || ch == '\r' || ch == '\n';
+}
+
+/**
+ * Process one complete status message.
+ * @param rcvr the receiver the message came from
+ * @param len the length of the message
+ * @param msg the message, without its end characters and NUL terminated
+ * @return 0 on success, -1 if the message could not be parsed
+ */
+static int handle_message(struct receiver *rcvr, size_t len, char *msg)
+{
+	int answered = note_reply(rcvr, len, msg);
+	int ret = 0;
+
+	/* parse the message and output a status message */
+	if(parse_status(rcvr, len, msg) != 0) {
+		rcvr->msgs_invalid++;
 		ret = -1;
+	} else {
+		rcvr->msgs_received++;
 	}
+	/* after the status, so whoever asked has it when told */
+	if(answered)
+		request_ack(&rcvr->awaiting_req, "answered", rcvr->awaiting);
+	return ret;
+}
 
-	free(status);
+/**
+ * Frame the status messages of a serial receiver, which are separated by
+ * their end characters only.
+ * @param rcvr the receiver to process messages for
+ * @param size the number of bytes just read into the input buffer
+ * @return 0 on success, -1 if some message could not be parsed
+ */
+static int frame_stream(struct receiver *rcvr, size_t size)
+{
+	int ret = 0;
+	char *start, *end, *p;
+	size_t left;
+
+	start = rcvr->recv_buf;
+	end = rcvr->recv_buf + rcvr->recv_len + size;
+	for(p = rcvr->recv_buf + rcvr->recv_len; p < end; p++) {
+		size_t len;
+
+		if(!is_end_char(*p))
+			continue;
+		len = (size_t)(p - start);
+		*p = '\0';
+		if(rcvr->recv_discard) {
+			/* the end of an overlong message we already complained about */
+			rcvr->recv_discard = 0;
+		} else if(len && handle_message(rcvr, len, start) != 0) {
+			ret = -1;
+		}
+		start = p + 1;
+	}
+
+	left = (size_t)(end - start);
+	if(left == RCVR_BUF_SIZE) {
+		/* complain once per message, however long it goes on */
+		if(!rcvr->recv_discard) {
+			log_msg(LEVEL_WARN, "receiver message too long, skipping it");
+			write_to_connections(rcvr_err);
+			rcvr->recv_discard = 1;
+		}
+		left = 0;
+	} else if(left && start != rcvr->recv_buf) {
+		memmove(rcvr->recv_buf, start, left);
+	}
+	rcvr->recv_len = left;
 	return ret;
 }
 
+/**
+ * Frame the status messages of a network receiver. Each one comes in an
+ * eISCP packet: a header giving its own length and the length of the
+ * message, then the message with its usual end characters.
+ * @param rcvr the receiver to process messages for
+ * @param size the number of bytes just read into the input buffer
+ * @return 0 on success, -1 if some message could not be parsed
+ */
+static int frame_packets(struct receiver *rcvr, size_t size)
+{
+	int ret = 0;
+	char *start, *end;
+	size_t left;
+
+	start = rcvr->recv_buf;
+	end = rcvr->recv_buf + rcvr->recv_len + size;
+	if(rcvr->recv_skip) {
+		/* more of an overlong packet we already complained about */
+		size_t skip = (size_t)(end - start);
+		if(skip > rcvr->recv_skip)
+			skip = rcvr->recv_skip;
+		start += skip;
+		rcvr->recv_skip -= skip;
+	}
+
+	while((left = (size_t)(end - start)) >= EISCP_HEADER_SIZE) {
+		unsigned long hdr_len = get_be32(start + 4);
+		unsigned long data_len = get_be32(start + 8);
+		size_t len;
+		char *msg, saved;
+
+		if(memcmp(start, "ISCP", 4) != 0 || hdr_len < EISCP_HEADER_SIZE ||
+				hdr_len >= RCVR_BUF_SIZE) {
+			/* we lost track of the packets; look for the next one, but
+			 * keep a tail that may be the start of its header */
+			char *next = memmem(start + 1, left - 1, "ISCP", 4);
+			log_msg(LEVEL_WARN, "receiver sent a bad packet, skipping it");
+			start = next ? next : end - 3;
+			continue;
+		}
+		/* a packet must fit in the buffer with a byte to spare for the
+		 * NUL after its message */
+		if(hdr_len + data_len >= RCVR_BUF_SIZE) {
+			size_t skip = hdr_len + data_len < left ?
+				hdr_len + data_len : left;
+			log_msg(LEVEL_WARN, "receiver message too long, skipping it");
+			write_to_connections(rcvr_err);
+			rcvr->recv_skip = hdr_len + data_len - skip;
+			start += skip;
+			continue;
+		}
+		if(left < hdr_len + data_len)
+			break;
+
+		msg = start + hdr_len;
+		len = data_len;
+		start = msg + data_len;
+		while(len && is_end_char(msg[len - 1]))
+			len--;
+		if(!len)
+			continue;
+		/* the byte after the message may belong to the next packet */
+		saved = msg[len];
+		msg[len] = '\0';
+		if(handle_message(rcvr, len, msg) != 0)
+			ret = -1;
+		msg[len] = saved;
+	}
+
+	if(left && start != rcvr->recv_buf)
+		memmove(rcvr->recv_buf, start, left);
+	rcvr->recv_len = left;
+	return ret;
+}
+
+/**
+ * Read whatever the receiver has sent and process every complete status
+ * message in it. Messages are framed in the receiver's own input buffer,
+ * and a message split over several reads is kept there until its end
+ * arrives. A message that does not fit in the buffer is skipped.
+ * @param rcvr the receiver to process messages for
+ * @return 0 on successful processing, -1 if some message could not be
+ * parsed, -2 if the receiver device could not be read
+ */
+int process_incoming_message(struct receiver *rcvr)
+{
+	ssize_t size;
+
+	size = xread(rcvr->fd, rcvr->recv_buf + rcvr->recv_len,
+			RCVR_BUF_SIZE - rcvr->recv_len);
+	if(size <= 0) {
+		if(size < 0) {
+			log_msg(LEVEL_ERROR, "receiver read: %s", strerror(errno));
+			rcvr->read_errors++;
+		} else {
+			log_msg(LEVEL_ERROR, "receiver read, device hung up");
+		}
+		write_to_connections(rcvr_err);
+		return -2;
+	}
+
+	/* capture the raw input before framing writes into the buffer */
+	capture_record(CAPTURE_RX, rcvr, rcvr->recv_buf + rcvr->recv_len,
+			(size_t)size);
+	if(rcvr->type == RCVR_NET)
+		return frame_packets(rcvr, (size_t)size);
+	return frame_stream(rcvr, (size_t)size);
+}
+
 /* vim: set ts=4 sw=4 noet: */
@@ -17,6 +17,8 @@
  *  along with this program.  If not, see <http://www.gnu.org/licenses/>.
  */
 
+#include <stdlib.h> /* calloc, free */
+#include <string.h> /* strcmp */
 #include <sys/stat.h> /* open */
 #include <sys/time.h> /* struct timeval */
 #include <fcntl.h>  /* open */
@@ -87,6 +89,116 @@ unsigned long hash_sdbm(const char *str)
 	return hash;
 }
 
+/**
+ * Set up an empty hash index with room for the given number of keys. The
+ * table is kept at most half full so probe sequences stay short.
+ * @param idx the index to set up
+ * @param count the number of keys that will be added
+ * @return 0 on success, -1 on allocation failure
+ */
+int hash_index_init(struct hash_index *idx, size_t count)
+{
+	size_t size = 8;
+
+	while(size < count * 2)
+		size *= 2;
+	idx->slots = calloc(size, sizeof(struct hash_slot));
+	if(!idx->slots) {
+		idx->mask = 0;
+		return -1;
+	}
+	idx->mask = size - 1;
+	return 0;
+}
+
+/**
+ * Add a key to a hash index. The key string is not copied and must stay
+ * valid for the lifetime of the index. Adding a key that is already
+ * present leaves the first value in place.
+ * @param idx the index to add to
+ * @param key the key string
+ * @param value the value to return when the key is looked up
+ * @return 0 on success, -1 if the index is full
+ */
+int hash_index_add(struct hash_index *idx, const char *key, void *value)
+{
+	unsigned long hash = hash_sdbm(key);
+	size_t i = hash & idx->mask, probes;
+
+	for(probes = 0; probes <= idx->mask; probes++) {
+		struct hash_slot *slot = &idx->slots[i];
+		if(!slot->key) {
+			slot->hash = hash;
+			slot->key = key;
+			slot->value = value;
+			return 0;
+		}
+		if(slot->hash == hash && strcmp(slot->key, key) == 0)
+			return 0;
+		i = (i + 1) & idx->mask;
+	}
+	return -1;
+}
+
+/**
+ * Look up a key in a hash index. The key string is always compared, so
+ * two keys with the same hash value can never be confused.
+ * @param idx the index to search
+ * @param key the key string
+ * @param hash the hash_sdbm() value of key
+ * @return the value added for the key, NULL if it is not present
+ */
+void *hash_index_find(const struct hash_index *idx,
+		const char *key, unsigned long hash)
+{
+	size_t i = hash & idx->mask;
+
+	if(!idx->slots)
+		return NULL;
+	for(;;) {
+		const struct hash_slot *slot = &idx->slots[i];
+		if(!slot->key)
+			return NULL;
+		if(slot->hash == hash && strcmp(slot->key, key) == 0)
+			return slot->value;
+		i = (i + 1) & idx->mask;
+	}
+}
+
+/**
+ * Free the memory used by a hash index.
+ * @param idx the index to free
+ */
+void hash_index_free(struct hash_index *idx)
+{
+	free(idx->slots);
+	idx->slots = NULL;
+	idx->mask = 0;
+}
+
+/** Upper bounds (in milliseconds) of all but the last histogram bucket */
+const unsigned long histogram_bounds[HIST_BUCKETS - 1] = {
+	1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000,
+};
+
+/**
+ * Count a time in a histogram.
+ * @param h the histogram
+ * @param usec the time in microseconds
+ */
+void histogram_add(struct histogram *h, unsigned long usec)
+{
+	size_t i;
+
+	for(i = 0; i < HIST_BUCKETS - 1; i++) {
+		if(usec <= histogram_bounds[i] * 1000)
+			break;
+	}
+	h->counts[i]++;
+	h->count++;
+	h->sum += usec;
+}
+
 void timeval_diff(struct timeval * restrict a,
 		struct timeval * restrict b, struct timeval * restrict result)
 {